@@ -1,24 +1,34 @@
 import asyncio
 import logging
+import signal
 
 from telegram.ext import (
     ApplicationBuilder,
     CallbackContext,
     CommandHandler,
     MessageHandler,
-    CallbackQueryHandler,
     PreCheckoutQueryHandler,
     JobQueue,
-    AIORateLimiter,
     filters,
     Application,
 )
 
 from bot import config
+from bot.database import db
+from bot import metrics
+from bot.metrics import InstrumentedHTTPXRequest
+from bot.executors import shutdown_executors, get_executors_statistics, io_pool
+from bot.context_budget import load_encodings
+from bot.model_clients import model_clients
+from bot.handlers.streaming_edits import streaming_edit_scheduler, RateLimiter
+from bot.handlers.utils import user_locks
+from bot.webhook import run_webhook
+from bot.workers import user_leases, get_worker_port
 from bot.queue.message_queue import MessageQueueWatchdog
-from bot.queue.user_task import UserTask
+from bot.queue.user_task import UserTask, cancel_user_task
 from bot.queue.globals import message_queue
 from bot.handlers import constants
+from bot.handlers.callback_router import CallbackQueryRouter
 from bot.handlers.crypto_payments_status_checkers import (
     check_not_expired_payments_job_fn
 )
@@ -39,10 +49,12 @@ from bot.handlers.chat_mode import (
     set_chat_mode_handle,
     show_chat_modes_callback_handle,
     show_chat_modes_handle,
+    build_chat_mode_menus,
 )
 from bot.handlers.settings import (
     settings_handle,
     set_settings_handle,
+    build_settings_menus,
 )
 from bot.handlers.balance import show_balance_handle, speedup_message_queue_button_handle
 from bot.handlers.checkout import (
@@ -58,16 +70,91 @@ from bot.handlers.payments_ui import (
 from bot.handlers.admin import (
     user_info_handle,
     add_tokens_handle,
+    index_stats_handle,
+    perf_handle,
 )
+from bot.handlers.config_reload import reload_config_handle, schedule_config_reload
 from bot.handlers.error import error_handle
 
 
 logger = logging.getLogger(__name__)
 
 
+def setup_logging() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)-12s :%(name)-15s: %(levelname)-8s %(message)s'
+    )
+    logging.getLogger("openai").setLevel(logging.ERROR)
+
+
+def register_gauges(application: Application) -> None:
+    metrics.registry.register(metrics.Gauge(
+        "bot_user_cache_size", "Number of cached user documents", lambda: len(db.user_cache),
+    ))
+    metrics.registry.register(metrics.Gauge(
+        "bot_user_cache_hit_rate", "User cache hit rate", lambda: db.user_cache.get_statistics()["hit_rate"],
+    ))
+    metrics.registry.register(metrics.Gauge(
+        "bot_user_write_buffer_size", "Number of users with buffered writes", lambda: db.get_user_write_buffer_statistics()["n_users"],
+    ))
+    metrics.registry.register(metrics.Gauge(
+        "bot_user_locks_size", "Number of users with held or awaited locks", lambda: len(user_locks),
+    ))
+    metrics.registry.register(metrics.Gauge(
+        "bot_executor_queue_depth", "Calls waiting for free executor worker (estimated from calls in flight)",
+        lambda: {name: stats["queue_depth"] for name, stats in get_executors_statistics().items()}, labelname="executor",
+    ))
+    metrics.registry.register(metrics.Gauge(
+        "bot_executor_active_workers", "Busy executor workers (estimated from calls in flight)",
+        lambda: {name: stats["n_active_workers"] for name, stats in get_executors_statistics().items()}, labelname="executor",
+    ))
+    metrics.registry.register(metrics.Gauge(
+        "bot_streaming_chats", "Chats with answers being streamed", lambda: len(streaming_edit_scheduler),
+    ))
+    metrics.registry.register(metrics.Gauge(
+        "bot_llm_client_events", "Model client and HTTP connection creations and reuses",
+        lambda: {
+            name: value for name, value in model_clients.get_statistics().items()
+            if name.startswith(("n_clients_", "n_connections_"))
+        },
+        labelname="event",
+    ))
+    if "webhook_server" in application.bot_data:
+        webhook_server = application.bot_data["webhook_server"]
+        metrics.registry.register(metrics.Gauge(
+            "bot_webhook_pending_updates", "Updates received by webhook but not yet processed", lambda: webhook_server.n_pending_updates,
+        ))
+    if config.enable_message_queue:
+        metrics.registry.register(metrics.Gauge(
+            "bot_message_queue_size", "Tasks in message queue", lambda: len(message_queue),
+        ))
+
+
 async def post_init(application: Application):
     logger.info("Post init started")
 
+    await db.setup()
+
+    user_leases.on_cancel_requested = cancel_user_task
+    user_leases.run()
+
+    build_chat_mode_menus()
+    build_settings_menus()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, schedule_config_reload)
+
+    # tokenizers are loaded from disk or network, don't do it on event loop during first message
+    try:
+        await io_pool.run(load_encodings)
+    except Exception:
+        logger.exception("Failed to preload tokenizers")
+
+    register_gauges(application)
+    if config.metrics_port is not None:
+        metrics_server = metrics.MetricsServer(config.metrics_listen, config.metrics_port + config.worker_index)
+        await metrics_server.start()
+        application.bot_data["metrics_server"] = metrics_server
+
     if not config.enable_message_queue:
         return
 
@@ -96,49 +183,86 @@ async def post_init(application: Application):
 async def pre_stop(application: Application):
     logger.info("Pre stop started")
 
-    if not config.enable_message_queue:
-        return
+    # step 0: stop receiving updates
+    if "webhook_server" in application.bot_data:
+        await application.bot_data["webhook_server"].stop()
+
+    if config.enable_message_queue:
+        # step 1: stop queue
+        await message_queue.shutdown()
 
-    # step 1: stop queue
-    await message_queue.shutdown()
+        # step 2: stop watchdog
+        await application.bot_data["message_queue_watchdog"].shutdown()
 
-    # step 2: stop watchdog
-    await application.bot_data["message_queue_watchdog"].shutdown()
+        # step 3: await loaded user tasks
+        await UserTask.await_loaded_tasks(application)
 
-    # step 3: await loaded user tasks
-    await UserTask.await_loaded_tasks(application)
+    # step 4: stop renewing user leases (leases of unfinished tasks expire by themselves)
+    await user_leases.shutdown()
+
+    # step 5: flush buffered user activity
+    try:
+        n_flushed_users = await db.flush_user_write_buffer()
+        logger.info(f"Flushed activity of {n_flushed_users} users")
+    except Exception:
+        logger.exception("Failed to flush user activity buffer")
+
+    # step 6: shutdown executors
+    shutdown_executors(wait=False)
+
+    # step 7: stop serving metrics
+    if "metrics_server" in application.bot_data:
+        await application.bot_data["metrics_server"].stop()
+
+    # step 8: close model clients connections
+    await model_clients.close()
 
     logger.info("Pre stop finished")
 
 
+async def flush_user_write_buffer_job_fn(context: CallbackContext):
+    try:
+        await db.flush_user_write_buffer()
+    except Exception as e:
+        logger.error(f"Failed to flush user activity buffer. Reason: {e}")
+
+
 def run_bot() -> None:
     class _ApplicationWithPreStop(Application):
         async def stop(self) -> None:
             await pre_stop(self)
             await super().stop()
 
-    application = (
+    application_builder = (
         ApplicationBuilder()
         .application_class(_ApplicationWithPreStop)
         .token(config.telegram_token)
         .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=3))
-        .http_version("1.1")
+        .rate_limiter(RateLimiter(max_retries=3))
+        .request(InstrumentedHTTPXRequest(connection_pool_size=256, read_timeout=30, write_timeout=30, http_version="1.1"))
         .get_updates_http_version("1.1")
-        .read_timeout(30)
-        .write_timeout(30)
         .post_init(post_init)
-        .build()
     )
+    application = application_builder.build()
 
-    # run job to check not expired payments
+    # run job to check not expired payments (in one worker only, otherwise payments are checked several times)
+    if config.worker_index == 0:
+        application.job_queue.run_repeating(
+            check_not_expired_payments_job_fn,
+            interval=config.check_not_expired_payments_update_time,
+            name="check_not_expired_payments_job",
+        )
+
+    # run job to write buffered user activity to database
     application.job_queue.run_repeating(
-        check_not_expired_payments_job_fn,
-        interval=config.check_not_expired_payments_update_time,
-        name="check_not_expired_payments_job",
+        flush_user_write_buffer_job_fn,
+        interval=config.user_activity_flush_interval,
+        name="flush_user_write_buffer_job",
     )
 
     # add handlers
+    callback_query_router = CallbackQueryRouter()
+
     if len(config.allowed_telegram_usernames) == 0:
         user_filter = filters.ALL
     else:
@@ -157,35 +281,48 @@ def run_bot() -> None:
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & user_filter, message_handle))
     application.add_handler(CommandHandler("retry", retry_handle, filters=user_filter))
     application.add_handler(CommandHandler("new", new_dialog_handle, filters=user_filter))
-    application.add_handler(CallbackQueryHandler(new_dialog_timeout_confirm_handle, pattern=constants.NewDialogButtonData.pattern()))
+    callback_query_router.add(constants.NewDialogButtonData, new_dialog_timeout_confirm_handle)
     application.add_handler(MessageHandler(filters.VOICE & user_filter, voice_message_handle))
     application.add_handler(CommandHandler("cancel", cancel_handle, filters=user_filter))
 
     # chat mode
     application.add_handler(CommandHandler("mode", show_chat_modes_handle, filters=user_filter))
-    application.add_handler(CallbackQueryHandler(show_chat_modes_callback_handle, pattern=constants.ChoosePageChatModesData.pattern()))
-    application.add_handler(CallbackQueryHandler(set_chat_mode_handle, pattern=constants.SetChatModeData.pattern()))
+    callback_query_router.add(constants.ChoosePageChatModesData, show_chat_modes_callback_handle)
+    callback_query_router.add(constants.SetChatModeData, set_chat_mode_handle)
 
     # settings
     application.add_handler(CommandHandler("settings", settings_handle, filters=user_filter))
-    application.add_handler(CallbackQueryHandler(set_settings_handle, pattern=constants.SettingsData.pattern()))
+    callback_query_router.add(constants.SettingsData, set_settings_handle)
 
     # payment
     application.add_handler(CommandHandler("balance", show_balance_handle, filters=user_filter))
-    application.add_handler(CallbackQueryHandler(speedup_message_queue_button_handle, pattern=constants.SpeedupMessageQueueButtonData.pattern()))
+    callback_query_router.add(constants.SpeedupMessageQueueButtonData, speedup_message_queue_button_handle)
 
-    application.add_handler(CallbackQueryHandler(show_payment_methods_handle, pattern=constants.ShowPaymentMethodsData.pattern()))
-    application.add_handler(CallbackQueryHandler(show_products_handle, pattern=constants.ShowProductsData.pattern()))
-    application.add_handler(CallbackQueryHandler(invite_friend_handle, pattern=constants.InviteFriendData.pattern()))
-    application.add_handler(CallbackQueryHandler(send_invoice_handle, pattern=constants.InvoiceData.pattern()))
+    callback_query_router.add(constants.ShowPaymentMethodsData, show_payment_methods_handle)
+    callback_query_router.add(constants.ShowProductsData, show_products_handle)
+    callback_query_router.add(constants.InviteFriendData, invite_friend_handle)
+    callback_query_router.add(constants.InvoiceData, send_invoice_handle)
 
     application.add_handler(PreCheckoutQueryHandler(pre_checkout_handle))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT & user_filter, successful_payment_handle))
 
     # admin
     application.add_handler(CommandHandler("add_tokens", add_tokens_handle, filters=admin_filter))
+    application.add_handler(CommandHandler("index_stats", index_stats_handle, filters=admin_filter))
+    application.add_handler(CommandHandler("perf", perf_handle, filters=admin_filter))
+    application.add_handler(CommandHandler("reload_config", reload_config_handle, filters=admin_filter))
     application.add_handler(CommandHandler("info", user_info_handle, filters=user_filter))
+
+    # callback queries of all handlers above
+    application.add_handler(callback_query_router.to_handler())
+
     application.add_error_handler(error_handle)
 
     # start the bot
-    application.run_polling()
+    if config.n_workers > 1:
+        # worker process, updates come from bot.workers.UpdateRouter
+        run_webhook(application, listen="127.0.0.1", port=get_worker_port(config.worker_index), set_webhook=False)
+    elif config.webhook_enabled:
+        run_webhook(application)
+    else:
+        application.run_polling()
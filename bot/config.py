@@ -1,8 +1,14 @@
+import os
+import re
 import yaml
+from typing import NamedTuple, Dict, Any
 import dotenv
 from pathlib import Path
 
 from bot.mixpanel_wrapper import MixpanelWrapper
+from bot.strings import compile_string_tables
+from bot.config_snapshot import compile_config_snapshot, ConfigSnapshot, ConfigError
+from bot.strings import StringTable
 
 
 config_dir = Path(__file__).parent.parent.resolve() / "config"
@@ -29,16 +35,60 @@ n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 7)
 check_not_expired_payments_update_time = config_yaml["check_not_expired_payments_update_time"]
 mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
 
+# database
+user_cache_max_size = config_yaml.get("user_cache_max_size", 10000)
+user_cache_ttl = config_yaml.get("user_cache_ttl", 60.0)
+dialog_storage = config_yaml.get("dialog_storage", "embedded")  # embedded, message_per_document
+max_n_dialog_messages_in_context = config_yaml.get("max_n_dialog_messages_in_context", 50)
+mongodb_profiler_slowms = config_yaml.get("mongodb_profiler_slowms", None)
+payment_id_block_size = config_yaml.get("payment_id_block_size", 1)
+user_activity_flush_interval = config_yaml.get("user_activity_flush_interval", 10.0)
+
+# webhook (if disabled, updates are received with long polling)
+webhook_enabled = config_yaml.get("webhook_enabled", False)
+webhook_listen = config_yaml.get("webhook_listen", "0.0.0.0")
+webhook_port = config_yaml.get("webhook_port", 8443)
+webhook_url_path = config_yaml.get("webhook_url_path", "/telegram")
+webhook_url = config_yaml.get("webhook_url", None)
+webhook_secret_token = config_yaml.get("webhook_secret_token", None)
+webhook_max_connections = config_yaml.get("webhook_max_connections", 40)
+webhook_max_pending_updates = config_yaml.get("webhook_max_pending_updates", 1000)
+if webhook_enabled and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", webhook_secret_token or ""):
+    # without it anyone who finds webhook url can post forged updates (e.g. admin commands)
+    raise ValueError("webhook_secret_token must be set to 1-256 characters of A-Z, a-z, 0-9, _ and - when webhook_enabled")
+
+# workers (n_workers > 1 runs several bot processes behind update router, requires webhook)
+n_workers = config_yaml.get("n_workers", 1)
+worker_index = int(os.environ.get("BOT_WORKER_INDEX", 0))  # set by bot.workers.run_workers
+user_lease_ttl = config_yaml.get("user_lease_ttl", 30.0)
+user_lease_renew_interval = config_yaml.get("user_lease_renew_interval", 2.0)
+if n_workers > 1:
+    user_tasks_dump_path = bot_data_dir / f"user_tasks_dump_{worker_index}.json"
+
+# metrics (served on metrics_listen:metrics_port/metrics, in multi-worker mode port of worker is metrics_port + worker_index)
+metrics_listen = config_yaml.get("metrics_listen", "127.0.0.1")
+metrics_port = config_yaml.get("metrics_port", None)
+
+# executors
+cpu_pool_max_workers = config_yaml.get("cpu_pool_max_workers", 2)
+io_pool_max_workers = config_yaml.get("io_pool_max_workers", 4)
+
+# streaming answers (pacing of placeholder message edits, see bot.handlers.streaming_edits)
+streaming_edit_min_interval = config_yaml.get("streaming_edit_min_interval", 0.6)
+streaming_edit_group_min_interval = config_yaml.get("streaming_edit_group_min_interval", 3.0)
+streaming_edit_max_interval = config_yaml.get("streaming_edit_max_interval", 5.0)
+streaming_edit_max_chars_per_second = config_yaml.get("streaming_edit_max_chars_per_second", 4000)
+
+# model clients
+llm_connection_limit = config_yaml.get("llm_connection_limit", 100)
+llm_keepalive_timeout = config_yaml.get("llm_keepalive_timeout", 60.0)
+
 # model apis
 model_apis = config_yaml["model_apis"]
 
 # files
 help_group_chat_video_path = Path(__file__).parent.parent.resolve() / "static" / "help_group_chat.mp4"
 
-# strings
-with open(config_dir / "strings.yml", 'r') as f:
-    strings = yaml.safe_load(f)
-
 # queue
 enable_message_queue = config_yaml["enable_message_queue"]
 if enable_message_queue:
@@ -65,18 +115,63 @@ bot_name = config_yaml["bot_name"]
 admin_chat_id = config_yaml["admin_chat_id"]
 admin_usernames = config_yaml["admin_usernames"]
 
-# chat_modes
-with open(config_dir / "chat_modes.yml", 'r') as f:
-    chat_modes = yaml.safe_load(f)
-
-# models
-with open(config_dir / "models.yml", 'r') as f:
-    models = yaml.safe_load(f)
-
 # payments
 payment_methods = config_yaml["payment_methods"]
 products = config_yaml["products"]
 
+
+# content: chat modes, models and strings (reloadable at runtime with /reload_config or SIGHUP)
+class Content(NamedTuple):
+    chat_modes: Dict[str, Any]  # raw YAML, bot code reads snapshot
+    models: Dict[str, Any]  # raw YAML, bot code reads snapshot
+    strings: Dict[str, Any]
+    string_tables: Dict[str, StringTable]
+    snapshot: ConfigSnapshot  # validated and precompiled models, chat modes and products
+
+
+def load_content() -> Content:
+    """Read and validate content configs. Blocking, raises ConfigError or ValueError on invalid config
+    """
+    with open(config_dir / "chat_modes.yml", 'r') as f:
+        _chat_modes = yaml.safe_load(f)
+    with open(config_dir / "models.yml", 'r') as f:
+        _models = yaml.safe_load(f)
+    with open(config_dir / "strings.yml", 'r') as f:
+        _strings = yaml.safe_load(f)
+
+    # all languages of strings.yml, because chat modes and models are shown in each of them
+    _string_tables = compile_string_tables(_strings, default_lang)
+
+    return Content(
+        chat_modes=_chat_modes,
+        models=_models,
+        strings=_strings,
+        string_tables=_string_tables,
+        snapshot=compile_config_snapshot(
+            _models, _chat_modes, products, payment_methods, model_apis, langs=sorted(_string_tables.keys())
+        ),
+    )
+
+
+def apply_content(content: Content) -> None:
+    """Swap content in one step. Removing chat modes or models is rejected, because users
+    may have them selected or have used tokens of them
+    """
+    global chat_modes, models, strings, string_tables, snapshot
+
+    removed_chat_modes = set(snapshot.chat_modes) - set(content.snapshot.chat_modes)
+    if removed_chat_modes:
+        raise ConfigError(f"chat_modes: can't remove {sorted(removed_chat_modes)} without restart")
+    removed_models = set(snapshot.models) - set(content.snapshot.models)
+    if removed_models:
+        raise ConfigError(f"models.info: can't remove {sorted(removed_models)} without restart")
+
+    chat_modes, models, strings, string_tables, snapshot = content
+
+
+# fails at startup on schema errors
+chat_modes, models, strings, string_tables, snapshot = load_content()
+
 # mixpanel
 mxp = MixpanelWrapper(token=config_yaml["mixpanel_project_token"])
 
@@ -0,0 +1,242 @@
+from typing import Optional, Any, Dict, Tuple, Mapping, Iterable
+from dataclasses import dataclass
+from types import MappingProxyType
+from pydoc import locate
+
+
+# 1 bot token costs as much as 1 input token of this model
+BASELINE_MODEL = "gpt-3.5-turbo"
+
+MODEL_TYPES = {"chat_completion", "image", "audio", "moderation"}
+CHAT_MODE_MODEL_TYPES = {"text", "image"}
+PARSE_MODES = {"html", "markdown"}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class ModelScore:
+    title: Mapping[str, str]
+    score: int
+
+
+@dataclass(frozen=True)
+class ModelInfo:
+    key: str
+    type: str
+    is_pro: bool
+    name: Optional[str] = None
+    description: Optional[Mapping[str, str]] = None
+    scores: Tuple[ModelScore, ...] = ()
+    context_size: Optional[int] = None  # None means prompt size is not checked before request
+
+    # precomputed prices in bot tokens
+    bot_tokens_per_input_token: float = 0.0
+    bot_tokens_per_output_token: float = 0.0
+    bot_tokens_per_image: float = 0.0
+    bot_tokens_per_second: float = 0.0
+
+
+@dataclass(frozen=True)
+class ChatModeInfo:
+    key: str
+    name: Mapping[str, str]
+    welcome_message: Mapping[str, str]
+    model_type: str
+    is_pro: bool
+    prompt_start: Optional[str] = None
+    parse_mode: str = "html"
+    type: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class ProductInfo:
+    key: str
+    n_tokens_to_add: int
+    price: float
+    currency: str
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    """Validated, immutable view of models, chat modes and products
+    """
+    models: Mapping[str, ModelInfo]
+    available_text_models: Tuple[str, ...]
+    chat_modes: Mapping[str, ChatModeInfo]
+    chat_mode_keys: Tuple[str, ...]
+    products: Mapping[str, ProductInfo]
+
+
+def _require(d: Dict[str, Any], key: str, path: str, types: Any = None) -> Any:
+    if not isinstance(d, dict) or key not in d:
+        raise ConfigError(f"{path}.{key} is missing")
+    value = d[key]
+    if types is not None and not isinstance(value, types):
+        raise ConfigError(f"{path}.{key} has wrong type {type(value).__name__}")
+    return value
+
+
+def _require_translations(d: Dict[str, Any], key: str, path: str, langs: Iterable[str]) -> Mapping[str, str]:
+    translations = _require(d, key, path, dict)
+    for lang in langs:
+        if not isinstance(translations.get(lang), str):
+            raise ConfigError(f"{path}.{key}.{lang} is missing")
+    return MappingProxyType(dict(translations))
+
+
+def _require_positive_number(d: Dict[str, Any], key: str, path: str) -> float:
+    value = _require(d, key, path, (int, float))
+    if value <= 0:
+        raise ConfigError(f"{path}.{key} must be positive")
+    return float(value)
+
+
+def _compile_context_size(d: Dict[str, Any], path: str) -> Optional[int]:
+    if d.get("context_size") is None:
+        return None
+    context_size = _require(d, "context_size", path, int)
+    if context_size <= 0:
+        raise ConfigError(f"{path}.context_size must be positive")
+    return context_size
+
+
+def _compile_model(key: str, d: Dict[str, Any], baseline_price_per_token: float, langs: Iterable[str]) -> ModelInfo:
+    path = f"models.info.{key}"
+    model_type = _require(d, "type", path, str)
+    if model_type not in MODEL_TYPES:
+        raise ConfigError(f"{path}.type must be one of {sorted(MODEL_TYPES)}")
+
+    kwargs = dict(key=key, type=model_type, is_pro=bool(d.get("is_pro", False)))
+    if model_type == "chat_completion":
+        scores = []
+        for i, score_dict in enumerate(_require(d, "scores", path, list)):
+            score = _require(score_dict, "score", f"{path}.scores.{i}", int)
+            if not 0 <= score <= 5:
+                raise ConfigError(f"{path}.scores.{i}.score must be in [0, 5]")
+            scores.append(ModelScore(title=_require_translations(score_dict, "title", f"{path}.scores.{i}", langs), score=score))
+
+        kwargs.update(
+            name=_require(d, "name", path, str),
+            description=_require_translations(d, "description", path, langs),
+            scores=tuple(scores),
+            context_size=_compile_context_size(d, path),
+            bot_tokens_per_input_token=_require_positive_number(d, "price_per_1000_input_tokens", path) / 1000 / baseline_price_per_token,
+            bot_tokens_per_output_token=_require_positive_number(d, "price_per_1000_output_tokens", path) / 1000 / baseline_price_per_token,
+        )
+    elif model_type == "image":
+        kwargs.update(bot_tokens_per_image=_require_positive_number(d, "price_per_1_image", path) / baseline_price_per_token)
+    elif model_type == "audio":
+        kwargs.update(bot_tokens_per_second=_require_positive_number(d, "price_per_1_min", path) / 60 / baseline_price_per_token)
+
+    # drop float noise (e.g. 50.00000000000001), so that whole prices convert exactly
+    for name in ["bot_tokens_per_input_token", "bot_tokens_per_output_token", "bot_tokens_per_image", "bot_tokens_per_second"]:
+        if name in kwargs:
+            kwargs[name] = round(kwargs[name], 9)
+
+    return ModelInfo(**kwargs)
+
+
+def _validate_model_api(key: str, model_type: str, model_apis: Dict[str, Any]) -> None:
+    path = f"model_apis.{key}"
+    model_api = _require(model_apis, key, "model_apis", dict)
+    if model_type != "chat_completion":
+        _require(model_api, "openai_api_key", path, str)
+        return
+
+    _require(model_api, "default", path, dict)
+    for api_type in ["default", "fallback"]:
+        if api_type not in model_api:
+            continue
+        class_path = _require(model_api[api_type], "class", f"{path}.{api_type}", str)
+        _require(model_api[api_type], "kwargs", f"{path}.{api_type}", dict)
+        if locate(class_path) is None:
+            raise ConfigError(f"{path}.{api_type}.class: can't import {class_path}")
+
+
+def _compile_chat_mode(key: str, d: Dict[str, Any], langs: Iterable[str]) -> ChatModeInfo:
+    path = f"chat_modes.{key}"
+    model_type = _require(d, "model_type", path, str)
+    if model_type not in CHAT_MODE_MODEL_TYPES:
+        raise ConfigError(f"{path}.model_type must be one of {sorted(CHAT_MODE_MODEL_TYPES)}")
+
+    prompt_start = d.get("prompt_start")
+    if model_type == "text" and d.get("type") is None and not isinstance(prompt_start, str):
+        raise ConfigError(f"{path}.prompt_start is missing")
+
+    parse_mode = d.get("parse_mode", "html")
+    if parse_mode not in PARSE_MODES:
+        raise ConfigError(f"{path}.parse_mode must be one of {sorted(PARSE_MODES)}")
+
+    return ChatModeInfo(
+        key=key,
+        name=_require_translations(d, "name", path, langs),
+        welcome_message=_require_translations(d, "welcome_message", path, langs),
+        model_type=model_type,
+        is_pro=bool(d.get("is_pro", False)),
+        prompt_start=prompt_start,
+        parse_mode=parse_mode,
+        type=d.get("type"),
+    )
+
+
+def _compile_product(key: str, d: Dict[str, Any]) -> ProductInfo:
+    path = f"products.{key}"
+    return ProductInfo(
+        key=key,
+        n_tokens_to_add=_require(d, "n_tokens_to_add", path, int),
+        price=_require_positive_number(d, "price", path),
+        currency=_require(d, "currency", path, str),
+    )
+
+
+def compile_config_snapshot(
+    models: Dict[str, Any],
+    chat_modes: Dict[str, Any],
+    products: Dict[str, Any],
+    payment_methods: Dict[str, Any],
+    model_apis: Dict[str, Any],
+    langs: Iterable[str],
+) -> ConfigSnapshot:
+    """Validate raw YAML configs and compile them into ConfigSnapshot. Translations are required
+    for all langs, every model must have its api in model_apis. Raises ConfigError
+    """
+    langs = list(langs)
+
+    models_info = _require(models, "info", "models", dict)
+    baseline_model_dict = _require(models_info, BASELINE_MODEL, "models.info", dict)
+    baseline_price_per_token = _require_positive_number(baseline_model_dict, "price_per_1000_input_tokens", f"models.info.{BASELINE_MODEL}") / 1000
+
+    compiled_models = {
+        key: _compile_model(key, model_dict, baseline_price_per_token, langs)
+        for key, model_dict in models_info.items()
+    }
+    for key, model_info in compiled_models.items():
+        _validate_model_api(key, model_info.type, model_apis)
+
+    available_text_models = tuple(_require(models, "available_text_models", "models", list))
+    if len(available_text_models) == 0:
+        raise ConfigError("models.available_text_models is empty")
+    for model_key in available_text_models:
+        if model_key not in compiled_models or compiled_models[model_key].type != "chat_completion":
+            raise ConfigError(f"models.available_text_models: {model_key} is not a chat_completion model")
+
+    if len(chat_modes) == 0:
+        raise ConfigError("chat_modes is empty")
+    compiled_chat_modes = {key: _compile_chat_mode(key, chat_mode_dict, langs) for key, chat_mode_dict in chat_modes.items()}
+
+    compiled_products = {key: _compile_product(key, product_dict) for key, product_dict in products.items()}
+    for payment_method_key, payment_method_dict in payment_methods.items():
+        for product_key in payment_method_dict.get("product_keys", []):
+            if product_key not in compiled_products:
+                raise ConfigError(f"payment_methods.{payment_method_key}.product_keys: unknown product {product_key}")
+
+    return ConfigSnapshot(
+        models=MappingProxyType(compiled_models),
+        available_text_models=available_text_models,
+        chat_modes=MappingProxyType(compiled_chat_modes),
+        chat_mode_keys=tuple(compiled_chat_modes.keys()),
+        products=MappingProxyType(compiled_products),
+    )
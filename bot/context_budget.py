@@ -0,0 +1,94 @@
+from typing import Optional, Dict, List, Any
+
+import logging
+
+import tiktoken
+
+from bot import config
+
+
+logger = logging.getLogger(__name__)
+
+
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+# upper bound over model versions: every message is wrapped into <|start|>{role}\n{content}<|end|>\n
+N_TOKENS_PER_MESSAGE = 4
+N_TOKENS_PER_REPLY = 3  # every reply is primed with <|start|>assistant<|message|>
+
+# reserved for reply, if max_tokens isn't set in model api kwargs
+DEFAULT_N_REPLY_TOKENS = 1000
+
+# local count may differ from API one (e.g. after model update), keep some room
+SAFETY_MARGIN = 32
+
+_encodings: Dict[str, tiktoken.Encoding] = {}
+
+
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Blocking on first call for each model: tiktoken loads BPE ranks (and may download them)
+    """
+    encoding = _encodings.get(model)
+    if encoding is None:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        _encodings[model] = encoding
+    return encoding
+
+
+def load_encodings() -> None:
+    for model_key in config.snapshot.available_text_models:
+        get_encoding(model_key)
+
+
+def count_text_tokens(encoding: tiktoken.Encoding, text: str) -> int:
+    # user text may contain special tokens like <|endoftext|>, count them as plain text
+    return N_TOKENS_PER_MESSAGE + len(encoding.encode(text, disallowed_special=()))
+
+
+def get_n_reply_tokens(model: str) -> int:
+    # model may be served by several apis (default and fallback), reserve for the largest reply
+    n_reply_tokens = [
+        model_api["kwargs"].get("max_tokens")
+        for model_api in config.model_apis[model].values()
+    ]
+    n_reply_tokens = [n for n in n_reply_tokens if n is not None]
+    return max(n_reply_tokens) if len(n_reply_tokens) > 0 else DEFAULT_N_REPLY_TOKENS
+
+
+def get_n_first_dialog_messages_to_remove(
+    model: str,
+    prompt: str,
+    dialog_messages: List[Dict[str, Any]],
+    message: str,
+) -> int:
+    """Find the longest suffix of dialog_messages, which fits into model context together
+    with prompt, new message and reply. Return number of messages before it.
+
+    Messages are counted once from the end. If even prompt with new message doesn't fit,
+    all dialog messages are removed and API reports the error
+    """
+    context_size: Optional[int] = config.snapshot.models[model].context_size
+    if context_size is None or len(dialog_messages) == 0:
+        return 0
+
+    encoding = get_encoding(model)
+    n_available_tokens = (
+        context_size
+        - get_n_reply_tokens(model)
+        - N_TOKENS_PER_REPLY
+        - SAFETY_MARGIN
+        - count_text_tokens(encoding, prompt)
+        - count_text_tokens(encoding, message)
+    )
+
+    n_kept = 0
+    for dialog_message in reversed(dialog_messages):
+        n_available_tokens -= count_text_tokens(encoding, dialog_message["user"])
+        n_available_tokens -= count_text_tokens(encoding, dialog_message["bot"])
+        if n_available_tokens < 0:
+            break
+        n_kept += 1
+
+    return len(dialog_messages) - n_kept
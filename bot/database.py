@@ -1,27 +1,419 @@
-from typing import Optional, Any
+from typing import Optional, Any, Dict, Tuple, List, Callable, Awaitable
 
+import asyncio
+import logging
 import pymongo
+from pymongo import ReturnDocument, IndexModel, UpdateOne
+import motor.motor_asyncio
 import uuid
+import copy
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
 from bot import config
+from bot.metrics import InstrumentedDatabase
 
 
+logger = logging.getLogger(__name__)
+
 ChatId = UserId = int
 
 
+# low-value fields written on every message, they are buffered and flushed periodically
+USER_ACTIVITY_KEYS = {"last_interaction", "last_message_ts", "last_message_text"}
+
+# changed on behalf of user by other processes (payment job runs in worker 0, /add_tokens in admin's worker),
+# so in multi-worker mode they are always read from DB, not from per-process user cache
+SHARED_USER_KEYS = {"token_balance", "invites"}
+
+# indexes for all collections, applied idempotently by Database.ensure_indexes()
+INDEX_SPEC: Dict[str, List[IndexModel]] = {
+    "user": [
+        IndexModel([("username", pymongo.ASCENDING)], name="username"),  # add_tokens_handle
+        IndexModel([("first_seen", pymongo.DESCENDING)], name="first_seen"),  # analytics
+    ],
+    "dialog": [
+        IndexModel([("user_id", pymongo.ASCENDING), ("start_time", pymongo.DESCENDING)], name="user_id_start_time"),
+    ],
+    "dialog_message": [
+        IndexModel([("dialog_id", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)], name="dialog_id_seq", unique=True),
+    ],
+    "payment": [
+        IndexModel([("user_id", pymongo.ASCENDING), ("status", pymongo.ASCENDING)], name="user_id_status"),  # does_user_have_successful_payment
+        IndexModel([("expired_at", pymongo.ASCENDING), ("status", pymongo.ASCENDING)], name="expired_at_status"),  # get_all_not_expried_payment_dicts
+    ],
+    "newsletter_delivery": [
+        IndexModel([("newsletter_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)], name="newsletter_id_user_id", unique=True),
+    ],
+    "user_lease": [
+        IndexModel([("owner", pymongo.ASCENDING)], name="owner"),  # renew_user_leases
+        IndexModel([("expires_at", pymongo.ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),  # removes abandoned leases
+    ],
+}
+
+
+class UserCache:
+    """In-process LRU cache of user documents with TTL.
+
+    Writes done through Database patch cached documents in place (write-through),
+    TTL bounds staleness of writes made by other processes
+    """
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._items: "OrderedDict[UserId, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+
+        # statistics
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, user_id: UserId) -> Optional[Dict[str, Any]]:
+        item = self._items.get(user_id)
+        if item is None:
+            self.n_misses += 1
+            return None
+
+        expires_at, user_dict = item
+        if time.monotonic() > expires_at:
+            del self._items[user_id]
+            self.n_misses += 1
+            return None
+
+        self._items.move_to_end(user_id)
+        self.n_hits += 1
+        return user_dict
+
+    def put(self, user_id: UserId, user_dict: Dict[str, Any]) -> None:
+        self._items[user_id] = (time.monotonic() + self.ttl, user_dict)
+        self._items.move_to_end(user_id)
+
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def update(self, user_id: UserId, values: Dict[str, Any]) -> None:
+        # only patch documents that are already cached, expiration time is kept
+        item = self._items.get(user_id)
+        if item is not None:
+            item[1].update(copy.deepcopy(values))
+
+    def invalidate(self, user_id: UserId) -> None:
+        self._items.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        n_requests = self.n_hits + self.n_misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "n_hits": self.n_hits,
+            "n_misses": self.n_misses,
+            "hit_rate": self.n_hits / n_requests if n_requests > 0 else 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SequenceAllocator:
+    """Allocates unique increasing ids from a counter document: {"_id": name, "value": last_allocated_id}.
+    With block_size > 1 a whole block of ids is reserved in one round trip and handed out locally
+    (ids from unused part of a block are skipped after restart)
+    """
+    def __init__(
+        self,
+        counter_collection,
+        name: str,
+        block_size: int = 1,
+        get_initial_value: Optional[Callable[[], Awaitable[int]]] = None,
+    ):
+        if block_size < 1:
+            raise ValueError(f"block_size must be >= 1, got {block_size}")
+
+        self.counter_collection = counter_collection
+        self.name = name
+        self.block_size = block_size
+        self.get_initial_value = get_initial_value
+
+        self._next_value = 0
+        self._end_value = 0  # exclusive
+        self._is_seeded = get_initial_value is None
+        self._lock = asyncio.Lock()
+
+    async def seed(self) -> None:
+        # counter must start after ids which were allocated before the counter existed.
+        # $max makes this idempotent and safe to run from several processes
+        initial_value = await self.get_initial_value()
+        await self.counter_collection.update_one(
+            {"_id": self.name},
+            {"$max": {"value": initial_value}},
+            upsert=True,
+        )
+        self._is_seeded = True
+
+    async def _reserve_block(self) -> None:
+        if not self._is_seeded:
+            await self.seed()
+
+        counter_dict = await self.counter_collection.find_one_and_update(
+            {"_id": self.name},
+            {"$inc": {"value": self.block_size}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._end_value = counter_dict["value"] + 1
+        self._next_value = self._end_value - self.block_size
+
+    async def allocate(self) -> int:
+        async with self._lock:
+            if self._next_value >= self._end_value:
+                await self._reserve_block()
+
+            value = self._next_value
+            self._next_value += 1
+            return value
+
+
+class EmbeddedDialogStorage:
+    """All messages of a dialog are stored in `messages` array of the dialog document
+    """
+    def __init__(self, db):
+        self.dialog_collection = db["dialog"]
+
+    async def get_messages(self, dialog_id: str, user_id: int) -> list:
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        return dialog_dict["messages"]
+
+    async def get_last_messages(self, dialog_id: str, user_id: int, n: int) -> list:
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id},
+            projection={"messages": {"$slice": -n}}
+        )
+        return dialog_dict["messages"]
+
+    async def count_messages(self, dialog_id: str, user_id: int) -> int:
+        dialog_dicts = await self.dialog_collection.aggregate([
+            {"$match": {"_id": dialog_id, "user_id": user_id}},
+            {"$project": {"n_messages": {"$size": "$messages"}}},
+        ]).to_list(length=None)
+        return dialog_dicts[0]["n_messages"] if len(dialog_dicts) > 0 else 0
+
+    async def set_messages(self, dialog_id: str, user_id: int, messages: list):
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {"messages": messages}}
+        )
+
+    async def append_message(self, dialog_id: str, user_id: int, message: dict):
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$push": {"messages": message}}
+        )
+
+    async def pop_last_message(self, dialog_id: str, user_id: int) -> Optional[dict]:
+        dialog_dict = await self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$pop": {"messages": 1}},
+            projection={"messages": {"$slice": -1}},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if dialog_dict is None or len(dialog_dict["messages"]) == 0:
+            return None
+
+        return dialog_dict["messages"][0]
+
+
+class MessagePerDocumentDialogStorage:
+    """Each message is a separate document in `dialog_message` collection keyed by (dialog_id, seq).
+    Dialog document keeps metadata and `n_messages` counter used to allocate seq
+    """
+    def __init__(self, db):
+        self.dialog_collection = db["dialog"]
+        self.dialog_message_collection = db["dialog_message"]
+
+    async def get_messages(self, dialog_id: str, user_id: int) -> list:
+        cursor = self.dialog_message_collection.find(
+            {"dialog_id": dialog_id, "user_id": user_id},
+            projection={"_id": 0, "message": 1},
+            sort=[("seq", pymongo.ASCENDING)],
+        )
+        return [x["message"] async for x in cursor]
+
+    async def get_last_messages(self, dialog_id: str, user_id: int, n: int) -> list:
+        cursor = self.dialog_message_collection.find(
+            {"dialog_id": dialog_id, "user_id": user_id},
+            projection={"_id": 0, "message": 1},
+            sort=[("seq", pymongo.DESCENDING)],
+            limit=n,
+        )
+        messages = [x["message"] async for x in cursor]
+        return messages[::-1]
+
+    async def count_messages(self, dialog_id: str, user_id: int) -> int:
+        # n_messages of dialog document isn't used: it's seq counter, and popped messages leave gaps
+        return await self.dialog_message_collection.count_documents({"dialog_id": dialog_id, "user_id": user_id})
+
+    async def set_messages(self, dialog_id: str, user_id: int, messages: list):
+        await self.dialog_message_collection.delete_many({"dialog_id": dialog_id, "user_id": user_id})
+        if len(messages) > 0:
+            await self.dialog_message_collection.insert_many([
+                self.build_message_dict(dialog_id, user_id, seq, message)
+                for seq, message in enumerate(messages)
+            ])
+
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {"n_messages": len(messages)}}
+        )
+
+    async def append_message(self, dialog_id: str, user_id: int, message: dict):
+        dialog_dict = await self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$inc": {"n_messages": 1}},
+            projection={"n_messages": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if dialog_dict is None:
+            raise ValueError(f"Dialog {dialog_id} does not exist")
+
+        seq = dialog_dict["n_messages"] - 1
+        await self.dialog_message_collection.insert_one(
+            self.build_message_dict(dialog_id, user_id, seq, message)
+        )
+
+    async def pop_last_message(self, dialog_id: str, user_id: int) -> Optional[dict]:
+        # seq counter is not decremented, gaps in seq are fine
+        message_dict = await self.dialog_message_collection.find_one_and_delete(
+            {"dialog_id": dialog_id, "user_id": user_id},
+            projection={"_id": 0, "message": 1},
+            sort=[("seq", pymongo.DESCENDING)],
+        )
+        if message_dict is None:
+            return None
+
+        return message_dict["message"]
+
+    @staticmethod
+    def build_message_dict(dialog_id: str, user_id: int, seq: int, message: dict) -> Dict[str, Any]:
+        return {
+            "dialog_id": dialog_id,
+            "user_id": user_id,
+            "seq": seq,
+            "message": message,
+        }
+
+
 class Database:
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
-        self.db = self.client["chatgpt_telegram_bot"]
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(config.mongodb_uri)
+        self.db = InstrumentedDatabase(self.client["chatgpt_telegram_bot"])  # counts round trips for bot.metrics
 
         self.user_collection = self.db["user"]
         self.dialog_collection = self.db["dialog"]
         self.payment_collection = self.db["payment"]
         self.newsletter_collection = self.db["newsletter"]
+        self.counter_collection = self.db["counter"]
+        self.newsletter_delivery_collection = self.db["newsletter_delivery"]
+        self.user_lease_collection = self.db["user_lease"]
+
+        self.payment_id_allocator = SequenceAllocator(
+            self.counter_collection,
+            "payment_id",
+            block_size=config.payment_id_block_size,
+            get_initial_value=self._get_max_payment_id,
+        )
+
+        self.user_cache = UserCache(
+            max_size=config.user_cache_max_size,
+            ttl=config.user_cache_ttl,
+        )
+
+        self.uncached_user_keys = SHARED_USER_KEYS if config.n_workers > 1 else set()
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        # write-behind buffer: {user_id: {key: value}} for USER_ACTIVITY_KEYS
+        self._user_write_buffer: Dict[UserId, Dict[str, Any]] = {}
+
+        if config.dialog_storage == "embedded":
+            self.dialog_storage = EmbeddedDialogStorage(self.db)
+        elif config.dialog_storage == "message_per_document":
+            self.dialog_storage = MessagePerDocumentDialogStorage(self.db)
+        else:
+            raise ValueError(f"Unknown dialog_storage: {config.dialog_storage}")
+
+    async def setup(self):
+        await self.ensure_indexes()
+        await self.payment_id_allocator.seed()
+
+        if config.mongodb_profiler_slowms is not None:
+            # profiler collects slow queries shown in index report
+            await self.db.command("profile", 1, slowms=config.mongodb_profiler_slowms)
+
+    async def ensure_indexes(self):
+        for collection_name, index_models in INDEX_SPEC.items():
+            try:
+                await self.db[collection_name].create_indexes(index_models)
+            except pymongo.errors.OperationFailure as e:
+                # e.g. index with the same name but different options already exists
+                logger.error(f"Failed to create indexes for collection {collection_name}. Reason: {e}")
+
+    async def get_index_report(self, n_slow_queries: int = 10) -> Dict[str, Any]:
+        """Index usage ($indexStats), missing indexes from INDEX_SPEC and
+        recent slow queries without index (if profiler is enabled)
+        """
+        report = {"collections": {}, "profiler_level": None, "slow_queries": []}
+
+        for collection_name, index_models in INDEX_SPEC.items():
+            index_stats = await self.db[collection_name].aggregate([{"$indexStats": {}}]).to_list(length=None)
+            existing_index_names = {x["name"] for x in index_stats}
+            report["collections"][collection_name] = {
+                "indexes": [
+                    {"name": x["name"], "n_ops": x["accesses"]["ops"], "since": x["accesses"]["since"]}
+                    for x in sorted(index_stats, key=lambda x: x["name"])
+                ],
+                "missing_indexes": [
+                    x.document["name"] for x in index_models
+                    if x.document["name"] not in existing_index_names
+                ],
+            }
+
+        profile_status = await self.db.command("profile", -1)
+        report["profiler_level"] = profile_status["was"]
+        if report["profiler_level"] > 0:
+            cursor = self.db["system.profile"].find(
+                {"planSummary": "COLLSCAN"},
+                projection={"ns": 1, "op": 1, "millis": 1, "ts": 1, "command": 1},
+                sort=[("ts", pymongo.DESCENDING)],
+                limit=n_slow_queries,
+            )
+            report["slow_queries"] = [
+                {
+                    "ns": x.get("ns"),
+                    "op": x.get("op"),
+                    "millis": x.get("millis"),
+                    "ts": x.get("ts"),
+                    "filter": x.get("command", {}).get("filter", x.get("command", {}).get("q")),
+                }
+                async for x in cursor
+            ]
+
+        return report
+
+    async def _get_user_dict(self, user_id: int) -> Optional[Dict[str, Any]]:
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is None:
+            user_dict = await self.user_collection.find_one({"_id": user_id})
+            if user_dict is not None:
+                # not yet flushed activity fields are newer than DB values
+                user_dict.update(self._user_write_buffer.get(user_id, {}))
+                self.user_cache.put(user_id, user_dict)
+
+        return user_dict
+
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        if await self._get_user_dict(user_id) is not None:
             return True
         else:
             if raise_exception:
@@ -29,8 +421,8 @@ class Database:
             else:
                 return False
 
-    def check_if_payment_exists(self, payment_id: int, raise_exception: bool = False):
-        if self.payment_collection.count_documents({"_id": payment_id}) > 0:
+    async def check_if_payment_exists(self, payment_id: int, raise_exception: bool = False):
+        if await self.payment_collection.count_documents({"_id": payment_id}) > 0:
             return True
         else:
             if raise_exception:
@@ -38,8 +430,8 @@ class Database:
             else:
                 return False
 
-    def check_if_newsletter_exists(self, newsletter_id: str, raise_exception: bool = False):
-        if self.newsletter_collection.count_documents({"_id": newsletter_id}) > 0:
+    async def check_if_newsletter_exists(self, newsletter_id: str, raise_exception: bool = False):
+        if await self.newsletter_collection.count_documents({"_id": newsletter_id}) > 0:
             return True
         else:
             if raise_exception:
@@ -47,16 +439,16 @@ class Database:
             else:
                 return False
 
-    def add_new_user(
-        self,
+    @staticmethod
+    def _get_new_user_dict(
         user_id: int,
         chat_id: int,
         initial_token_balance: int = 5000,
         username: str = "",
         first_name: str = "",
         last_name: str = "",
-    ):
-        user_dict = {
+    ) -> Dict[str, Any]:
+        return {
             "_id": user_id,
             "chat_id": chat_id,
 
@@ -69,7 +461,7 @@ class Database:
 
             "current_dialog_id": None,
             "current_chat_mode": "assistant",
-            "current_model": config.models["available_text_models"][0],
+            "current_model": config.snapshot.available_text_models[0],
 
             "n_used_tokens": {},
             "n_generated_images": 0,
@@ -81,112 +473,415 @@ class Database:
             "invites": []
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+    async def add_new_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        initial_token_balance: int = 5000,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ):
+        user_dict = self._get_new_user_dict(
+            user_id,
+            chat_id,
+            initial_token_balance=initial_token_balance,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+        )
 
-    def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        if not await self.check_if_user_exists(user_id):
+            await self.user_collection.insert_one(user_dict)
+            self.user_cache.put(user_id, copy.deepcopy(user_dict))
 
-        dialog_id = str(uuid.uuid4())
+    async def upsert_and_touch_user(
+        self,
+        user_id: int,
+        chat_id: int,
+        initial_token_balance: int = 5000,
+        username: str = "",
+        first_name: str = "",
+        last_name: str = "",
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Create user if needed, update last_interaction and backfill missing fields.
+        Takes 1 round trip for existing users.
+
+        Returns fresh user dict and whether user was just created
+        """
+        now = datetime.now()
+
+        new_user_dict = self._get_new_user_dict(
+            user_id,
+            chat_id,
+            initial_token_balance=initial_token_balance,
+            username=username,
+            first_name=first_name,
+            last_name=last_name,
+        )
+        new_user_dict.pop("_id")
+        new_user_dict.pop("last_interaction")
+        new_user_dict["first_seen"] = now
+        new_user_dict["current_dialog_id"] = str(uuid.uuid4())
+
+        # fast path: cached user which doesn't need backfill is only touched in write-behind buffer
+        cached_user_dict = self.user_cache.get(user_id)
+        if (
+            cached_user_dict is not None and
+            cached_user_dict.get("current_dialog_id") is not None and
+            len(self._get_user_backfill_dict(cached_user_dict, new_user_dict)) == 0
+        ):
+            await self.set_user_activity_attribute(user_id, "last_interaction", now)
+            return copy.deepcopy(cached_user_dict), False
+
+        set_dict = {"last_interaction": now}
+        self._pop_user_write_buffer(user_id, "last_interaction")
+
+        # return document before update to find out whether it was inserted,
+        # fresh document is then reconstructed locally
+        prev_user_dict = await self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$setOnInsert": new_user_dict, "$set": set_dict},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+
+        is_new_user = prev_user_dict is None
+        if is_new_user:
+            user_dict = {"_id": user_id, **new_user_dict, **set_dict}
+            await self._insert_new_dialog(
+                user_dict["current_dialog_id"],
+                user_id,
+                chat_mode=user_dict["current_chat_mode"],
+                model=user_dict["current_model"],
+            )
+        else:
+            user_dict = {**prev_user_dict, **self._user_write_buffer.get(user_id, {}), **set_dict}
+
+            backfill_dict = self._get_user_backfill_dict(user_dict, new_user_dict)
+            if len(backfill_dict) > 0:
+                await self.user_collection.update_one({"_id": user_id}, {"$set": backfill_dict})
+                user_dict.update(backfill_dict)
+
+        self.user_cache.put(user_id, copy.deepcopy(user_dict))
+
+        if user_dict.get("current_dialog_id") is None:
+            user_dict["current_dialog_id"] = await self.start_new_dialog(user_id)
+
+        return user_dict, is_new_user
+
+    @staticmethod
+    def _get_user_backfill_dict(user_dict: Dict[str, Any], new_user_dict: Dict[str, Any]) -> Dict[str, Any]:
+        # back compatibility for documents created by older versions
+        backfill_dict = {}
+        for key in ["token_balance", "current_model", "n_generated_images", "n_transcribed_seconds", "lang", "invites"]:
+            if user_dict.get(key) is None:
+                backfill_dict[key] = new_user_dict[key]
+
+        if isinstance(user_dict.get("n_used_tokens"), int):  # old format
+            backfill_dict["n_used_tokens"] = {
+                "gpt-3.5-turbo": {
+                    "n_input_tokens": 0,
+                    "n_output_tokens": user_dict["n_used_tokens"]
+                }
+            }
+
+        # make balance always non-negative
+        if user_dict.get("token_balance") is not None and user_dict["token_balance"] < 0:
+            backfill_dict["token_balance"] = 0
+
+        return backfill_dict
+
+    async def _insert_new_dialog(self, dialog_id: str, user_id: int, chat_mode: str, model: str):
         dialog_dict = {
             "_id": dialog_id,
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": chat_mode,
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
+            "model": model,
             "messages": []
         }
+        await self.dialog_collection.insert_one(dialog_dict)
+
+    async def start_new_dialog(self, user_id: int):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        dialog_id = str(uuid.uuid4())
+        await self._insert_new_dialog(
+            dialog_id,
+            user_id,
+            chat_mode=await self.get_user_attribute(user_id, "current_chat_mode"),
+            model=await self.get_user_attribute(user_id, "current_model"),
+        )
 
         # update user's current dialog
-        self.user_collection.update_one(
+        await self.user_collection.update_one(
             {"_id": user_id},
             {"$set": {"current_dialog_id": dialog_id}}
         )
+        self.user_cache.update(user_id, {"current_dialog_id": dialog_id})
 
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    async def get_user_attribute(self, user_id: int, key: str):
+        if key in self.uncached_user_keys:
+            return (await self.get_user_attributes(user_id, [key]))[key]
+
+        user_dict = await self._get_user_dict(user_id)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
         if key not in user_dict:
             return None
 
-        return user_dict[key]
+        # copy so that callers can't mutate cached document
+        return copy.deepcopy(user_dict[key])
+
+    async def get_user_attributes(self, user_id: int, keys: List[str]) -> Dict[str, Any]:
+        """Read several attributes at once. Missing attributes are None.
+        Served from cache if user document is cached, otherwise with one projected read
+        """
+        user_dict = self.user_cache.get(user_id)
+        if user_dict is not None and not self.uncached_user_keys.isdisjoint(keys):
+            user_dict = None
+        if user_dict is None:
+            # partial document is not put into cache
+            user_dict = await self.user_collection.find_one({"_id": user_id}, projection={key: 1 for key in keys})
+            if user_dict is None:
+                raise ValueError(f"User {user_id} does not exist")
+            user_dict.update(self._user_write_buffer.get(user_id, {}))
+
+        return {key: copy.deepcopy(user_dict.get(key)) for key in keys}
 
-    def get_chat_id(self, user_id: UserId):
-        return self.get_user_attribute(user_id, "chat_id")
+    async def get_chat_id(self, user_id: UserId):
+        return await self.get_user_attribute(user_id, "chat_id")
 
-    def get_user_lang(self, user_id: int):
+    async def get_user_lang(self, user_id: int):
         try:
-            lang = self.get_user_attribute(user_id, "lang")
+            lang = await self.get_user_attribute(user_id, "lang")
         except:
             lang = "en"
 
         return lang
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        self._pop_user_write_buffer(user_id, key)  # so that older buffered value doesn't overwrite this one
+        await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+        self.user_cache.update(user_id, {key: value})
+
+    async def set_user_activity_attribute(self, user_id: int, key: str, value: Any):
+        """Write-behind version of set_user_attribute for low-value activity fields.
+        Value is visible to reads immediately and is written to DB by flush_user_write_buffer()
+        """
+        if key not in USER_ACTIVITY_KEYS:
+            raise ValueError(f"{key} is not a user activity attribute")
+
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        self._user_write_buffer.setdefault(user_id, {})[key] = value
+        self.user_cache.update(user_id, {key: value})
+
+    def _pop_user_write_buffer(self, user_id: int, key: str) -> Optional[Tuple[Any]]:
+        # returns (value,) if key was buffered
+        if key not in self._user_write_buffer.get(user_id, {}):
+            return None
+
+        value = self._user_write_buffer[user_id].pop(key)
+        if len(self._user_write_buffer[user_id]) == 0:
+            del self._user_write_buffer[user_id]
+
+        return (value,)
+
+    async def flush_user_write_buffer(self) -> int:
+        """Write all buffered values with one bulk_write. Returns number of flushed users
+        """
+        if len(self._user_write_buffer) == 0:
+            return 0
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+        buffer, self._user_write_buffer = self._user_write_buffer, {}
+        try:
+            await self.user_collection.bulk_write([
+                UpdateOne({"_id": user_id}, {"$set": values})
+                for user_id, values in buffer.items()
+            ], ordered=False)
+        except Exception:
+            # put values back unless they were overwritten while flushing
+            for user_id, values in buffer.items():
+                self._user_write_buffer[user_id] = {**values, **self._user_write_buffer.get(user_id, {})}
+            raise
+
+        return len(buffer)
+
+    def get_user_write_buffer_statistics(self) -> Dict[str, Any]:
+        return {
+            "n_users": len(self._user_write_buffer),
+            "n_values": sum(len(values) for values in self._user_write_buffer.values()),
+        }
+
+    async def _update_user_and_fetch(self, user_id: int, update: Any, keys: list) -> Dict[str, Any]:
+        # single atomic update, returns new values of given keys
+        user_dict = await self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            update,
+            projection={key: 1 for key in keys},
+            return_document=ReturnDocument.AFTER,
+        )
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
+        user_dict.pop("_id")
+        self.user_cache.update(user_id, user_dict)
+        return user_dict
+
+    async def add_user_invite(self, user_id: int, invited_user_id: int, max_invites: int) -> bool:
+        """Atomically add invited user if they are not invited yet and limit is not reached.
+        Returns True if invite was added
+        """
+        if max_invites <= 0:
+            return False
+
+        user_dict = await self.user_collection.find_one_and_update(
+            {"_id": user_id, "invites": {"$ne": invited_user_id}, f"invites.{max_invites - 1}": {"$exists": False}},
+            {"$push": {"invites": invited_user_id}},
+            projection={"invites": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if user_dict is None:
+            return False
+
+        self.user_cache.update(user_id, {"invites": user_dict["invites"]})
+        return True
+
+    async def increment_balance(self, user_id: int, delta: int, floor: Optional[int] = 0) -> int:
+        """Atomically add delta to token_balance (clipped from below by floor if it's not None).
+        Returns new balance
+        """
+        if floor is None:
+            update = {"$inc": {"token_balance": delta}}
         else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+            update = [{"$set": {
+                "token_balance": {"$max": [floor, {"$add": [{"$ifNull": ["$token_balance", 0]}, delta]}]}
+            }}]
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+        user_dict = await self._update_user_and_fetch(user_id, update, ["token_balance"])
+        return user_dict["token_balance"]
+
+    async def increment_user_attribute(self, user_id: int, key: str, delta: Any) -> Any:
+        """Atomically add delta to numeric user attribute. Returns new value
+        """
+        user_dict = await self._update_user_and_fetch(user_id, {"$inc": {key: delta}}, [key])
+        return user_dict[key]
+
+    async def add_token_usage(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int) -> Dict[str, int]:
+        """Atomically add used tokens to n_used_tokens[model].
+        Returns new {"n_input_tokens": ..., "n_output_tokens": ...} for this model
+        """
+        # model names contain dots (e.g. gpt-3.5-turbo), so dotted $inc paths can't be used here
+        model_field = {"$literal": model}
+        model_n_used_tokens = {"$getField": {"field": model_field, "input": "$n_used_tokens"}}
+
+        def _add(key: str, n: int):
+            return {"$add": [{"$ifNull": [{"$getField": {"field": key, "input": model_n_used_tokens}}, 0]}, n]}
+
+        update = [{"$set": {
+            "n_used_tokens": {"$setField": {
+                "field": model_field,
+                "input": {"$ifNull": ["$n_used_tokens", {}]},
+                "value": {
+                    "n_input_tokens": _add("n_input_tokens", n_input_tokens),
+                    "n_output_tokens": _add("n_output_tokens", n_output_tokens),
+                }
+            }}
+        }}]
+
+        user_dict = await self._update_user_and_fetch(user_id, update, ["n_used_tokens"])
+        return user_dict["n_used_tokens"][model]
+
+    async def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
+        await self.add_token_usage(user_id, model, n_input_tokens, n_output_tokens)
+
+    async def check_if_user_attribute_exists(self, user_id: int, key: str):
+        user_dict = await self._get_user_dict(user_id)
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
-    def check_if_user_attribute_exists(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
         return key in user_dict
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def _get_dialog_id(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[str]:
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
-            if dialog_id is None:
-                return []
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
-        return dialog_dict["messages"]
+        return dialog_id
+
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        if dialog_id is None:
+            return []
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+        return await self.dialog_storage.get_messages(dialog_id, user_id)
 
+    async def get_last_dialog_messages(self, user_id: int, n: int, dialog_id: Optional[str] = None):
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        if dialog_id is None or n <= 0:
+            return []
+
+        return await self.dialog_storage.get_last_messages(dialog_id, user_id, n)
+
+    async def get_dialog_messages_for_context(
+        self, user_id: int, max_n: int, dialog_id: Optional[str] = None
+    ) -> Tuple[list, int]:
+        """Return last max_n messages of dialog and number of older messages, which were not loaded
+        """
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
-            if dialog_id is None:
-                raise ValueError("current_dialog_id is not set")
+            return [], 0
 
-        self.dialog_collection.update_one(
-            {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"messages": dialog_messages}}
-        )
+        # one extra message tells if there are older ones, so only long dialogs are counted
+        dialog_messages = await self.dialog_storage.get_last_messages(dialog_id, user_id, max_n + 1)
+        if len(dialog_messages) <= max_n:
+            return dialog_messages, 0
 
-    def count_documents_in_collection(self, collection_name: str):
-        return self.db[collection_name].count_documents({})
+        n_dialog_messages = await self.dialog_storage.count_messages(dialog_id, user_id)
+        # max() covers messages removed between two requests
+        return dialog_messages[1:], max(n_dialog_messages - max_n, 1)
 
-    def get_new_unique_payment_id(self):
-        if self.payment_collection.count_documents({}) == 0:
-            payment_id = 0
-        else:
-            payment_id = 1 + self.payment_collection.find_one(sort=[("_id", pymongo.DESCENDING)])["_id"]
+    async def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        if dialog_id is None:
+            raise ValueError("current_dialog_id is not set")
+
+        await self.dialog_storage.set_messages(dialog_id, user_id, dialog_messages)
+
+    async def append_dialog_message(self, user_id: int, dialog_message: dict, dialog_id: Optional[str] = None):
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        if dialog_id is None:
+            raise ValueError("current_dialog_id is not set")
+
+        await self.dialog_storage.append_message(dialog_id, user_id, dialog_message)
 
-        return payment_id
+    async def pop_last_dialog_message(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        """Remove last message from dialog. Returns removed message or None if dialog is empty
+        """
+        dialog_id = await self._get_dialog_id(user_id, dialog_id)
+        if dialog_id is None:
+            return None
+
+        return await self.dialog_storage.pop_last_message(dialog_id, user_id)
+
+    async def count_documents_in_collection(self, collection_name: str):
+        return await self.db[collection_name].count_documents({})
 
-    def add_new_payment(
+    async def _get_max_payment_id(self) -> int:
+        payment_dict = await self.payment_collection.find_one(sort=[("_id", pymongo.DESCENDING)], projection={"_id": 1})
+        return -1 if payment_dict is None else payment_dict["_id"]
+
+    async def get_new_unique_payment_id(self):
+        return await self.payment_id_allocator.allocate()
+
+    async def add_new_payment(
         self,
         payment_id: int,
         payment_method: str,  # like: cryptomus, cards
@@ -216,61 +911,183 @@ class Database:
             "are_tokens_added": False
         }
 
-        self.payment_collection.insert_one(payment_dict)
+        await self.payment_collection.insert_one(payment_dict)
 
-    def get_payment_attribute(self, payment_id: int, key: str):
-        self.check_if_payment_exists(payment_id, raise_exception=True)
-        payment_dict = self.payment_collection.find_one({"_id": payment_id})
+    async def get_payment_attribute(self, payment_id: int, key: str):
+        await self.check_if_payment_exists(payment_id, raise_exception=True)
+        payment_dict = await self.payment_collection.find_one({"_id": payment_id})
 
         if key not in payment_dict:
             raise ValueError(f"Payment {payment_id} does not have a value for {key}")
 
         return payment_dict[key]
 
-    def set_payment_attribute(self, payment_id: int, key: str, value: Any):
-        self.check_if_payment_exists(payment_id, raise_exception=True)
-        self.payment_collection.update_one({"_id": payment_id}, {"$set": {key: value}})
+    async def set_payment_attribute(self, payment_id: int, key: str, value: Any):
+        await self.check_if_payment_exists(payment_id, raise_exception=True)
+        await self.payment_collection.update_one({"_id": payment_id}, {"$set": {key: value}})
 
-    def get_all_not_expried_payment_dicts(self, time_margin_in_seconds: int = 0):
-        return self.payment_collection.find({
+    async def claim_payment_tokens(self, payment_id: int) -> Optional[Dict[str, Any]]:
+        """Atomically mark payment as paid with tokens added. Returns payment document if this call
+        made the claim, None if tokens were already added (e.g. by concurrent webhook retry)
+        """
+        return await self.payment_collection.find_one_and_update(
+            {"_id": payment_id, "are_tokens_added": False},
+            {"$set": {"status": "paid", "are_tokens_added": True}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def unclaim_payment_tokens(self, payment_id: int) -> None:
+        await self.payment_collection.update_one({"_id": payment_id}, {"$set": {"are_tokens_added": False}})
+
+    async def get_all_not_expried_payment_dicts(self, time_margin_in_seconds: int = 0):
+        cursor = self.payment_collection.find({
             "$and": [{"expired_at": {"$gt": datetime.now() - timedelta(seconds=time_margin_in_seconds)}}, {"status": {"$ne": "paid"}}]
         })
+        return await cursor.to_list(length=None)
 
-    def does_user_have_successful_payment(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        n_successful_payments = self.payment_collection.count_documents({"user_id": user_id, "status": "paid"})
+    async def does_user_have_successful_payment(self, user_id: int):
+        await self.check_if_user_exists(user_id, raise_exception=True)
+        n_successful_payments = await self.payment_collection.count_documents({"user_id": user_id, "status": "paid"})
         return n_successful_payments > 0
 
-    def create_newsletter(self, newsletter_id: str):
-        if not self.check_if_newsletter_exists(newsletter_id):
+    async def create_newsletter(self, newsletter_id: str):
+        if not await self.check_if_newsletter_exists(newsletter_id):
             newsletter_dict = {
                 "_id": newsletter_id,
-                "already_sent_to_user_ids": [],
                 "created_at": datetime.now()
             }
 
-            self.newsletter_collection.insert_one(newsletter_dict)
+            await self.newsletter_collection.insert_one(newsletter_dict)
+        else:
+            await self._migrate_legacy_newsletter_deliveries(newsletter_id)
 
-    def add_user_to_newsletter(self, newsletter_id: str, user_id: int):
-        self.check_if_newsletter_exists(newsletter_id, raise_exception=True)
-        self.check_if_user_exists(user_id, raise_exception=True)
+    async def _migrate_legacy_newsletter_deliveries(self, newsletter_id: str):
+        # old newsletters kept deliveries in `already_sent_to_user_ids` array
+        newsletter_dict = await self.newsletter_collection.find_one(
+            {"_id": newsletter_id},
+            projection={"already_sent_to_user_ids": 1}
+        )
+        user_ids = newsletter_dict.get("already_sent_to_user_ids", [])
+        if len(user_ids) > 0:
+            await self.add_users_to_newsletter(newsletter_id, user_ids)
 
-        newsletter_dict = self.newsletter_collection.find_one({"_id": newsletter_id})
-        if user_id not in newsletter_dict["already_sent_to_user_ids"]:
-            self.newsletter_collection.update_one(
-                {"_id": newsletter_id},
-                {"$push": {"already_sent_to_user_ids": user_id}}
-            )
+        await self.newsletter_collection.update_one(
+            {"_id": newsletter_id},
+            {"$unset": {"already_sent_to_user_ids": ""}}
+        )
+
+    async def add_user_to_newsletter(self, newsletter_id: str, user_id: int):
+        await self.check_if_newsletter_exists(newsletter_id, raise_exception=True)
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
-    def get_newsletter_attribute(self, newsletter_id: str, key: str):
-        self.check_if_newsletter_exists(newsletter_id, raise_exception=True)
-        newsletter_dict = self.newsletter_collection.find_one({"_id": newsletter_id})
+        await self.newsletter_delivery_collection.update_one(
+            {"newsletter_id": newsletter_id, "user_id": user_id},
+            {"$setOnInsert": {"sent_at": datetime.now()}},
+            upsert=True,
+        )
+
+    async def add_users_to_newsletter(self, newsletter_id: str, user_ids: List[int], batch_size: int = 1000):
+        now = datetime.now()
+        for i in range(0, len(user_ids), batch_size):
+            await self.newsletter_delivery_collection.bulk_write([
+                UpdateOne(
+                    {"newsletter_id": newsletter_id, "user_id": user_id},
+                    {"$setOnInsert": {"sent_at": now}},
+                    upsert=True,
+                )
+                for user_id in user_ids[i:i + batch_size]
+            ], ordered=False)
+
+    async def count_newsletter_deliveries(self, newsletter_id: str) -> int:
+        return await self.newsletter_delivery_collection.count_documents({"newsletter_id": newsletter_id})
+
+    async def get_users_not_in_newsletter(self, newsletter_id: str, query: Optional[dict] = None) -> List[Dict[str, Any]]:
+        """User dicts (matching query, only _id and chat_id) to whom newsletter was not sent yet.
+        Deliveries are joined through (newsletter_id, user_id) index, so cost is linear in number of users.
+        Read into list at once: sending is slow, and cursor would time out between batches
+        """
+        cursor = self.user_collection.aggregate([
+            {"$match": query or {}},
+            {"$lookup": {
+                "from": self.newsletter_delivery_collection.name,
+                "localField": "_id",
+                "foreignField": "user_id",
+                "pipeline": [{"$match": {"newsletter_id": newsletter_id}}, {"$limit": 1}, {"$project": {"_id": 1}}],
+                "as": "_newsletter_delivery",
+            }},
+            {"$match": {"_newsletter_delivery": {"$size": 0}}},
+            {"$project": {"_id": 1, "chat_id": 1}},
+        ])
+        return await cursor.to_list(length=None)
+
+    async def get_newsletter_attribute(self, newsletter_id: str, key: str):
+        await self.check_if_newsletter_exists(newsletter_id, raise_exception=True)
+        newsletter_dict = await self.newsletter_collection.find_one({"_id": newsletter_id})
 
         if key not in newsletter_dict:
             raise ValueError(f"Newsletter {newsletter_id} does not have a value for {key}")
 
         return newsletter_dict[key]
 
+    async def acquire_user_lease(self, user_id: int, owner: str, ttl: float) -> bool:
+        """Take (or extend own) lease on user. Returns False if lease is held by another owner
+        """
+        now = datetime.utcnow()
+        try:
+            await self.user_lease_collection.find_one_and_update(
+                {"_id": user_id, "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl), "cancel_requested": False}},
+                upsert=True,
+            )
+        except pymongo.errors.DuplicateKeyError:
+            # lease document exists and belongs to somebody else
+            return False
+        return True
+
+    async def release_user_lease(self, user_id: int, owner: str) -> None:
+        await self.user_lease_collection.delete_one({"_id": user_id, "owner": owner})
+
+    async def renew_user_leases(self, owner: str, user_ids: List[int], ttl: float) -> List[int]:
+        """Extend all leases of owner with one update. Returns ids of users whose tasks were asked to be cancelled
+        """
+        if len(user_ids) == 0:
+            return []
+
+        now = datetime.utcnow()
+        await self.user_lease_collection.update_many(
+            {"_id": {"$in": user_ids}, "owner": owner},
+            {"$set": {"expires_at": now + timedelta(seconds=ttl)}},
+        )
+
+        cursor = self.user_lease_collection.find(
+            {"_id": {"$in": user_ids}, "owner": owner, "cancel_requested": True},
+            projection={"_id": 1},
+        )
+        return [lease_dict["_id"] async for lease_dict in cursor]
+
+    async def check_if_user_lease_is_held(self, user_id: int) -> bool:
+        lease_dict = await self.user_lease_collection.find_one(
+            {"_id": user_id, "expires_at": {"$gte": datetime.utcnow()}},
+            projection={"_id": 1},
+        )
+        return lease_dict is not None
+
+    async def request_user_task_cancel(self, user_id: int) -> bool:
+        """Ask owner of user lease (possibly another process) to cancel user task.
+        Returns False if user has no running task
+        """
+        result = await self.user_lease_collection.update_one(
+            {"_id": user_id, "expires_at": {"$gte": datetime.utcnow()}},
+            {"$set": {"cancel_requested": True}},
+        )
+        return result.matched_count > 0
+
+    async def clear_user_task_cancel_request(self, user_id: int, owner: str) -> None:
+        await self.user_lease_collection.update_one(
+            {"_id": user_id, "owner": owner},
+            {"$set": {"cancel_requested": False}},
+        )
+
 
 # global database reference
 db = Database()
@@ -0,0 +1,131 @@
+from typing import Optional, Callable, Any, Dict, Tuple
+
+import asyncio
+import logging
+import multiprocessing
+import time
+import concurrent.futures
+
+from bot import config
+
+
+logger = logging.getLogger(__name__)
+
+
+def _timed_call(fn: Callable, args: tuple) -> Tuple[float, Any]:
+    # runs inside worker, so it must stay module-level to be picklable for process pools
+    started_at = time.time()
+    return started_at, fn(*args)
+
+
+class InstrumentedExecutor:
+    """Named executor which creates its pool lazily and keeps saturation metrics.
+
+    n_active_workers and queue_depth are estimates, not measurements: pools are FIFO, so with
+    n_in_flight submitted-but-not-finished calls, about min(n_in_flight, max_workers) of them are
+    running and the rest are waiting in queue. Measured wait times are in wait time statistics
+    """
+    def __init__(self, name: str, kind: str, max_workers: int):
+        if kind not in {"thread", "process"}:
+            raise ValueError(f"Unknown executor kind: {kind}")
+
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+
+        self._executor: Optional[concurrent.futures.Executor] = None
+
+        self.n_submitted = 0
+        self.n_completed = 0
+        self.n_failed = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_run_time = 0.0
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                # not fork: parent runs Motor and io_pool threads, forked child could inherit their held locks
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("forkserver")
+                )
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix=f"{self.name}_pool"
+                )
+        return self._executor
+
+    @property
+    def n_in_flight(self) -> int:
+        return self.n_submitted - self.n_completed - self.n_failed
+
+    @property
+    def n_active_workers(self) -> int:  # estimate
+        return min(self.n_in_flight, self.max_workers)
+
+    @property
+    def queue_depth(self) -> int:  # estimate
+        return max(self.n_in_flight - self.max_workers, 0)
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """Run fn(*args) in pool. For process pools fn and args must be picklable
+        """
+        loop = asyncio.get_running_loop()
+
+        submitted_at = time.time()
+        self.n_submitted += 1
+        try:
+            started_at, result = await loop.run_in_executor(self._get_executor(), _timed_call, fn, args)
+        except BaseException:
+            self.n_failed += 1
+            raise
+
+        finished_at = time.time()
+        self.n_completed += 1
+
+        wait_time = max(started_at - submitted_at, 0.0)
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        self.total_run_time += finished_at - started_at
+
+        return result
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "n_active_workers": self.n_active_workers,
+            "queue_depth": self.queue_depth,
+            "n_submitted": self.n_submitted,
+            "n_completed": self.n_completed,
+            "n_failed": self.n_failed,
+            "avg_wait_time": self.total_wait_time / self.n_completed if self.n_completed > 0 else 0.0,
+            "max_wait_time": self.max_wait_time,
+            "avg_run_time": self.total_run_time / self.n_completed if self.n_completed > 0 else 0.0,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+# CPU-bound work (audio transcoding)
+cpu_pool = InstrumentedExecutor("cpu", kind="process", max_workers=config.cpu_pool_max_workers)
+
+# blocking I/O (payment provider SDKs)
+io_pool = InstrumentedExecutor("io", kind="thread", max_workers=config.io_pool_max_workers)
+
+executors = {executor.name: executor for executor in [cpu_pool, io_pool]}
+
+
+def get_executors_statistics() -> Dict[str, Dict[str, Any]]:
+    return {name: executor.get_statistics() for name, executor in executors.items()}
+
+
+def shutdown_executors(wait: bool = True) -> None:
+    for executor in executors.values():
+        try:
+            executor.shutdown(wait=wait)
+        except Exception:
+            logger.exception(f"Failed to shutdown {executor.name} executor")
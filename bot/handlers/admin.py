@@ -1,3 +1,6 @@
+from typing import Optional, Dict, Any, List
+
+import html
 import logging
 from datetime import datetime
 
@@ -8,7 +11,11 @@ from telegram.constants import ParseMode
 
 from bot import config
 from bot.database import db
-from bot.handlers.utils import add_handler_routines
+from bot.utils import split_text_into_chunks
+from bot import metrics
+from bot.executors import get_executors_statistics
+from bot.model_clients import model_clients
+from bot.handlers.utils import add_handler_routines, user_locks
 from bot.handlers.payments_ui import send_user_message_about_n_added_tokens
 
 
@@ -22,10 +29,10 @@ async def add_tokens_handle(update: Update, context: CallbackContext):
 
     try:
         user_id = int(username_or_user_id)
-        user_dict = db.user_collection.find_one({"_id": user_id})
+        user_dict = await db.user_collection.find_one({"_id": user_id})
     except:
         username = username_or_user_id
-        user_dict = db.user_collection.find_one({"username": username})
+        user_dict = await db.user_collection.find_one({"username": username})
 
     if user_dict is None:
         text = f"Username or user_id <b>{username_or_user_id}</b> not found in DB"
@@ -33,12 +40,11 @@ async def add_tokens_handle(update: Update, context: CallbackContext):
         return
 
     # add tokens
-    _balance = db.get_user_attribute(user_dict["_id"], "token_balance")
-    db.set_user_attribute(user_dict["_id"], "token_balance", _balance + n_tokens_to_add)
+    await db.increment_balance(user_dict["_id"], n_tokens_to_add)
 
     # save in database
-    payment_id = db.get_new_unique_payment_id()
-    db.add_new_payment(
+    payment_id = await db.get_new_unique_payment_id()
+    await db.add_new_payment(
         payment_id=payment_id,
         payment_method="add_tokens",
         payment_method_type="add_tokens",
@@ -87,11 +93,11 @@ async def notify_admins_about_successfull_payment(
         return
     text = "🟣 Successfull payment:\n"
 
-    payment_dict = db.payment_collection.find_one({"_id": payment_id})
+    payment_dict = await db.payment_collection.find_one({"_id": payment_id})
     for key in ["amount", "currency", "product_key", "n_tokens_to_add", "payment_method", "user_id", "status"]:
         text += f"- {key}: <b>{payment_dict[key]}</b>\n"
 
-    user_dict = db.user_collection.find_one({"_id": payment_dict["user_id"]})
+    user_dict = await db.user_collection.find_one({"_id": payment_dict["user_id"]})
     if user_dict["username"] is not None:
         text += f"- username: @{user_dict['username']}\n"
 
@@ -102,3 +108,111 @@ async def notify_admins_about_successfull_payment(
         text += f"\n{admin_username}"
 
     await context.bot.send_message(config.admin_chat_id, text, parse_mode=ParseMode.HTML)
+
+
+def format_index_report(report: Dict[str, Any]) -> str:
+    text = "🗂 <b>Index report</b>\n"
+    for collection_name, collection_report in report["collections"].items():
+        text += f"\n→ <b>{collection_name}</b>\n"
+        for index in collection_report["indexes"]:
+            text += f"  ⤷ {index['name']}: <b>{index['n_ops']}</b> ops since {index['since']:%Y-%m-%d %H:%M}\n"
+        for index_name in collection_report["missing_indexes"]:
+            text += f"  ⤷ 🚨 {index_name}: <b>missing</b>\n"
+
+    text += "\n→ 🐢 <b>Slow queries without index:</b>\n"
+    if report["profiler_level"] == 0:
+        text += "  ⤷ profiler is disabled (set mongodb_profiler_slowms in config)\n"
+    elif len(report["slow_queries"]) == 0:
+        text += "  ⤷ none\n"
+    else:
+        for query in report["slow_queries"]:
+            text += (
+                f"  ⤷ {query['ns']} {query['op']} <b>{query['millis']}ms</b>: "
+                f"<code>{html.escape(str(query['filter']))}</code>\n"
+            )
+
+    return text
+
+
+@add_handler_routines()
+async def index_stats_handle(update: Update, context: CallbackContext):
+    report = await db.get_index_report()
+    text = format_index_report(report)
+    for text_chunk in split_text_into_chunks(text, 4096):
+        await update.effective_message.reply_text(text_chunk, parse_mode=ParseMode.HTML)
+
+
+def _format_duration(duration: Optional[float]) -> str:
+    if duration is None:
+        return "-"
+    if duration == float("inf"):
+        return "&gt;120s"
+    return f"{1000 * duration:.0f}ms"
+
+
+def _format_n_calls(n_calls: Optional[float]) -> str:
+    return "-" if n_calls is None else f"{n_calls:.1f}"
+
+
+def format_perf_report(
+    handler_summary: List[Dict[str, Any]],
+    user_cache_statistics: Dict[str, Any],
+    user_locks_statistics: Dict[str, Any],
+    executors_statistics: Dict[str, Dict[str, Any]],
+    model_clients_statistics: Dict[str, Any],
+) -> str:
+    text = "⏱ <b>Performance</b> (since start, this process)\n"
+
+    text += "\n→ <b>Handlers</b> (count, avg / p95 latency, avg DB / Telegram / LLM calls per update)\n"
+    if len(handler_summary) == 0:
+        text += "  ⤷ no updates yet\n"
+    for item in handler_summary:
+        text += (
+            f"  ⤷ {item['handler']}: <b>{item['count']}</b>, "
+            f"{_format_duration(item['avg_duration'])} / {_format_duration(item['p95_duration'])}, "
+            f"{_format_n_calls(item['avg_db_calls'])} / {_format_n_calls(item['avg_telegram_calls'])} / {_format_n_calls(item['avg_llm_calls'])}"
+        )
+        if item["n_errors"] > 0:
+            text += f", 🚨 {item['n_errors']} errors"
+        text += "\n"
+
+    text += "\n→ <b>User cache</b>\n"
+    text += (
+        f"  ⤷ size: <b>{user_cache_statistics['size']}</b>/{user_cache_statistics['max_size']}, "
+        f"hit rate: <b>{100 * user_cache_statistics['hit_rate']:.1f}%</b>\n"
+    )
+
+    text += "\n→ <b>User locks</b>\n"
+    text += f"  ⤷ size: <b>{user_locks_statistics['size']}</b>, locked: {user_locks_statistics['n_locked']}, max size: {user_locks_statistics['max_size']}\n"
+
+    text += "\n→ <b>Executors</b> (active and queue are estimated from calls in flight)\n"
+    for name, stats in executors_statistics.items():
+        text += (
+            f"  ⤷ {name}: active <b>{stats['n_active_workers']}</b>/{stats['max_workers']}, "
+            f"queue: <b>{stats['queue_depth']}</b>, "
+            f"avg wait: {_format_duration(stats['avg_wait_time'])}, max wait: {_format_duration(stats['max_wait_time'])}\n"
+        )
+
+    text += "\n→ <b>Model clients</b>\n"
+    text += (
+        f"  ⤷ clients: <b>{model_clients_statistics['n_clients']}</b>, "
+        f"created: {model_clients_statistics['n_clients_created']}, reused: {model_clients_statistics['n_clients_reused']}\n"
+        f"  ⤷ connections created: <b>{model_clients_statistics['n_connections_created']}</b>, "
+        f"reused: {model_clients_statistics['n_connections_reused']} "
+        f"(<b>{100 * model_clients_statistics['connection_reuse_rate']:.1f}%</b>)\n"
+    )
+
+    return text
+
+
+@add_handler_routines()
+async def perf_handle(update: Update, context: CallbackContext):
+    text = format_perf_report(
+        handler_summary=metrics.get_handler_summary(),
+        user_cache_statistics=db.user_cache.get_statistics(),
+        user_locks_statistics=user_locks.get_statistics(),
+        executors_statistics=get_executors_statistics(),
+        model_clients_statistics=model_clients.get_statistics(),
+    )
+    for text_chunk in split_text_into_chunks(text, 4096):
+        await update.effective_message.reply_text(text_chunk, parse_mode=ParseMode.HTML)
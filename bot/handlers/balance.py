@@ -9,7 +9,7 @@ from telegram.constants import ParseMode
 from bot import config
 from bot.config import mxp
 from bot.database import db, UserId, ChatId
-from bot.handlers.utils import add_handler_routines, get_strings, send_reply
+from bot.handlers.utils import add_handler_routines, get_strings, get_user_lang, send_reply
 from bot.handlers.tokens import get_total_n_used_bot_tokens
 from bot.handlers.constants import ShowPaymentMethodsData, InviteFriendData
 
@@ -29,8 +29,9 @@ class ShowBalanceSource(Enum):
     MESSAGE_QUEUE_IS_FULL = 6
 
 
-def check_if_user_has_enough_tokens(user_id: UserId) -> bool:
-    token_balance = db.get_user_attribute(user_id, "token_balance")
+async def check_if_user_has_enough_tokens(user_id: UserId) -> bool:
+    # balance is changed by atomic updates, so it's always read from db (write-through cache)
+    token_balance = await db.get_user_attribute(user_id, "token_balance")
     return token_balance > 0
 
 
@@ -51,14 +52,14 @@ async def show_balance(
     source: ShowBalanceSource = ShowBalanceSource.COMMAND,
     source_chat_mode_key: Optional[str] = None
 ):
-    lang = db.get_user_attribute(user_id, "lang")
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
+    lang = strings.lang
 
     if not config.enable_message_queue and source == ShowBalanceSource.COMMAND:
         source = ShowBalanceSource.NOT_ENOUGH_TOKENS
 
-    token_balance = db.get_user_attribute(user_id, "token_balance")
-    total_n_used_bot_tokens = get_total_n_used_bot_tokens(user_id)
+    token_balance = await db.get_user_attribute(user_id, "token_balance")
+    total_n_used_bot_tokens = await get_total_n_used_bot_tokens(user_id)
     if token_balance > 0:
         text = strings["you_have_have_n_tokens_left"].format(
             token_balance=token_balance,
@@ -81,7 +82,7 @@ async def show_balance(
             text = strings["call_to_buy_tokens"]
         elif source == ShowBalanceSource.PRO_CHAT_MODE:
             text = strings["you_have_have_no_tokens_left_for_pro_chat_mode"].format(
-                chat_mode_name=config.chat_modes[source_chat_mode_key]["name"][lang],
+                chat_mode_name=config.snapshot.chat_modes[source_chat_mode_key].name[lang],
                 total_n_used_bot_tokens=total_n_used_bot_tokens
             )
             text += "\n\n"
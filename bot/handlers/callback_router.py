@@ -0,0 +1,41 @@
+from typing import Optional, Dict, Callable, Awaitable, Type
+
+import logging
+
+from telegram import Update
+from telegram.ext import CallbackContext, CallbackQueryHandler
+
+from bot.handlers.constants import CallbackData
+
+
+logger = logging.getLogger(__name__)
+
+
+HandlerFn = Callable[[Update, CallbackContext], Awaitable[None]]
+
+
+class CallbackQueryRouter:
+    """Dispatches callback queries to handlers by CallbackData prefix with one dict lookup,
+    instead of matching every query against regex pattern of each CallbackQueryHandler
+    """
+    def __init__(self):
+        self._handlers: Dict[str, HandlerFn] = {}
+
+    def add(self, callback_data_cls: Type[CallbackData], handler: HandlerFn) -> None:
+        prefix = callback_data_cls.prefix
+        if prefix in self._handlers:
+            raise ValueError(f"Handler for callback data prefix '{prefix}' is already added")
+        callback_data_cls.codec()  # compile codec at startup
+        self._handlers[prefix] = handler
+
+    def get_handler(self, data: Optional[str]) -> Optional[HandlerFn]:
+        if not data:
+            return None
+        return self._handlers.get(data.split("|", 1)[0])
+
+    async def handle(self, update: Update, context: CallbackContext) -> None:
+        handler = self.get_handler(update.callback_query.data)
+        await handler(update, context)
+
+    def to_handler(self) -> CallbackQueryHandler:
+        return CallbackQueryHandler(self.handle, pattern=lambda data: self.get_handler(data) is not None)
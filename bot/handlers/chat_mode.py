@@ -3,6 +3,7 @@ from enum import Enum
 
 import asyncio
 import logging
+import math
 
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import CallbackContext
@@ -11,11 +12,15 @@ from telegram.constants import ParseMode
 from bot import config
 from bot.database import db, UserId, ChatId
 from bot.config import mxp
+from bot.strings import StringTable
 from bot.handlers.utils import (
     get_strings,
+    get_user_lang,
     add_handler_routines,
     send_reply,
     ignore_message_not_modified_error,
+    get_user_attribute,
+    set_user_attribute,
 )
 from bot.handlers.balance import check_if_user_has_enough_tokens, show_balance, ShowBalanceSource
 from bot.handlers.constants import SetChatModeData, ChoosePageChatModesData
@@ -26,23 +31,51 @@ logger = logging.getLogger(__name__)
 
 
 def is_pro_chat_mode(chat_mode_key: str):
-    return ("is_pro" in config.chat_modes[chat_mode_key]) and (config.chat_modes[chat_mode_key]["is_pro"] == True)
+    return config.snapshot.chat_modes[chat_mode_key].is_pro
 
 
-def get_chat_mode_menu(page_index: int, strings: Dict[str, str]) -> Tuple[str, InlineKeyboardMarkup]:
+# (lang, page_index) -> (text, reply_markup), filled by build_chat_mode_menus()
+_chat_mode_menus: Dict[Tuple[str, int], Tuple[str, InlineKeyboardMarkup]] = {}
+
+
+def build_chat_mode_menus() -> None:
+    """Precompute chat mode menus of all languages and pages. Call again after config reload
+    """
+    n_pages = max(math.ceil(len(config.snapshot.chat_mode_keys) / config.n_chat_modes_per_page), 1)
+    chat_mode_menus = {
+        (lang, page_index): _build_chat_mode_menu(page_index, get_strings(lang))
+        for lang in config.string_tables.keys()
+        for page_index in range(n_pages)
+    }
+
+    # swap whole dict, so that readers never see partially built menus
+    global _chat_mode_menus
+    _chat_mode_menus = chat_mode_menus
+    logger.info(f"Built {len(chat_mode_menus)} chat mode menus")
+
+
+def get_chat_mode_menu(page_index: int, strings: StringTable) -> Tuple[str, InlineKeyboardMarkup]:
+    menu = _chat_mode_menus.get((strings.lang, page_index))
+    if menu is None:
+        menu = _build_chat_mode_menu(page_index, strings)
+    return menu
+
+
+def _build_chat_mode_menu(page_index: int, strings: StringTable) -> Tuple[str, InlineKeyboardMarkup]:
+    snapshot = config.snapshot
     n_chat_modes_per_page = config.n_chat_modes_per_page
-    text = strings["select_chat_mode"].format(n_chat_modes=len(config.chat_modes))
+    text = strings["select_chat_mode"].format(n_chat_modes=len(snapshot.chat_mode_keys))
 
     # buttons
-    chat_mode_keys = list(config.chat_modes.keys())
+    chat_mode_keys = snapshot.chat_mode_keys
     _start = page_index * n_chat_modes_per_page
     _end = (page_index + 1) * n_chat_modes_per_page
     page_chat_mode_keys = chat_mode_keys[_start:_end]
 
     keyboard = []
     for chat_mode_key in page_chat_mode_keys:
-        name = config.chat_modes[chat_mode_key]["name"][strings.lang]
-        if "is_pro" in config.chat_modes[chat_mode_key] and (config.chat_modes[chat_mode_key]["is_pro"] == True):
+        name = snapshot.chat_modes[chat_mode_key].name[strings.lang]
+        if snapshot.chat_modes[chat_mode_key].is_pro:
             name += " [PRO]"
         keyboard.append([InlineKeyboardButton(name, callback_data=SetChatModeData(chat_mode_key).dump())])
 
@@ -67,7 +100,7 @@ def get_chat_mode_menu(page_index: int, strings: Dict[str, str]) -> Tuple[str, I
 @add_handler_routines(check_if_previous_message_is_answered=True)
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
     text, reply_markup = get_chat_mode_menu(0, strings=strings)
     await update.effective_message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
@@ -75,7 +108,7 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
 @add_handler_routines(check_if_previous_message_is_answered=True, answer_callback_query=True)
 async def show_chat_modes_callback_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     page_index = ChoosePageChatModesData.load(update.callback_query.data).page
     if page_index < 0:
@@ -94,7 +127,7 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
 @add_handler_routines(answer_callback_query=True)
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
     chat_mode = SetChatModeData.load(update.callback_query.data).chat_mode_key
 
     distinct_id, event_name, properties = (
@@ -105,7 +138,7 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     mxp.track(distinct_id, event_name, properties)
 
     # is redirect to chatgpt_plus?
-    if "type" in config.chat_modes[chat_mode] and config.chat_modes[chat_mode]["type"] == "redirect_to_chatgpt_plus":
+    if config.snapshot.chat_modes[chat_mode].type == "redirect_to_chatgpt_plus":
         await update.effective_message.reply_text(
             strings["redirect_to_chatgpt_plus"],
             parse_mode=ParseMode.HTML,
@@ -115,7 +148,7 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     # is pro?
     if (
         (is_pro_chat_mode(chat_mode)) and
-        (not check_if_user_has_enough_tokens(user_id=user_id)) and
+        (not await check_if_user_has_enough_tokens(user_id=user_id)) and
         (config.enable_message_queue)
     ):
         await show_balance(
@@ -127,15 +160,16 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
         )
         return
 
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    await set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id)
 
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = await get_user_attribute(user_id, "current_model")
 
+    snapshot = config.snapshot
     text = ""
-    if config.chat_modes[chat_mode]["model_type"] == "text":
-        text += f"<i>{config.models['info'][current_model]['name']}</i>: "
-    text += config.chat_modes[chat_mode]["welcome_message"][strings.lang]
+    if snapshot.chat_modes[chat_mode].model_type == "text":
+        text += f"<i>{snapshot.models[current_model].name}</i>: "
+    text += snapshot.chat_modes[chat_mode].welcome_message[strings.lang]
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
 
     # mxp
@@ -152,21 +186,21 @@ async def maybe_switch_chat_mode_to_default_because_not_enough_tokens(
     user_id: UserId,
     chat_id: ChatId,
 ):
-    current_chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    current_chat_mode = await get_user_attribute(user_id, "current_chat_mode")
     if (
-      (not check_if_user_has_enough_tokens(user_id=user_id)) and
+      (not await check_if_user_has_enough_tokens(user_id=user_id)) and
       (is_pro_chat_mode(current_chat_mode)) and
       (config.enable_message_queue)
     ):
-        strings = get_strings(user_id)
+        strings = get_strings(await get_user_lang(user_id))
         default_chat_mode = "assistant"
 
-        db.set_user_attribute(user_id, "current_chat_mode", default_chat_mode)
-        db.start_new_dialog(user_id)
+        await set_user_attribute(user_id, "current_chat_mode", default_chat_mode)
+        await db.start_new_dialog(user_id)
 
         text = strings["switch_chat_mode_to_default_because_not_enough_tokens"].format(
-            current_chat_mode_name=config.chat_modes[current_chat_mode]["name"][strings.lang],
-            default_chat_mode_name=config.chat_modes[default_chat_mode]["name"][strings.lang]
+            current_chat_mode_name=config.snapshot.chat_modes[current_chat_mode].name[strings.lang],
+            default_chat_mode_name=config.snapshot.chat_modes[default_chat_mode].name[strings.lang]
         )
 
         await send_reply(
@@ -8,9 +8,11 @@ from telegram.constants import ParseMode
 
 from bot import config
 from bot.database import db
+from bot.executors import io_pool
 from bot.config import mxp
 from bot.handlers.utils import (
     get_strings,
+    get_user_lang,
     add_handler_routines,
 )
 from bot.handlers.constants import InvoiceData
@@ -24,18 +26,18 @@ from bot.payment import CryptomusPayment
 @add_handler_routines(answer_callback_query=True)
 async def send_invoice_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     data = InvoiceData.load(update.callback_query.data)
     product = config.products[data.product_key]
     payment_method_type = config.payment_methods[data.payment_method_key]["type"]
-    payment_id = db.get_new_unique_payment_id()
+    payment_id = await db.get_new_unique_payment_id()
 
     if payment_method_type == "telegram_payments":
         chat_id = update.callback_query.message.chat.id
 
         # save in database
-        db.add_new_payment(
+        await db.add_new_payment(
             payment_id=payment_id,
             payment_method=data.payment_method_key,
             payment_method_type=payment_method_type,
@@ -76,14 +78,16 @@ async def send_invoice_handle(update: Update, context: CallbackContext):
             config.payment_methods[data.payment_method_key]["merchant_id"]
         )
 
-        invoice_url, status, expired_at = cryptomus_payment_instance.create_invoice(
+        # blocking HTTP request
+        invoice_url, status, expired_at = await io_pool.run(
+            cryptomus_payment_instance.create_invoice,
             payment_id,
             product["price"],
             product["currency"]
         )
 
         # save in database
-        db.add_new_payment(
+        await db.add_new_payment(
             payment_id=payment_id,
             payment_method=data.payment_method_key,
             payment_method_type=payment_method_type,
@@ -116,7 +120,7 @@ async def send_invoice_handle(update: Update, context: CallbackContext):
         user_id,
         "send_invoice",
         {
-            "token_balance": db.get_user_attribute(user_id, "token_balance"),
+            "token_balance": await db.get_user_attribute(user_id, "token_balance"),
             "payment_method": data.payment_method_key,
             "product": data.product_key,
             "payment_id": payment_id,
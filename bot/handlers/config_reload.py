@@ -0,0 +1,77 @@
+from typing import Optional
+
+import asyncio
+import html
+import logging
+import os
+import signal
+
+from telegram import Update
+from telegram.ext import CallbackContext
+from telegram.constants import ParseMode
+
+from bot import config
+from bot.executors import io_pool
+from bot.handlers.utils import add_handler_routines
+from bot.handlers.chat_mode import build_chat_mode_menus
+from bot.handlers.settings import build_settings_menus
+
+
+logger = logging.getLogger(__name__)
+
+
+_reload_config_lock: Optional[asyncio.Lock] = None
+_reload_config_task: Optional[asyncio.Task] = None
+
+
+async def reload_config() -> None:
+    """Reload chat modes, models and strings. Files are read and validated in io_pool,
+    then config and precomputed menus are swapped without yielding to other handlers.
+    On error old config stays in use
+    """
+    global _reload_config_lock
+    if _reload_config_lock is None:
+        _reload_config_lock = asyncio.Lock()
+
+    async with _reload_config_lock:
+        content = await io_pool.run(config.load_content)
+
+        config.apply_content(content)
+        build_chat_mode_menus()
+        build_settings_menus()
+
+    logger.info(f"Config reloaded: {len(config.snapshot.chat_modes)} chat modes, {len(config.snapshot.available_text_models)} text models")
+
+
+def schedule_config_reload() -> None:
+    """SIGHUP handler
+    """
+    async def _reload():
+        try:
+            await reload_config()
+        except Exception:
+            logger.exception("Failed to reload config, old config is kept")
+
+    global _reload_config_task
+    _reload_config_task = asyncio.create_task(_reload())
+
+
+@add_handler_routines()
+async def reload_config_handle(update: Update, context: CallbackContext):
+    if config.n_workers > 1:
+        # parent process forwards SIGHUP to all workers, including this one
+        os.kill(os.getppid(), signal.SIGHUP)
+        text = f"🟣 Config reload is requested for all <b>{config.n_workers}</b> workers, errors are logged by workers"
+        await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
+        return
+
+    try:
+        await reload_config()
+    except Exception as e:
+        text = f"Failed to reload config, old config is kept:\n<code>{html.escape(str(e))}</code>"
+    else:
+        text = (
+            f"🟣 Config reloaded: <b>{len(config.snapshot.chat_modes)}</b> chat modes, "
+            f"<b>{len(config.snapshot.available_text_models)}</b> text models"
+        )
+    await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -1,30 +1,74 @@
-from typing import Optional, Tuple, Any
+from typing import Optional, Tuple, Any, Callable, List
 
 from enum import Enum
-from dataclasses import dataclass, asdict, fields
+from dataclasses import dataclass, fields
+from operator import attrgetter
 from bson.objectid import ObjectId
 
 
+# Telegram limit for InlineKeyboardButton.callback_data
+MAX_CALLBACK_DATA_SIZE = 64
+
+
+class CallbackDataCodec:
+    """Encoder/decoder of one CallbackData class, generated once from its dataclass fields
+    """
+    def __init__(self, cls: type):
+        _fields = [f for f in fields(cls) if f.name != "prefix"]
+
+        self.cls = cls
+        self.prefix = cls.prefix
+        self.n_parts = len(_fields) + 1
+        self.parsers: List[Callable[[str], Any]] = [CallbackDataCodec.get_parser(f.type) for f in _fields]
+        self.getter = attrgetter(*[f.name for f in _fields]) if len(_fields) > 0 else None
+        self.n_fields = len(_fields)
+
+    @staticmethod
+    def get_parser(field_type: type) -> Callable[[str], Any]:
+        if field_type is bool:
+            return "True".__eq__
+        elif field_type is str:
+            return str.__str__
+        return field_type
+
+    def dump(self, obj) -> str:
+        if self.n_fields == 0:
+            data = self.prefix
+        elif self.n_fields == 1:
+            data = f"{self.prefix}|{self.getter(obj)}"
+        else:
+            data = "|".join([self.prefix, *map(str, self.getter(obj))])
+
+        if len(data.encode()) > MAX_CALLBACK_DATA_SIZE:
+            raise ValueError(f"Callback data is longer than {MAX_CALLBACK_DATA_SIZE} bytes: {data}")
+        return data
+
+    def load(self, data: str):
+        parts = data.split("|")
+        if parts[0] != self.prefix:
+            raise ValueError(f"Invalid prefix: {parts[0]}")
+        if len(parts) != self.n_parts:
+            raise ValueError(f"Invalid number of parts {len(parts)} in data {data} for {self.cls.__name__}")
+        return self.cls(*[parse(part) for parse, part in zip(self.parsers, parts[1:])])
+
+
 @dataclass
 class CallbackData:
     def dump(self):
-        data = asdict(self)
-        data.pop("prefix")
-        parts = [self.prefix, *data.values()]
-        return "|".join(str(x) for x in parts)
+        return type(self).codec().dump(self)
 
     @classmethod
     def load(cls, data):
-        parts = data.split("|")
-        prefix = parts[0]
-        if prefix != cls.prefix:
-            raise ValueError(f"Invalid prefix: {prefix}")
-        _fields = fields(cls)
-        if len(parts) != len(_fields):
-            raise ValueError(f"Invalid number of parts {len(parts)} in data {data} for {_fields}")
-        _fields = [x for x in _fields if x.name != "prefix"]
-        kwargs = {f.name: cls.string_to_field_value(p, f.type) for f, p in zip(_fields, parts[1:])}
-        return cls(**kwargs)
+        return cls.codec().load(data)
+
+    @classmethod
+    def codec(cls) -> CallbackDataCodec:
+        # stored in class __dict__, so that subclasses don't share codec of parent
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = CallbackDataCodec(cls)
+            setattr(cls, "_codec", codec)
+        return codec
 
     @classmethod
     def pattern(cls):
@@ -32,9 +76,7 @@ class CallbackData:
 
     @staticmethod
     def string_to_field_value(line: str, field_type: type) -> Any:
-        if field_type is bool:
-            return line == "True"
-        return field_type(line)
+        return CallbackDataCodec.get_parser(field_type)(line)
 
 
 @dataclass
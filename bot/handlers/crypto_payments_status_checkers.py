@@ -1,10 +1,9 @@
-import asyncio
 import logging
 
 from telegram.ext import CallbackContext
 
 from bot import config
-from bot.handlers.utils import thread_pool
+from bot.executors import io_pool
 from bot.database import db
 from bot.payment import CryptomusPayment
 from bot.handlers.tokens import confirm_payment_and_add_tokens
@@ -14,9 +13,9 @@ logger = logging.getLogger(__name__)
 
 
 async def check_not_expired_payments_job_fn(context: CallbackContext):
-    def _get_payment_ids_to_confirm_fn():
-        payment_dicts = db.get_all_not_expried_payment_dicts(time_margin_in_seconds=12*60*60)  # give 12 hour margin after expiration
+    payment_dicts = await db.get_all_not_expried_payment_dicts(time_margin_in_seconds=12*60*60)  # give 12 hour margin after expiration
 
+    def _get_payment_ids_to_confirm_fn():
         cryptomus_payment_instance = CryptomusPayment(
             config.payment_methods["cryptomus"]["api_key"],
             config.payment_methods["cryptomus"]["merchant_id"]
@@ -36,8 +35,7 @@ async def check_not_expired_payments_job_fn(context: CallbackContext):
 
         return payment_ids_to_confirm
 
-    loop = asyncio.get_running_loop()
-    payment_ids_to_confirm = await loop.run_in_executor(thread_pool, _get_payment_ids_to_confirm_fn)
+    payment_ids_to_confirm = await io_pool.run(_get_payment_ids_to_confirm_fn)
 
     for payment_id in payment_ids_to_confirm:
         try:
@@ -2,7 +2,6 @@ from typing import Tuple, Dict, Optional
 
 import tempfile
 import asyncio
-import pydub
 import logging
 from datetime import datetime
 from pathlib import Path
@@ -17,15 +16,17 @@ from bot import config
 from bot.config import mxp
 
 from bot.database import db
+from bot.executors import cpu_pool
+from bot.utils import convert_audio
 
-from bot.queue.globals import user_tasks
-from bot.queue.user_task import UserTaskType, create_and_run_user_task
+from bot.queue.user_task import UserTaskType, create_and_run_user_task, cancel_user_task
+from bot.workers import user_leases
 
 from bot.handlers.utils import (
     get_strings,
+    get_user_lang,
     add_handler_routines,
     send_reply,
-    thread_pool
 )
 from bot.handlers.balance import (
     check_if_user_has_enough_tokens,
@@ -58,10 +59,10 @@ async def message_handle(
 
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     message_text = message_text or update.effective_message.text
-    db.set_user_attribute(user_id, "last_message_text", message_text)
+    await db.set_user_activity_attribute(user_id, "last_message_text", message_text)
 
     # remove bot mention (in group chats)
     if update.effective_chat.type != "private":
@@ -82,7 +83,7 @@ async def message_handle(
     )
 
     # define in which queue to process the task
-    if not check_if_user_has_enough_tokens(user_id=user_id):
+    if not await check_if_user_has_enough_tokens(user_id=user_id):
         if config.enable_message_queue:
             user_task_type = UserTaskType.MESSAGE_QUEUE
         else:
@@ -124,13 +125,14 @@ async def message_handle(
         raise ValueError(f"Unknown user_task_type: {user_task_type}")
 
     # mxp
+    user_attributes = await db.get_user_attributes(user_id, ["current_dialog_id", "current_chat_mode", "current_model"])
     distinct_id, event_name, properties = (
         user_id,
         "send_message",
         {
-            "dialog_id": db.get_user_attribute(user_id, "current_dialog_id"),
-            "chat_mode": db.get_user_attribute(user_id, "current_chat_mode"),
-            "model": db.get_user_attribute(user_id, "current_model"),
+            "dialog_id": user_attributes["current_dialog_id"],
+            "chat_mode": user_attributes["current_chat_mode"],
+            "model": user_attributes["current_model"],
             "user_task_type": user_task_type.name
         }
     )
@@ -151,7 +153,7 @@ async def edited_message_handle(update: Update, context: CallbackContext):
     if update.edited_message.chat.type != ChatType.PRIVATE:
         return
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
     text = strings["edited_message"]
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
 
@@ -159,18 +161,15 @@ async def edited_message_handle(update: Update, context: CallbackContext):
 @add_handler_routines(check_if_previous_message_is_answered=True)
 async def retry_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
+    # last message is removed from the context
+    last_dialog_message = await db.pop_last_dialog_message(user_id, dialog_id=None)
+    if last_dialog_message is None:
         text = strings["no_message_to_retry"]
         await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
         return
 
-    last_dialog_message = dialog_messages.pop()
-    # last message was removed from the context
-    db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)
-
     await message_handle(
         update,
         context,
@@ -181,14 +180,19 @@ async def retry_handle(update: Update, context: CallbackContext):
 
 async def check_if_dialog_timeout_happened(update: Update, context: CallbackContext, use_new_dialog_timeout: bool = True):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    strings = get_strings(await get_user_lang(user_id))
+    user_attributes = await db.get_user_attributes(user_id, ["current_chat_mode", "current_dialog_id", "last_message_ts"])
+    chat_mode = user_attributes["current_chat_mode"]
 
     # handle new dialog timeout case
     ask_new_dialog = False
 
-    if chat_mode != "artist" and use_new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-        last_message_ts = db.get_user_attribute(user_id, "last_message_ts")
+    if (
+        chat_mode != "artist" and
+        use_new_dialog_timeout and
+        len(await db.get_last_dialog_messages(user_id, 1, dialog_id=user_attributes["current_dialog_id"])) > 0
+    ):
+        last_message_ts = user_attributes["last_message_ts"]
         if last_message_ts is not None:  # backward compatibility
             elapsed_seconds = (datetime.now() - last_message_ts).total_seconds()
             if elapsed_seconds > config.new_dialog_timeout:
@@ -214,14 +218,14 @@ async def check_if_dialog_timeout_happened(update: Update, context: CallbackCont
 )
 async def new_dialog_timeout_confirm_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     use_new_dialog = NewDialogButtonData.load(update.callback_query.data).use_new_dialog
 
     if use_new_dialog:
-        db.start_new_dialog(user_id)
-        chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-        chat_mode_name = config.chat_modes[chat_mode]["name"][strings.lang]
+        await db.start_new_dialog(user_id)
+        chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
+        chat_mode_name = config.snapshot.chat_modes[chat_mode].name[strings.lang]
         text = (
             strings["starting_new_dialog_due_to_timeout"]
             .format(chat_mode_name=chat_mode_name)
@@ -238,7 +242,7 @@ async def new_dialog_timeout_confirm_handle(update: Update, context: CallbackCon
         except:
             pass
 
-    message_text = db.get_user_attribute(user_id, "last_message_text")
+    message_text = await db.get_user_attribute(user_id, "last_message_text")
     await message_handle(
         update,
         context,
@@ -250,20 +254,21 @@ async def new_dialog_timeout_confirm_handle(update: Update, context: CallbackCon
 @add_handler_routines(check_if_previous_message_is_answered=True)
 async def new_dialog_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
     text = strings["new_dialog"]
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    current_model = db.get_user_attribute(user_id, "current_model")
+    user_attributes = await db.get_user_attributes(user_id, ["current_chat_mode", "current_model"])
+    chat_mode, current_model = user_attributes["current_chat_mode"], user_attributes["current_model"]
 
+    snapshot = config.snapshot
     text = ""
-    if config.chat_modes[chat_mode]["model_type"] == "text":
-        text += f"<i>{config.models['info'][current_model]['name']}</i>: "
+    if snapshot.chat_modes[chat_mode].model_type == "text":
+        text += f"<i>{snapshot.models[current_model].name}</i>: "
 
-    text += config.chat_modes[chat_mode]["welcome_message"][strings.lang]
+    text += snapshot.chat_modes[chat_mode].welcome_message[strings.lang]
 
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
 
@@ -271,12 +276,10 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
 @add_handler_routines()
 async def cancel_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
-
-    if user_id in user_tasks:
-        user_task = user_tasks[user_id]
-        await user_task.cancel()
+    strings = get_strings(await get_user_lang(user_id))
 
+    # task could be running in another worker process, then it is cancelled through user lease
+    if await cancel_user_task(user_id) or await user_leases.request_cancel(user_id):
         text = strings["canceled"]
         await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
     else:
@@ -291,7 +294,7 @@ async def cancel_handle(update: Update, context: CallbackContext):
 async def voice_message_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     # voice messages bot ads
     if config.enable_voice_messages_bot_ads:
@@ -309,7 +312,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
 
         asyncio.sleep(5.0)
 
-    if not check_if_user_has_enough_tokens(user_id=user_id):
+    if not await check_if_user_has_enough_tokens(user_id=user_id):
         if config.enable_message_queue:
             show_balance_source = ShowBalanceSource.VOICE_MESSAGE
         else:
@@ -339,9 +342,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
 
         # convert to mp3
         voice_mp3_path = tmp_dir / "voice.mp3"
-        loop = asyncio.get_running_loop()
-        def _task_fn(): return pydub.AudioSegment.from_file(voice_ogg_path).export(voice_mp3_path, format="mp3")
-        await loop.run_in_executor(thread_pool, _task_fn)
+        await cpu_pool.run(convert_audio, voice_ogg_path, voice_mp3_path, "mp3")
 
         # transcribe
         with open(voice_mp3_path, "rb") as f:
@@ -354,14 +355,10 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
 
     # token usage
-    _n = db.get_user_attribute(user_id, "n_transcribed_seconds")
-    db.set_user_attribute(user_id, "n_transcribed_seconds", voice.duration + _n)
+    await db.increment_user_attribute(user_id, "n_transcribed_seconds", voice.duration)
 
     n_used_bot_tokens = convert_transcribed_seconds_to_bot_tokens("whisper-1", voice.duration)
-    initial_balance = db.get_user_attribute(user_id, "token_balance")
-
-    new_balance = max(0, initial_balance - n_used_bot_tokens)
-    db.set_user_attribute(user_id, "token_balance", new_balance)
+    await db.increment_balance(user_id, -n_used_bot_tokens, floor=0)
 
     # mxp
     distinct_id, event_name, properties = (
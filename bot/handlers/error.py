@@ -13,7 +13,7 @@ from bot import config
 from bot.config import mxp
 from bot.database import db, ChatId, UserId
 from bot.utils import split_text_into_chunks
-from bot.handlers.utils import get_strings
+from bot.handlers.utils import get_strings, get_user_lang
 from bot.handlers.utils import send_reply
 
 
@@ -68,7 +68,7 @@ async def send_message_about_error_to_user(
     chat_id: ChatId,
     user_id: UserId,
 ):
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     # send message to user
     text = strings["exception"].format(support_username=config.support_username)
@@ -13,9 +13,11 @@ from bot.database import db, UserId
 from bot.config import mxp
 from bot.handlers.utils import (
     get_strings,
+    get_user_lang,
     add_handler_routines,
-    register_user,
+    get_request_context,
     send_reply,
+    set_user_attribute,
 )
 from bot.handlers.tokens import add_tokens_to_ref_user
 from bot.handlers.chat_mode import show_chat_modes_handle
@@ -40,10 +42,11 @@ def parse_deeplink_parameters(s):
         return dict()
 
 
+@add_handler_routines()
 async def start_handle(update: Update, context: CallbackContext):
-    is_new_user = await register_user(update, context)
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    is_new_user = get_request_context(user_id).is_new_user  # user is registered by add_handler_routines
+    strings = get_strings(await get_user_lang(user_id))
 
     # deeplink parameters
     argv = update.effective_message.text.split(" ")
@@ -52,26 +55,25 @@ async def start_handle(update: Update, context: CallbackContext):
         deeplink_parameters = parse_deeplink_parameters(argv[1])
 
         if "lang" in deeplink_parameters:
-            db.set_user_attribute(user_id, "lang", deeplink_parameters["lang"])
+            await set_user_attribute(user_id, "lang", deeplink_parameters["lang"])
 
         if "source" in deeplink_parameters:
-            if db.get_user_attribute(user_id, "deeplink_source") is None:
-                db.set_user_attribute(user_id, "deeplink_source", deeplink_parameters["source"])
+            if await db.get_user_attribute(user_id, "deeplink_source") is None:
+                await db.set_user_attribute(user_id, "deeplink_source", deeplink_parameters["source"])
 
         if "ref" in deeplink_parameters and is_new_user:
             ref_user_id = int(deeplink_parameters["ref"])
 
             # set ref for new user
-            if db.get_user_attribute(user_id, "ref") is None:
-                db.set_user_attribute(user_id, "ref", ref_user_id)
+            if await db.get_user_attribute(user_id, "ref") is None:
+                await db.set_user_attribute(user_id, "ref", ref_user_id)
 
-            if db.check_if_user_exists(ref_user_id):
-                ref_user_invites = db.get_user_attribute(ref_user_id, "invites")
-                if user_id not in ref_user_invites and len(ref_user_invites) < config.max_invites_per_user:
-                    await add_tokens_to_ref_user(context, user_id=user_id, ref_user_id=ref_user_id)
+            # invite is added atomically: concurrent /start's (maybe in other workers) can't exceed the limit
+            if await db.add_user_invite(ref_user_id, user_id, max_invites=config.max_invites_per_user):
+                await add_tokens_to_ref_user(context, user_id=user_id, ref_user_id=ref_user_id)
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    await db.set_user_activity_attribute(user_id, "last_interaction", datetime.now())
+    await db.start_new_dialog(user_id)
 
     if is_new_user:
         await send_welcome_message_to_new_user(update, context)
@@ -87,7 +89,7 @@ async def start_handle(update: Update, context: CallbackContext):
 
 async def send_welcome_message_to_new_user(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     for message_key in ["welcome_message_1", "welcome_message_2", "welcome_message_3"]:
         placeholder_message = await update.effective_message.reply_text("...")
@@ -118,7 +120,7 @@ async def send_welcome_message_to_new_user(update: Update, context: CallbackCont
 @add_handler_routines()
 async def help_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
     text = strings["help"].format(support_username=config.support_username)
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
 
@@ -126,7 +128,7 @@ async def help_handle(update: Update, context: CallbackContext):
 @add_handler_routines()
 async def help_group_chat_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
     text = strings["help_group_chat"].format(bot_username=config.bot_username)
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
     await update.effective_message.reply_video(config.help_group_chat_video_path)
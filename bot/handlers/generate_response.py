@@ -18,12 +18,13 @@ from bot import config
 from bot.database import db, UserId, ChatId
 from bot.config import mxp
 from bot.queue.utils import MessageQueueTaskId, MessageQueueTaskStatus
-from bot.handlers.utils import get_strings, send_reply, ignore_message_not_modified_error
+from bot.handlers.utils import get_strings, get_user_lang, send_reply, ignore_message_not_modified_error
 from bot.handlers.tokens import (
     convert_generated_images_to_bot_tokens,
     convert_text_tokens_to_bot_tokens,
 )
 from bot.handlers.constants import SpeedupMessageQueueButtonData
+from bot.handlers.streaming_edits import streaming_edit_scheduler, NO_RETRIES
 from bot import openai_utils
 from bot.openai_utils import get_total_token_expenses
 
@@ -39,14 +40,17 @@ async def generate_and_send_text(
     token_expenses: TokenExpenses,
 ) -> None:
     # fetch prerequisites
-    strings = get_strings(user_id)
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+    strings = get_strings(await get_user_lang(user_id))
+    user_attributes = await db.get_user_attributes(user_id, ["current_chat_mode", "current_model", "current_dialog_id"])
+    chat_mode, current_model = user_attributes["current_chat_mode"], user_attributes["current_model"]
+    # older messages wouldn't fit into model context anyway, so don't transfer whole dialog
+    dialog_messages, n_dialog_messages_not_loaded = await db.get_dialog_messages_for_context(
+        user_id, config.max_n_dialog_messages_in_context, dialog_id=user_attributes["current_dialog_id"]
+    )
     parse_mode = {
         "html": ParseMode.HTML,
         "markdown": ParseMode.MARKDOWN
-    }[config.chat_modes[chat_mode]["parse_mode"]]
-    current_model = db.get_user_attribute(user_id, "current_model")
+    }[config.snapshot.chat_modes[chat_mode].parse_mode]
 
     # send typing action
     await bot.send_chat_action(chat_id=chat_id, action="typing")
@@ -78,41 +82,37 @@ async def generate_and_send_text(
             ignore_message_not_modified_error=True,
             text=text,
             parse_mode=parse_mode,
+            rate_limit_args=NO_RETRIES,  # scheduler handles RetryAfter
         )
 
-    # update placeholder message on the fly
-    displayed_answer = ""
-    async for gen_item in gen:
-        answer, n_first_dialog_messages_removed = gen_item
-        answer = answer[:4096]  # telegram message limit
-
-        # update only when 100 new symbols are ready
-        if abs(len(answer) - len(displayed_answer)) < 100:
-            continue
+    # update placeholder message on the fly, edits are paced per chat
+    answer, n_first_dialog_messages_removed = "", 0
+    async with streaming_edit_scheduler.answer(chat_id, _update_placeholder_message) as streaming_answer:
+        async for gen_item in gen:
+            answer, n_first_dialog_messages_removed = gen_item
+            answer = answer[:4096]  # telegram message limit
 
-        placeholder_message = await _update_placeholder_message(answer + "...")
-        if placeholder_message is None:
-            return None
-        await asyncio.sleep(0.1)  # wait a bit to avoid flooding
+            if not await streaming_answer.update(answer + "..."):
+                return None
 
-        displayed_answer = answer
+        # send final answer
+        if len(answer) != 0:
+            final_message = await streaming_answer.flush(answer)
+        else:
+            text = strings["model_answer_is_empty"]
+            final_message = await streaming_answer.flush(text)
 
-    # send final answer
-    if len(answer) != 0:
-        await _update_placeholder_message(answer)
-    else:
-        text = strings["model_answer_is_empty"]
-        await _update_placeholder_message(text)
+    if final_message is None:
+        # user didn't see the answer, so it doesn't become a part of the dialog
+        logger.error(f"Failed to send final answer to user {user_id}, answer is not added to dialog")
+        return None
 
     # update dialog
     new_dialog_message = {"user": message_text, "bot": answer, "date": datetime.now()}
-    db.set_dialog_messages(
-        user_id,
-        db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
-        dialog_id=None
-    )
+    await db.append_dialog_message(user_id, new_dialog_message, dialog_id=None)
 
     # send notification if some messages were removed from the context
+    n_first_dialog_messages_removed += n_dialog_messages_not_loaded
     if n_first_dialog_messages_removed > 0:
         if n_first_dialog_messages_removed == 1:
             text = strings["dialog_is_too_long_first_message"]
@@ -137,7 +137,7 @@ async def generate_and_send_images(
 ) -> Tuple[int, Optional[Exception]]:
     n_generated_images = 0
     try:
-        strings = get_strings(user_id)
+        strings = get_strings(await get_user_lang(user_id))
 
         try:
             image_urls = await openai_utils.generate_images(message_text, n_images=config.return_n_generated_images)
@@ -187,11 +187,10 @@ async def generate_response(
     message_text: str,
     do_subtract_tokens: bool = True,
 ):
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    user_attributes = await db.get_user_attributes(user_id, ["current_chat_mode", "current_model"])
+    chat_mode, current_model = user_attributes["current_chat_mode"], user_attributes["current_model"]
 
-    db.set_user_attribute(user_id, "last_message_ts", datetime.now())
-    current_model = db.get_user_attribute(user_id, "current_model")
-    initial_balance = db.get_user_attribute(user_id, "token_balance")
+    await db.set_user_activity_attribute(user_id, "last_message_ts", datetime.now())
 
     if chat_mode == 'artist':
         (
@@ -204,13 +203,11 @@ async def generate_response(
             message_text=message_text,
         )
 
-        _n = db.get_user_attribute(user_id, "n_generated_images")
-        db.set_user_attribute(user_id, "n_generated_images", _n + n_generated_images)
+        await db.increment_user_attribute(user_id, "n_generated_images", n_generated_images)
         n_used_bot_tokens = convert_generated_images_to_bot_tokens("dalle-2", n_generated_images)
 
         if do_subtract_tokens:
-            new_balance = max(0, initial_balance - n_used_bot_tokens)
-            db.set_user_attribute(user_id, "token_balance", new_balance)
+            await db.increment_balance(user_id, -n_used_bot_tokens, floor=0)
 
         distinct_id, event_name, properties = (
             user_id,
@@ -233,19 +230,18 @@ async def generate_response(
         finally:
             n_input_tokens, n_output_tokens = get_total_token_expenses(token_expenses)
 
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.add_token_usage(user_id, current_model, n_input_tokens, n_output_tokens)
             n_used_bot_tokens = convert_text_tokens_to_bot_tokens(current_model, n_input_tokens, n_output_tokens)
 
             if do_subtract_tokens:
-                new_balance = max(0, initial_balance - n_used_bot_tokens)
-                db.set_user_attribute(user_id, "token_balance", new_balance)
+                await db.increment_balance(user_id, -n_used_bot_tokens, floor=0)
 
         # mxp
         distinct_id, event_name, properties = (
             user_id,
             "send_message_done",
             {
-                "dialog_id": db.get_user_attribute(user_id, "current_dialog_id"),
+                "dialog_id": await db.get_user_attribute(user_id, "current_dialog_id"),
                 "chat_mode": chat_mode,
                 "model": current_model,
                 "n_used_bot_tokens": n_used_bot_tokens
@@ -269,7 +265,7 @@ async def display_message_queue_task_progress(
         user_id = message_queue_task.user_id
         chat_id = message_queue_task.chat_id
 
-        strings = get_strings(user_id)
+        strings = get_strings(await get_user_lang(user_id))
 
         progress_message = None
 
@@ -9,6 +9,7 @@ from bot.database import db, UserId, ChatId
 from bot.config import mxp
 from bot.handlers.utils import (
     get_strings,
+    get_user_lang,
     add_handler_routines,
 )
 from bot.handlers.constants import ShowProductsData, InvoiceData
@@ -24,9 +25,9 @@ async def send_user_message_about_n_added_tokens(
     if chat_id is None:
         if user_id is None:
             raise ValueError(f"chat_id and user_id can't be None simultaneously")
-        chat_id = db.get_user_attribute(user_id, "chat_id")
+        chat_id = await db.get_user_attribute(user_id, "chat_id")
 
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     if joined_friend_user_id is not None:
         text = strings["your_friend_joined"].format(friend_user_id=joined_friend_user_id)
@@ -39,7 +40,7 @@ async def send_user_message_about_n_added_tokens(
 @add_handler_routines(answer_callback_query=True)
 async def show_payment_methods_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     buttons = [
         InlineKeyboardButton(
@@ -59,7 +60,7 @@ async def show_payment_methods_handle(update: Update, context: CallbackContext):
     distinct_id, event_name, properties = (
         user_id,
         "show_payment_methods",
-        {"token_balance": db.get_user_attribute(user_id, "token_balance")}
+        {"token_balance": await db.get_user_attribute(user_id, "token_balance")}
     )
     mxp.track(distinct_id, event_name, properties)
 
@@ -67,7 +68,7 @@ async def show_payment_methods_handle(update: Update, context: CallbackContext):
 @add_handler_routines(answer_callback_query=True)
 async def show_products_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     payment_method_key = ShowProductsData.load(update.callback_query.data).payment_method_key
     product_keys = config.payment_methods[payment_method_key]["product_keys"]
@@ -90,7 +91,7 @@ async def show_products_handle(update: Update, context: CallbackContext):
         user_id,
         "show_products",
         {
-            "token_balance": db.get_user_attribute(user_id, "token_balance"),
+            "token_balance": await db.get_user_attribute(user_id, "token_balance"),
             "payment_method": payment_method_key
         }
     )
@@ -100,12 +101,12 @@ async def show_products_handle(update: Update, context: CallbackContext):
 @add_handler_routines(answer_callback_query=True)
 async def invite_friend_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
 
     text = strings["invite_friend"].format(
         n_tokens_to_add_to_ref=config.n_tokens_to_add_to_ref,
         max_invites_per_user=config.max_invites_per_user,
-        n_already_invited_users=len(db.get_user_attribute(user_id, "invites"))
+        n_already_invited_users=len(await db.get_user_attribute(user_id, "invites"))
     )
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML)
 
@@ -119,7 +120,7 @@ async def invite_friend_handle(update: Update, context: CallbackContext):
         user_id,
         "invite_friend",
         {
-            "token_balance": db.get_user_attribute(user_id, "token_balance"),
+            "token_balance": await db.get_user_attribute(user_id, "token_balance"),
         }
     )
     mxp.track(distinct_id, event_name, properties)
@@ -9,32 +9,62 @@ from telegram.constants import ParseMode
 from bot import config
 from bot.database import db, UserId, ChatId
 from bot.config import mxp
+from bot.strings import StringTable
 from bot.handlers.utils import (
     get_strings,
+    get_user_lang,
     add_handler_routines,
     send_reply,
+    get_user_attribute,
+    set_user_attribute,
 )
 from bot.handlers.balance import check_if_user_has_enough_tokens
 from bot.handlers.constants import SettingsData
 from bot.handlers.payments_ui import show_payment_methods_handle
 
 
-def get_settings_menu(user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
-    strings = get_strings(user_id)
-    current_model = db.get_user_attribute(user_id, "current_model")
-    text = config.models["info"][current_model]["description"][strings.lang]
+# (lang, current_model) -> (text, reply_markup), filled by build_settings_menus()
+_settings_menus: Dict[Tuple[str, str], Tuple[str, InlineKeyboardMarkup]] = {}
+
+
+def build_settings_menus() -> None:
+    """Precompute settings menus of all languages and models. Call again after config reload
+    """
+    settings_menus = {
+        (lang, model_key): _build_settings_menu(model_key, get_strings(lang))
+        for lang in config.string_tables.keys()
+        for model_key in config.snapshot.available_text_models
+    }
+
+    # swap whole dict, so that readers never see partially built menus
+    global _settings_menus
+    _settings_menus = settings_menus
+
+
+async def get_settings_menu(user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
+    strings = get_strings(await get_user_lang(user_id))
+    current_model = await get_user_attribute(user_id, "current_model")
+
+    menu = _settings_menus.get((strings.lang, current_model))
+    if menu is None:
+        menu = _build_settings_menu(current_model, strings)
+    return menu
+
+
+def _build_settings_menu(current_model: str, strings: StringTable) -> Tuple[str, InlineKeyboardMarkup]:
+    snapshot = config.snapshot
+    text = snapshot.models[current_model].description[strings.lang]
 
     text += "\n\n"
-    scores = config.models["info"][current_model]["scores"]
-    for score_dict in scores:
-        text += "🟢" * score_dict["score"] + "⚪️" * (5 - score_dict["score"]) + f" – {score_dict['title'][strings.lang]}\n\n"
+    for model_score in snapshot.models[current_model].scores:
+        text += "🟢" * model_score.score + "⚪️" * (5 - model_score.score) + f" – {model_score.title[strings.lang]}\n\n"
 
     text += strings["select_model"]
 
     # buttons to choose models
     buttons = []
-    for model_key in config.models["available_text_models"]:
-        title = config.models["info"][model_key]["name"]
+    for model_key in snapshot.available_text_models:
+        title = snapshot.models[model_key].name
         if model_key == current_model:
             title = "✅ " + title
         buttons.append(
@@ -48,7 +78,7 @@ def get_settings_menu(user_id: int) -> Tuple[str, InlineKeyboardMarkup]:
 @add_handler_routines(check_if_previous_message_is_answered=True)
 async def settings_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     await update.effective_message.reply_text(
         text,
         reply_markup=reply_markup,
@@ -59,13 +89,13 @@ async def settings_handle(update: Update, context: CallbackContext):
 @add_handler_routines(answer_callback_query=True)
 async def set_settings_handle(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    strings = get_strings(user_id)
+    strings = get_strings(await get_user_lang(user_id))
     model_key = SettingsData.load(update.callback_query.data).model_key
 
     # is pro?
     is_pro = is_pro_model(model_key=model_key)
-    if is_pro and not db.does_user_have_successful_payment(user_id):
-        text = strings["pro_model"].format(model_name=config.models["info"][model_key]["name"])
+    if is_pro and not await db.does_user_have_successful_payment(user_id):
+        text = strings["pro_model"].format(model_name=config.snapshot.models[model_key].name)
         await update.effective_message.reply_text(
             text,
             parse_mode=ParseMode.HTML,
@@ -75,10 +105,10 @@ async def set_settings_handle(update: Update, context: CallbackContext):
         await show_payment_methods_handle(update, context)
         return
 
-    db.set_user_attribute(user_id, "current_model", model_key)
-    db.start_new_dialog(user_id)
+    await set_user_attribute(user_id, "current_model", model_key)
+    await db.start_new_dialog(user_id)
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     await send_reply(
         update.effective_message,
         try_edit=True,
@@ -97,10 +127,7 @@ async def set_settings_handle(update: Update, context: CallbackContext):
 
 
 def is_pro_model(model_key: str) -> bool:
-    return (
-        ("is_pro" in config.models["info"][model_key]) and
-        (config.models["info"][model_key]["is_pro"] == True)
-    )
+    return config.snapshot.models[model_key].is_pro
 
 
 async def maybe_switch_model_to_default_because_not_enough_tokens(
@@ -108,21 +135,21 @@ async def maybe_switch_model_to_default_because_not_enough_tokens(
     user_id: UserId,
     chat_id: ChatId,
 ):
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = await get_user_attribute(user_id, "current_model")
     if (
-      (not check_if_user_has_enough_tokens(user_id=user_id)) and
+      (not await check_if_user_has_enough_tokens(user_id=user_id)) and
       (is_pro_model(current_model)) and
       (config.enable_message_queue)
     ):
-        strings = get_strings(user_id)
+        strings = get_strings(await get_user_lang(user_id))
         default_model = "gpt-3.5-turbo"
 
-        db.set_user_attribute(user_id, "current_model", default_model)
-        db.start_new_dialog(user_id)
+        await set_user_attribute(user_id, "current_model", default_model)
+        await db.start_new_dialog(user_id)
 
         text = strings["switch_model_to_default_because_not_enough_tokens"].format(
-            current_model_name=config.models["info"][current_model]["name"],
-            default_model_name=config.models["info"][default_model]["name"],
+            current_model_name=config.snapshot.models[current_model].name,
+            default_model_name=config.snapshot.models[default_model].name,
         )
 
         await send_reply(
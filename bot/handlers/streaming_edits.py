@@ -0,0 +1,187 @@
+from typing import Optional, Dict, Callable, Awaitable, Any
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+import telegram
+from telegram import Message
+from telegram.ext import AIORateLimiter
+
+from bot import config
+from bot import metrics
+from bot.database import ChatId
+
+
+logger = logging.getLogger(__name__)
+
+
+EditFn = Callable[[str], Awaitable[Optional[Message]]]
+
+# pass as rate_limit_args to Bot method, so that RetryAfter is raised to caller instead of being slept through
+NO_RETRIES = 0
+
+
+class _NotRetriedRetryAfter(Exception):
+    def __init__(self, retry_after_error: telegram.error.RetryAfter):
+        super().__init__(str(retry_after_error))
+        self.retry_after_error = retry_after_error
+
+
+class RateLimiter(AIORateLimiter):
+    """AIORateLimiter which doesn't retry requests made with rate_limit_args=NO_RETRIES.
+    Placeholder edits use it: StreamingEditScheduler backs off by itself and coalesces
+    skipped texts, while sleeping through RetryAfter would hide flood limits from it
+    """
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args: Optional[int]) -> Any:
+        if rate_limit_args != NO_RETRIES:
+            return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+        async def _callback(*args, **kwargs):
+            # base class retries RetryAfter, so it's passed through as another exception
+            try:
+                return await callback(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                raise _NotRetriedRetryAfter(e)
+
+        try:
+            return await super().process_request(_callback, args, kwargs, endpoint, data, None)
+        except _NotRetriedRetryAfter as e:
+            raise e.retry_after_error
+
+
+class _ChatEditState:
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.backoff_interval = min_interval  # grows on RetryAfter, decays on successful edits
+        self.edit_latency: Optional[float] = None  # EWMA
+        self.next_edit_at = 0.0
+        self.n_refs = 0
+
+
+class StreamingAnswer:
+    """Placeholder message of one streamed answer. update() edits it only when chat schedule allows,
+    skipped texts are coalesced into the next edit
+    """
+    def __init__(self, scheduler: "StreamingEditScheduler", state: _ChatEditState, edit_fn: EditFn):
+        self._scheduler = scheduler
+        self._state = state
+        self._edit_fn = edit_fn
+
+        self.displayed_text: Optional[str] = None
+        self.n_edits = 0
+        self.n_rate_limited = 0
+
+    async def update(self, text: str) -> bool:
+        """Return False if message can't be edited anymore (e.g. bot is blocked)
+        """
+        if text == self.displayed_text or time.monotonic() < self._state.next_edit_at:
+            return True
+        message = await self._edit(text)
+        return message is not None  # rate limited edit (False) is retried with next text
+
+    async def flush(self, text: str, max_attempts: int = 3) -> Optional[Message]:
+        """Edit message to final text, waiting for chat schedule if needed.
+        Returns None if user didn't get final text
+        """
+        for _ in range(max_attempts):
+            delay = self._state.next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            message = await self._edit(text)
+            if message is not False:
+                return message
+
+        logger.error(f"Failed to send final answer: rate limited {max_attempts} times")
+        return None
+
+    async def _edit(self, text: str):
+        # returns edited message, None if message is gone or False if rate limited
+        state = self._state
+        started_at = time.monotonic()
+        try:
+            message = await self._edit_fn(text)
+        except telegram.error.RetryAfter as e:
+            self.n_rate_limited += 1
+            metrics.answer_edits_rate_limited.inc()
+            state.backoff_interval = min(2 * state.backoff_interval, self._scheduler.max_interval)
+            state.next_edit_at = time.monotonic() + max(e.retry_after, state.backoff_interval)
+            return False
+
+        finished_at = time.monotonic()
+        latency = finished_at - started_at
+        state.edit_latency = latency if state.edit_latency is None else 0.8 * state.edit_latency + 0.2 * latency
+        state.backoff_interval = max(0.8 * state.backoff_interval, state.min_interval)
+        state.next_edit_at = finished_at + self._scheduler.get_interval(state, len(text))
+
+        self.n_edits += 1
+        self.displayed_text = text
+        return message
+
+
+class StreamingEditScheduler:
+    """Paces placeholder edits of streamed answers per chat.
+
+    Interval between edits of one chat is the largest of:
+    - min interval (Telegram allows ~1 message per second in private chats and ~20 per minute in groups)
+    - latency_factor * observed edit latency, so slow Telegram responses slow edits down
+    - text length / max_chars_per_second, because every edit re-sends the whole text
+    - backoff interval, which doubles on RetryAfter and decays on successful edits
+    capped by max_interval. Answers in one chat share the schedule while any of them is in flight
+    """
+    def __init__(
+        self,
+        min_interval: float,
+        group_min_interval: float,
+        max_interval: float,
+        max_chars_per_second: float,
+        latency_factor: float = 2.0,
+    ):
+        self.min_interval = min_interval
+        self.group_min_interval = group_min_interval
+        self.max_interval = max_interval
+        self.max_chars_per_second = max_chars_per_second
+        self.latency_factor = latency_factor
+
+        self._chats: Dict[ChatId, _ChatEditState] = {}
+
+    def get_interval(self, state: _ChatEditState, text_length: int) -> float:
+        interval = max(
+            state.min_interval,
+            self.latency_factor * (state.edit_latency or 0.0),
+            text_length / self.max_chars_per_second,
+            state.backoff_interval,
+        )
+        return min(interval, self.max_interval)
+
+    @asynccontextmanager
+    async def answer(self, chat_id: ChatId, edit_fn: EditFn):
+        state = self._chats.get(chat_id)
+        if state is None:
+            # negative ids are groups and channels
+            state = self._chats[chat_id] = _ChatEditState(self.group_min_interval if chat_id < 0 else self.min_interval)
+            state.next_edit_at = time.monotonic() + state.min_interval  # placeholder was just sent
+        state.n_refs += 1
+
+        streaming_answer = StreamingAnswer(self, state, edit_fn)
+        try:
+            yield streaming_answer
+        finally:
+            metrics.answer_edits.observe(streaming_answer.n_edits)
+
+            state.n_refs -= 1
+            if state.n_refs == 0:
+                del self._chats[chat_id]
+
+    def __len__(self) -> int:
+        return len(self._chats)
+
+
+streaming_edit_scheduler = StreamingEditScheduler(
+    min_interval=config.streaming_edit_min_interval,
+    group_min_interval=config.streaming_edit_group_min_interval,
+    max_interval=config.streaming_edit_max_interval,
+    max_chars_per_second=config.streaming_edit_max_chars_per_second,
+)
@@ -25,22 +25,20 @@ async def confirm_payment_and_add_tokens(
     """Confirm given payment, send notification to user, update database
     state and log events
     """
-    db.set_payment_attribute(payment_id, "status", "paid")
-    payment_dict = db.payment_collection.find_one({"_id": payment_id})
+    # claim first, so that concurrent confirmations (webhook retry vs checker job) add tokens once
+    payment_dict = await db.claim_payment_tokens(payment_id)
+    if payment_dict is None:
+        await db.set_payment_attribute(payment_id, "status", "paid")
+        return
 
     user_id = payment_dict["user_id"]
     n_tokens_to_add = payment_dict["n_tokens_to_add"]
 
-    if payment_dict["are_tokens_added"]:
-        return
-
-    _balance = db.get_user_attribute(user_id, "token_balance")
-    db.set_user_attribute(
-        user_id,
-        "token_balance",
-        _balance + n_tokens_to_add,
-    )
-    db.set_payment_attribute(payment_id, "are_tokens_added", True)
+    try:
+        token_balance = await db.increment_balance(user_id, n_tokens_to_add)
+    except Exception:
+        await db.unclaim_payment_tokens(payment_id)  # let next confirmation retry
+        raise
 
     await send_user_message_about_n_added_tokens(context, n_tokens_to_add, user_id=user_id)
     await notify_admins_about_successfull_payment(context, payment_id)
@@ -55,7 +53,7 @@ async def confirm_payment_and_add_tokens(
         user_id,
         "successful_payment",
         {
-            "token_balance": db.get_user_attribute(user_id, "token_balance"),
+            "token_balance": token_balance,
             "payment_method": payment_dict["payment_method"],
             "product": payment_dict["product_key"],
             "payment_id": payment_id,
@@ -73,12 +71,11 @@ async def add_tokens_to_ref_user(
     """Create fake payment, send notification to user, update database
     state and log events
     """
-    _balance = db.get_user_attribute(ref_user_id, "token_balance")
-    db.set_user_attribute(ref_user_id, "token_balance", _balance + config.n_tokens_to_add_to_ref)
+    await db.increment_balance(ref_user_id, config.n_tokens_to_add_to_ref)
 
     # save in database
-    payment_id = db.get_new_unique_payment_id()
-    db.add_new_payment(
+    payment_id = await db.get_new_unique_payment_id()
+    await db.add_new_payment(
         payment_id=payment_id,
         payment_method="add_tokens_for_ref",
         payment_method_type="add_tokens_for_ref",
@@ -92,12 +89,8 @@ async def add_tokens_to_ref_user(
         n_tokens_to_add=config.n_tokens_to_add_to_ref,
     )
 
-    # update invites
-    _invites = db.get_user_attribute(ref_user_id, "invites")
-    db.set_user_attribute(ref_user_id, "invites", _invites + [user_id])
-
     # send message to ref user
-    ref_chat_id = db.get_user_attribute(ref_user_id, "chat_id")
+    ref_chat_id = await db.get_user_attribute(ref_user_id, "chat_id")
     await send_user_message_about_n_added_tokens(
         context,
         n_tokens_added=config.n_tokens_to_add_to_ref,
@@ -134,17 +127,19 @@ async def add_tokens_to_ref_user(
     mxp.track(distinct_id, event_name, properties)
 
 
-def get_total_n_used_bot_tokens(user_id: UserId) -> int:
+async def get_total_n_used_bot_tokens(user_id: UserId) -> int:
+    user_attributes = await db.get_user_attributes(user_id, ["n_used_tokens", "n_transcribed_seconds", "n_generated_images"])
+
     total_n_used_bot_tokens = 0
-    for model_key, model_values in db.get_user_attribute(user_id, "n_used_tokens").items():
+    for model_key, model_values in user_attributes["n_used_tokens"].items():
         total_n_used_bot_tokens += convert_text_tokens_to_bot_tokens(model_key, model_values["n_input_tokens"], model_values["n_output_tokens"])
 
     # voice messages
-    voice_recognition_n_used_bot_tokens = convert_transcribed_seconds_to_bot_tokens("whisper-1", db.get_user_attribute(user_id, "n_transcribed_seconds"))
+    voice_recognition_n_used_bot_tokens = convert_transcribed_seconds_to_bot_tokens("whisper-1", user_attributes["n_transcribed_seconds"])
     total_n_used_bot_tokens += voice_recognition_n_used_bot_tokens
 
     # image generation
-    image_generation_n_used_bot_tokens = convert_generated_images_to_bot_tokens("dalle-2", db.get_user_attribute(user_id, "n_generated_images"))
+    image_generation_n_used_bot_tokens = convert_generated_images_to_bot_tokens("dalle-2", user_attributes["n_generated_images"])
     total_n_used_bot_tokens += image_generation_n_used_bot_tokens
 
     return total_n_used_bot_tokens
@@ -155,27 +150,17 @@ def convert_text_tokens_to_bot_tokens(model: str, n_input_tokens: int, n_output_
     Text token – LLM token
     Bot token – currency inside bot (1 bot token price == 1 gpt-3.5-turbo token price)
     """
-    baseline_price_per_1000_tokens = config.models["info"]["gpt-3.5-turbo"]["price_per_1000_input_tokens"]
+    model_info = config.snapshot.models[model]
 
-    n_bot_input_tokens = int(n_input_tokens * (config.models["info"][model]["price_per_1000_input_tokens"] / baseline_price_per_1000_tokens))
-    n_bot_output_tokens = int(n_output_tokens * (config.models["info"][model]["price_per_1000_output_tokens"] / baseline_price_per_1000_tokens))
+    n_bot_input_tokens = int(n_input_tokens * model_info.bot_tokens_per_input_token)
+    n_bot_output_tokens = int(n_output_tokens * model_info.bot_tokens_per_output_token)
 
     return n_bot_input_tokens + n_bot_output_tokens
 
 
 def convert_generated_images_to_bot_tokens(model: str, n_generated_images: int):
-    baseline_price_per_1000_tokens = config.models["info"]["gpt-3.5-turbo"]["price_per_1000_input_tokens"]
-
-    n_spent_dollars = n_generated_images * (config.models["info"][model]["price_per_1_image"])
-    n_bot_tokens = int(n_spent_dollars / (baseline_price_per_1000_tokens / 1000))
-
-    return n_bot_tokens
+    return int(n_generated_images * config.snapshot.models[model].bot_tokens_per_image)
 
 
 def convert_transcribed_seconds_to_bot_tokens(model: str, n_transcribed_seconds: float):
-    baseline_price_per_1000_tokens = config.models["info"]["gpt-3.5-turbo"]["price_per_1000_input_tokens"]
-
-    n_spent_dollars = n_transcribed_seconds * (config.models["info"][model]["price_per_1_min"] / 60)
-    n_bot_tokens = int(n_spent_dollars / (baseline_price_per_1000_tokens / 1000))
-
-    return n_bot_tokens
+    return int(n_transcribed_seconds * config.snapshot.models[model].bot_tokens_per_second)
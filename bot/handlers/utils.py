@@ -1,13 +1,12 @@
-from typing import Optional, List, Dict, Any, Union
-from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Union, Tuple
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
 
 from functools import wraps
 
 import logging
 import asyncio
 from datetime import datetime
-from collections import defaultdict
-import concurrent.futures
 
 import telegram
 from telegram import Update, Message, Bot
@@ -15,15 +14,18 @@ from telegram.ext import CallbackContext
 from telegram.constants import ParseMode, ChatAction, ChatType
 
 from bot import config
-from bot.config import mxp, strings
+from bot.config import mxp
+from bot.strings import StringTable
+from bot.utils import KeyedLockRegistry
+from bot.metrics import track_handler
+from bot.workers import user_leases
 from bot.database import db, UserId
 
 
 logger = logging.getLogger(__name__)
 
 # asyncio utils
-user_semaphores: Dict[UserId, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(1))
-thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+user_locks = KeyedLockRegistry()
 
 
 async def send_reply(
@@ -47,7 +49,7 @@ async def send_reply(
         message_id = message.message_id
 
     if chat_id is None and user_id is not None:
-        chat_id = db.get_chat_id(user_id)
+        chat_id = await db.get_chat_id(user_id)
 
     assert chat_id is not None
     assert bot is not None
@@ -69,6 +71,8 @@ async def send_reply(
             except telegram.error.Forbidden:
                 logger.info("Failed to edit message (forbidden by user)")
                 return None
+            except telegram.error.RetryAfter:
+                raise  # sending new message instead would hit the same flood limit
             except:  # TODO: handle specific error only
                 pass
         elif try_delete:
@@ -109,8 +113,14 @@ def add_handler_routines(
     def decorator(f):
         @wraps(f)
         async def _fn(update: Update, context: CallbackContext, *args, **kwargs):
-            if register_user:
-                await _register_user(update, context)
+            async with track_handler(f.__name__):
+                if register_user:
+                    async with request_context(update, context):
+                        await _run(update, context, *args, **kwargs)
+                else:
+                    await _run(update, context, *args, **kwargs)
+
+        async def _run(update: Update, context: CallbackContext, *args, **kwargs):
             if ignore_if_bot_is_not_mentioned and not is_bot_mentioned(update, context):
                 return
             if check_if_previous_message_is_answered:
@@ -131,9 +141,103 @@ def add_handler_routines(
     return decorator
 
 
-def get_strings(user_id: UserId) -> Dict[str, str]:
+class RequestContext:
+    """State of one update: user document loaded at registration and resolved strings.
+
+    user_dict is a snapshot. Only KEYS are served from it: they are written only through
+    set_user_attribute() below, which writes to DB synchronously and updates the snapshot.
+    Other attributes (balance, invites, ...) are changed by atomic DB updates and are read from db
+    """
+    KEYS = frozenset(["lang", "current_chat_mode", "current_model"])
+
+    def __init__(self, user_id: UserId, user_dict: Dict[str, Any], is_new_user: bool = False):
+        self.user_id = user_id
+        self.user_dict = user_dict
+        self.is_new_user = is_new_user
+
+        self.strings = get_strings(self.lang)
+
+    @property
+    def lang(self) -> str:
+        return self.user_dict.get("lang") or config.default_lang
+
+    def get_user_attribute(self, key: str) -> Any:
+        return self.user_dict.get(key)
+
+    async def set_user_attribute(self, key: str, value: Any) -> None:
+        await db.set_user_attribute(self.user_id, key, value)
+        self.user_dict[key] = value
+
+        if key == "lang":
+            self.strings = get_strings(self.lang)
+
+
+_request_context: ContextVar[Optional[RequestContext]] = ContextVar("request_context", default=None)
+
+
+def get_request_context(user_id: UserId) -> Optional[RequestContext]:
+    request_ctx = _request_context.get()
+    if request_ctx is not None and request_ctx.user_id == user_id:
+        return request_ctx
+    return None
+
+
+@asynccontextmanager
+async def request_context(update: Update, context: CallbackContext):
+    # handler called from another handler (e.g. retry_handle -> message_handle) reuses outer context
+    request_ctx = get_request_context(update.effective_user.id)
+    if request_ctx is not None:
+        yield request_ctx
+        return
+
+    user_dict, is_new_user = await _register_user_and_get_user_dict(update, context)
+    request_ctx = RequestContext(update.effective_user.id, user_dict, is_new_user=is_new_user)
+
+    token = _request_context.set(request_ctx)
     try:
-        lang = db.get_user_attribute(user_id, "lang")
+        yield request_ctx
+    finally:
+        _request_context.reset(token)
+
+
+async def get_user_attribute(user_id: UserId, key: str) -> Any:
+    """Read user attribute from request context of current update if it holds the key, otherwise from database
+    """
+    request_ctx = get_request_context(user_id)
+    if request_ctx is not None and key in RequestContext.KEYS:
+        return request_ctx.get_user_attribute(key)
+
+    return await db.get_user_attribute(user_id, key)
+
+
+async def set_user_attribute(user_id: UserId, key: str, value: Any) -> None:
+    """Write user attribute to database, keeping request context of current update up to date
+    """
+    request_ctx = get_request_context(user_id)
+    if request_ctx is not None:
+        await request_ctx.set_user_attribute(key, value)
+    else:
+        await db.set_user_attribute(user_id, key, value)
+
+
+def get_strings(lang: Optional[str] = None) -> StringTable:
+    """Return precompiled string table of language, unknown languages fall back to default one
+    """
+    string_table = config.string_tables.get(lang)
+    if string_table is None:
+        string_table = config.string_tables[config.default_lang]
+    return string_table
+
+
+async def get_user_lang(user_id: UserId) -> str:
+    """Resolve user language: from request context of current update, otherwise from user cache / database
+    """
+    request_ctx = get_request_context(user_id)
+    if request_ctx is not None:
+        return request_ctx.lang
+
+    try:
+        lang = await db.get_user_attribute(user_id, "lang")
     except Exception as e:
         logger.error(f"Failed to get user language, fallback to default language: {e}")
         lang = config.default_lang
@@ -141,15 +245,7 @@ def get_strings(user_id: UserId) -> Dict[str, str]:
     if lang is None:
         lang = config.default_lang
 
-    class _Wrapper:
-        def __getitem__(self, name: str) -> str:
-            return strings[name][lang]
-
-        @property
-        def lang(self) -> str:
-            return lang
-
-    return _Wrapper()
+    return lang
 
 
 async def is_previous_message_not_answered_yet(
@@ -157,8 +253,8 @@ async def is_previous_message_not_answered_yet(
     context: CallbackContext,
 ) -> bool:
     user_id = update.effective_user.id
-    if user_semaphores[user_id].locked():
-        text = get_strings(user_id)["previous_message_is_not_answered_yet"]
+    if user_locks.locked(user_id) or await user_leases.is_held(user_id):
+        text = get_strings(await get_user_lang(user_id))["previous_message_is_not_answered_yet"]
         try:
             await send_reply(
                 message=update.effective_message,
@@ -193,70 +289,25 @@ def is_bot_mentioned(update: Update, context: CallbackContext) -> bool:
 
 
 async def _register_user(update: Update, context: CallbackContext) -> bool:
+    _, is_new_user = await _register_user_and_get_user_dict(update, context)
+    return is_new_user
+
+
+async def _register_user_and_get_user_dict(update: Update, context: CallbackContext) -> Tuple[Dict[str, Any], bool]:
     user = update.effective_user
-    is_new_user = False
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
-            user.id,
-            update.effective_chat.id,
-            initial_token_balance=config.initial_token_balance,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name
-        )
-        db.start_new_dialog(user.id)
-
-        is_new_user = True
-
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
-
-    # token balance
-    if not db.check_if_user_attribute_exists(user.id, "token_balance"):
-        db.set_user_attribute(user.id, "token_balance", config.initial_token_balance)
-
-    db.set_user_attribute(user.id, "last_interaction", datetime.now())
-
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
-
-    # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
-    if isinstance(n_used_tokens, int):  # old format
-        new_n_used_tokens = {
-            "gpt-3.5-turbo": {
-                "n_input_tokens": 0,
-                "n_output_tokens": n_used_tokens
-            }
-        }
-        db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
-
-    # image generation
-    if db.get_user_attribute(user.id, "n_generated_images") is None:
-        db.set_user_attribute(user.id, "n_generated_images", 0)
-
-    # voice message transcription
-    if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
-        db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
-
-    # lang
-    if (lang := db.get_user_attribute(user.id, "lang")) is None:
-        db.set_user_attribute(user.id, "lang", config.default_lang)
-
-    # invites
-    if db.get_user_attribute(user.id, "invites") is None:
-        db.set_user_attribute(user.id, "invites", [])
-
-    # make balance always non-negative
-    token_balance = db.get_user_attribute(user.id, "token_balance")
-    if token_balance < 0:
-        db.set_user_attribute(user.id, "token_balance", max(0, token_balance))
+    user_dict, is_new_user = await db.upsert_and_touch_user(
+        user.id,
+        update.effective_chat.id,
+        initial_token_balance=config.initial_token_balance,
+        username=user.username,
+        first_name=user.first_name,
+        last_name=user.last_name
+    )
 
     # mxp
-    user_dict = db.user_collection.find_one({"_id": user.id})
     mxp.people_set(user.id, user_dict)
 
-    return is_new_user
+    return user_dict, is_new_user
 
 # alias for outer imports
 register_user = _register_user
@@ -0,0 +1,370 @@
+from typing import Optional, Dict, Any, List, Tuple, Callable, Sequence
+
+import bisect
+import logging
+import math
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from aiohttp import web
+from telegram.request import HTTPXRequest
+
+
+logger = logging.getLogger(__name__)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CALL_COUNT_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Tuple, extra: Optional[Dict[str, str]] = None) -> str:
+    items = list(zip(labelnames, labelvalues)) + list((extra or {}).items())
+    if len(items) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in items)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = defaultdict(float)
+
+    def inc(self, value: float = 1.0, **labels) -> None:
+        self._values[tuple(labels[name] for name in self.labelnames)] += value
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labelvalues, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    class _Series:
+        def __init__(self, n_buckets: int):
+            self.bucket_counts = [0] * n_buckets
+            self.sum = 0.0
+            self.count = 0
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series: Dict[Tuple, Histogram._Series] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        labelvalues = tuple(labels[name] for name in self.labelnames)
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = Histogram._Series(len(self.buckets))
+
+        series.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    def get_series(self) -> Dict[Tuple, "Histogram._Series"]:
+        return self._series
+
+    def get_quantile(self, q: float, **labels) -> Optional[float]:
+        """Upper bound of bucket which contains q-quantile
+        """
+        series = self._series.get(tuple(labels[name] for name in self.labelnames))
+        if series is None or series.count == 0:
+            return None
+
+        rank, cumulative_count = q * series.count, 0
+        for upper_bound, bucket_count in zip(self.buckets, series.bucket_counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= rank:
+                return upper_bound
+        return math.inf
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, series in self._series.items():
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.buckets, series.bucket_counts):
+                cumulative_count += bucket_count
+                labels = _format_labels(self.labelnames, labelvalues, {"le": _format_value(upper_bound)})
+                lines.append(f"{self.name}_bucket{labels} {cumulative_count}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{labels} {series.count}")
+        return lines
+
+
+class Gauge:
+    """Value is read from callback at exposition time. Callback returns a number
+    or a dict {label value: number} for gauges with one label
+    """
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Any], labelname: Optional[str] = None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelname = labelname
+
+    def get(self) -> Any:
+        return self.callback()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.callback()
+        except Exception:
+            logger.exception(f"Failed to collect gauge {self.name}")
+            return lines
+
+        if self.labelname is None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        else:
+            for labelvalue, item_value in value.items():
+                lines.append(f"{self.name}{_format_labels((self.labelname,), (labelvalue,))} {_format_value(item_value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+handler_duration = registry.register(Histogram(
+    "bot_handler_duration_seconds", "Handler latency", ["handler"],
+))
+handler_errors = registry.register(Counter(
+    "bot_handler_errors_total", "Handlers which raised an exception", ["handler"],
+))
+update_db_calls = registry.register(Histogram(
+    "bot_update_db_calls", "Database round trips per update", ["handler"], buckets=CALL_COUNT_BUCKETS,
+))
+update_telegram_calls = registry.register(Histogram(
+    "bot_update_telegram_calls", "Telegram API calls per update", ["handler"], buckets=CALL_COUNT_BUCKETS,
+))
+update_llm_calls = registry.register(Histogram(
+    "bot_update_llm_calls", "LLM API calls per update", ["handler"], buckets=CALL_COUNT_BUCKETS,
+))
+db_calls = registry.register(Counter(
+    "bot_db_calls_total", "Database round trips", ["collection", "method"],
+))
+db_call_duration = registry.register(Histogram(
+    "bot_db_call_duration_seconds", "Database call latency", ["collection", "method"],
+))
+telegram_call_duration = registry.register(Histogram(
+    "bot_telegram_call_duration_seconds", "Telegram API call latency", ["method"],
+))
+llm_call_duration = registry.register(Histogram(
+    "bot_llm_call_duration_seconds", "LLM API call latency (for streaming calls until the last chunk)", ["kind"],
+))
+answer_edits = registry.register(Histogram(
+    "bot_answer_edits", "Placeholder message edits per streamed answer", buckets=CALL_COUNT_BUCKETS,
+))
+answer_edits_rate_limited = registry.register(Counter(
+    "bot_answer_edits_rate_limited_total", "Placeholder message edits rejected by Telegram with RetryAfter",
+))
+
+
+class UpdateStats:
+    def __init__(self):
+        self.n_db_calls = 0
+        self.n_telegram_calls = 0
+        self.n_llm_calls = 0
+
+
+# stats of update being handled, tasks created by handler share it
+_update_stats: ContextVar[Optional[UpdateStats]] = ContextVar("update_stats", default=None)
+
+
+@asynccontextmanager
+async def track_handler(handler_name: str):
+    """Measure handler latency. Outermost handler of update also records number of calls made during update
+    """
+    update_stats = _update_stats.get()
+    is_outermost = update_stats is None
+    if is_outermost:
+        update_stats = UpdateStats()
+        token = _update_stats.set(update_stats)
+
+    start_time = time.perf_counter()
+    try:
+        yield update_stats
+    except BaseException:
+        handler_errors.inc(handler=handler_name)
+        raise
+    finally:
+        handler_duration.observe(time.perf_counter() - start_time, handler=handler_name)
+        if is_outermost:
+            _update_stats.reset(token)
+            update_db_calls.observe(update_stats.n_db_calls, handler=handler_name)
+            update_telegram_calls.observe(update_stats.n_telegram_calls, handler=handler_name)
+            update_llm_calls.observe(update_stats.n_llm_calls, handler=handler_name)
+
+
+def _count_call(attribute: str) -> None:
+    update_stats = _update_stats.get()
+    if update_stats is not None:
+        setattr(update_stats, attribute, getattr(update_stats, attribute) + 1)
+
+
+@contextmanager
+def track_llm_call(kind: str):
+    _count_call("n_llm_calls")
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        llm_call_duration.observe(time.perf_counter() - start_time, kind=kind)
+
+
+def llm_call(kind: str):
+    def decorator(f):
+        @wraps(f)
+        async def _fn(*args, **kwargs):
+            with track_llm_call(kind):
+                return await f(*args, **kwargs)
+        return _fn
+    return decorator
+
+
+class InstrumentedCollection:
+    """Proxy of motor collection which counts and times database round trips.
+    Cursor methods (find, aggregate) are counted once, when cursor is created
+    """
+    AWAITABLE_METHODS = {
+        "find_one", "find_one_and_update", "find_one_and_delete", "find_one_and_replace",
+        "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+        "delete_one", "delete_many", "bulk_write", "count_documents", "estimated_document_count",
+        "distinct", "create_indexes", "create_index", "index_information",
+    }
+    CURSOR_METHODS = {"find", "aggregate", "list_indexes"}
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._collection, name)
+        if name in InstrumentedCollection.AWAITABLE_METHODS:
+            collection_name = self._collection.name
+
+            @wraps(attr)
+            async def _method(*args, **kwargs):
+                _count_call("n_db_calls")
+                db_calls.inc(collection=collection_name, method=name)
+                start_time = time.perf_counter()
+                try:
+                    return await attr(*args, **kwargs)
+                finally:
+                    db_call_duration.observe(time.perf_counter() - start_time, collection=collection_name, method=name)
+            return _method
+        elif name in InstrumentedCollection.CURSOR_METHODS:
+            collection_name = self._collection.name
+
+            @wraps(attr)
+            def _cursor_method(*args, **kwargs):
+                _count_call("n_db_calls")
+                db_calls.inc(collection=collection_name, method=name)
+                return attr(*args, **kwargs)
+            return _cursor_method
+        return attr
+
+
+class InstrumentedDatabase:
+    """Proxy of motor database which returns InstrumentedCollection
+    """
+    def __init__(self, database):
+        self._database = database
+        self._collections: Dict[str, InstrumentedCollection] = {}
+
+    def __getitem__(self, name: str) -> InstrumentedCollection:
+        if name not in self._collections:
+            self._collections[name] = InstrumentedCollection(self._database[name])
+        return self._collections[name]
+
+    def __getattr__(self, name: str):
+        return getattr(self._database, name)
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """Bot request which counts and times Telegram API calls
+    """
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        _count_call("n_telegram_calls")
+        start_time = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            telegram_call_duration.observe(time.perf_counter() - start_time, method=url.rsplit("/", 1)[-1])
+
+
+def get_handler_summary() -> List[Dict[str, Any]]:
+    summary = []
+    for (handler_name,), series in handler_duration.get_series().items():
+        item = {
+            "handler": handler_name,
+            "count": series.count,
+            "avg_duration": series.sum / series.count if series.count > 0 else 0.0,
+            "p50_duration": handler_duration.get_quantile(0.5, handler=handler_name),
+            "p95_duration": handler_duration.get_quantile(0.95, handler=handler_name),
+            "n_errors": int(handler_errors.get(handler=handler_name)),
+        }
+        for key, histogram in [("db", update_db_calls), ("telegram", update_telegram_calls), ("llm", update_llm_calls)]:
+            calls_series = histogram.get_series().get((handler_name,))
+            item[f"avg_{key}_calls"] = calls_series.sum / calls_series.count if calls_series is not None and calls_series.count > 0 else None
+        summary.append(item)
+
+    return sorted(summary, key=lambda item: item["count"] * item["avg_duration"], reverse=True)
+
+
+class MetricsServer:
+    """Local HTTP server with /metrics endpoint in Prometheus text format
+    """
+    def __init__(self, listen: str, port: int):
+        self.listen = listen
+        self.port = port
+
+        self._runner: Optional[web.AppRunner] = None
+        self.http_app = web.Application()
+        self.http_app.router.add_get("/metrics", self._handle_metrics)
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.http_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"Metrics are served on {self.listen}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain")
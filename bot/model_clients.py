@@ -0,0 +1,113 @@
+from typing import Optional, Any, Dict, Tuple
+
+import logging
+from pydoc import locate
+
+import aiohttp
+import openai
+
+from llm_tools.llm_streaming import StreamingOpenAIChatModel
+from llm_tools.llm_fallback import StreamingModelWithFallback
+
+from bot import config
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModelClientRegistry:
+    """Builds chat model clients of config.model_apis once per (model, api type) and routes
+    all OpenAI requests through one keep-alive aiohttp session.
+
+    Streaming wrappers are still created per call: they accumulate token expenses of one stream,
+    but they only hold references to shared clients, so creating them is cheap
+    """
+    def __init__(self, connection_limit: int = 100, keepalive_timeout: float = 60.0):
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+
+        self._chat_models: Dict[Tuple[str, str], Any] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        self.n_clients_created = 0
+        self.n_clients_reused = 0
+        self.n_connections_created = 0
+        self.n_connections_reused = 0
+
+    def get_chat_model(self, model: str, api_type: str) -> Any:
+        key = (model, api_type)
+        chat_model = self._chat_models.get(key)
+        if chat_model is not None:
+            self.n_clients_reused += 1
+            return chat_model
+
+        model_api = config.model_apis[model][api_type]
+        model_cls = locate(model_api["class"])
+        if model_cls is None:
+            raise ValueError(f"Can't locate model class {model_api['class']}")
+        chat_model = model_cls(**model_api["kwargs"])
+
+        self._chat_models[key] = chat_model
+        self.n_clients_created += 1
+        return chat_model
+
+    def get_streaming_model(self, model: str):
+        model_api = config.model_apis[model]
+
+        def _get_streaming_model(api_type: str):
+            return StreamingOpenAIChatModel(
+                self.get_chat_model(model, api_type),
+                **model_api[api_type].get("streaming_kwargs", {})
+            )
+
+        streaming_model = _get_streaming_model("default")
+        if "fallback" in model_api:
+            streaming_model = StreamingModelWithFallback(
+                [streaming_model, _get_streaming_model("fallback")]
+            )
+
+        return streaming_model
+
+    def use_http_session(self) -> None:
+        """Make OpenAI requests of current context (task) go through shared session.
+        Without it openai opens new session, and so new TLS connection, for every request
+        """
+        if self._session is None or self._session.closed:
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_connection_create_end.append(self._on_connection_created)
+            trace_config.on_connection_reuseconn.append(self._on_connection_reused)
+
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=self.keepalive_timeout),
+                trace_configs=[trace_config],
+            )
+
+        openai.aiosession.set(self._session)
+
+    async def _on_connection_created(self, session, trace_config_ctx, params) -> None:
+        self.n_connections_created += 1
+
+    async def _on_connection_reused(self, session, trace_config_ctx, params) -> None:
+        self.n_connections_reused += 1
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def get_statistics(self) -> Dict[str, Any]:
+        n_connections = self.n_connections_created + self.n_connections_reused
+        return {
+            "n_clients": len(self._chat_models),
+            "n_clients_created": self.n_clients_created,
+            "n_clients_reused": self.n_clients_reused,
+            "n_connections_created": self.n_connections_created,
+            "n_connections_reused": self.n_connections_reused,
+            "connection_reuse_rate": self.n_connections_reused / n_connections if n_connections > 0 else 0.0,
+        }
+
+
+model_clients = ModelClientRegistry(
+    connection_limit=config.llm_connection_limit,
+    keepalive_timeout=config.llm_keepalive_timeout,
+)
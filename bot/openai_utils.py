@@ -1,14 +1,14 @@
 import logging
-from pydoc import locate
 
 import openai
 
-from llm_tools.llm_streaming import StreamingOpenAIChatModel
-from llm_tools.llm_fallback import StreamingModelWithFallback
 from llm_tools.tokens import TokenExpenses
 from llm_tools.errors import ModelContextSizeExceededError
 
 from bot import config
+from bot.metrics import track_llm_call, llm_call
+from bot.model_clients import model_clients
+from bot.context_budget import get_n_first_dialog_messages_to_remove
 
 
 logger = logging.getLogger(__name__)
@@ -35,23 +35,34 @@ class ChatGPT:
         dialog_messages=[],
         chat_mode: str = "assistant",
     ):
-        if chat_mode not in config.chat_modes.keys():
+        if chat_mode not in config.snapshot.chat_modes:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
         answer = ""
         n_dialog_messages_before = len(dialog_messages)
         n_first_dialog_messages_removed = 0
 
+        model_clients.use_http_session()
+
+        # drop oldest messages which don't fit into context before sending, instead of retrying on overflow
+        n_first_dialog_messages_to_remove = get_n_first_dialog_messages_to_remove(
+            self.model, config.snapshot.chat_modes[chat_mode].prompt_start, dialog_messages, message
+        )
+        if n_first_dialog_messages_to_remove > 0:
+            logger.info(f"Context budget exceeded. Removing {n_first_dialog_messages_to_remove} first messages in dialog_messages")
+            dialog_messages = dialog_messages[n_first_dialog_messages_to_remove:]
+
         is_finished = False
-        while not is_finished:  # iterating to reduce context size if needed
+        while not is_finished:  # iterating only if local token count was lower than API one
             messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
             streaming_model = self._get_streaming_model()
 
             try:
-                gen = streaming_model.stream_llm_reply(messages=messages)
-                async for answer, _ in gen:
-                    n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                    yield answer, n_first_dialog_messages_removed
+                with track_llm_call("chat"):
+                    gen = streaming_model.stream_llm_reply(messages=messages)
+                    async for answer, _ in gen:
+                        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
+                        yield answer, n_first_dialog_messages_removed
 
                 answer = self._postprocess_answer(answer)
                 is_finished = True
@@ -59,7 +70,7 @@ class ChatGPT:
                 if e.during_streaming:  # TODO: catch separate error when n_output_tokens >= max_tokens
                     is_finished = True
                 else:
-                    logger.info("Context length exceeded. Removing first message in dialog_messages")
+                    logger.warning("Context length exceeded despite context budget. Removing first message in dialog_messages")
                     if len(dialog_messages) == 0:
                         raise ValueError("Context length exceeded and dialog messages is empty")
 
@@ -72,30 +83,11 @@ class ChatGPT:
                     token_expenses.add_expense(expense)
 
     def _get_streaming_model(self):
-        model_api = config.model_apis[self.model]
-
-        def _instantinate_streaming_model(type: str):
-            assert type in {"default", "fallback"}
-            model_cls = locate(model_api[type]["class"])
-            model_kwargs = dict(model_api[type]["kwargs"])
-            model = model_cls(**model_kwargs)
-            streaming_model = StreamingOpenAIChatModel(
-                model,
-                **model_api[type].get("streaming_kwargs", {})
-            )
-            return streaming_model
-
-        streaming_model = _instantinate_streaming_model("default")
-        if "fallback" in model_api:
-            fallback_streaming_model = _instantinate_streaming_model("fallback")
-            streaming_model = StreamingModelWithFallback(
-                [streaming_model, fallback_streaming_model]
-            )
-
-        return streaming_model
+        # new streaming model per stream (it counts tokens spent), underlying clients are shared
+        return model_clients.get_streaming_model(self.model)
 
     def _generate_prompt_messages(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        prompt = config.snapshot.chat_modes[chat_mode].prompt_start
 
         messages = [{"role": "system", "content": prompt}]
         for dialog_message in dialog_messages:
@@ -110,9 +102,11 @@ class ChatGPT:
         return answer
 
 
+@llm_call("transcribe")
 async def transcribe_audio(audio_file):
     model = "whisper-1"
     model_api = config.model_apis[model]
+    model_clients.use_http_session()
 
     r = await openai.Audio.atranscribe(
         file=audio_file,
@@ -122,9 +116,11 @@ async def transcribe_audio(audio_file):
     return r["text"]
 
 
+@llm_call("images")
 async def generate_images(prompt, n_images=4):
     model = "dalle-2"
     model_api = config.model_apis[model]
+    model_clients.use_http_session()
 
     r = await openai.Image.acreate(
         prompt=prompt,
@@ -136,9 +132,11 @@ async def generate_images(prompt, n_images=4):
     return image_urls
 
 
+@llm_call("moderation")
 async def is_content_acceptable(prompt):
     model = "moderation"
     model_api = config.model_apis[model]
+    model_clients.use_http_session()
 
     r = await openai.Moderation.acreate(
         input=prompt,
@@ -2,10 +2,11 @@ from bot import config
 from bot.queue.message_queue import MessageQueueWithTokenBudget, MessageQueueWatchdog
 
 # message queue
+# each worker process has its own queue, so budget is split between them
 message_queue = MessageQueueWithTokenBudget(
-    token_budget_per_day=config.message_queue_token_budget_per_day,
-    initial_token_budget=config.message_queue_initial_token_budget,
+    token_budget_per_day=config.message_queue_token_budget_per_day / config.n_workers,
+    initial_token_budget=config.message_queue_initial_token_budget // config.n_workers,
 ) if config.enable_message_queue else None
 
-# user tasks (used for task cancelling)
+# user tasks (used for task cancelling), entries are removed when task is finished
 user_tasks = dict()
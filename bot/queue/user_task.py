@@ -12,7 +12,8 @@ from bot.utils import cancel_asyncio_task_and_wait
 from bot.queue.utils import MessageQueueTaskId, MessageQueueTaskPriority
 from bot.queue.globals import message_queue, user_tasks
 from bot.handlers.generate_response import generate_response
-from bot.handlers.utils import user_semaphores
+from bot.handlers.utils import user_locks
+from bot.workers import user_leases
 from bot.database import UserId, ChatId
 from bot.config import user_tasks_dump_path
 
@@ -100,15 +101,26 @@ async def create_and_run_user_task(
     message_text: str,
     do_subtract_tokens: bool
 ):
-    async with user_semaphores[user_id]:
-        await _create_and_run_user_task_impl(
-            user_task_type=user_task_type,
-            bot=bot,
-            user_id=user_id,
-            chat_id=chat_id,
-            message_text=message_text,
-            do_subtract_tokens=do_subtract_tokens,
-        )
+    async with user_locks.acquire(user_id):
+        async with user_leases.acquire(user_id):
+            await _create_and_run_user_task_impl(
+                user_task_type=user_task_type,
+                bot=bot,
+                user_id=user_id,
+                chat_id=chat_id,
+                message_text=message_text,
+                do_subtract_tokens=do_subtract_tokens,
+            )
+
+
+async def cancel_user_task(user_id: UserId) -> bool:
+    """Cancel task of user running in this process. Returns False if there is no such task
+    """
+    if user_id not in user_tasks:
+        return False
+
+    await user_tasks[user_id].cancel()
+    return True
 
 
 async def _create_and_run_user_task_impl(
@@ -0,0 +1,85 @@
+from typing import Any, Dict, Iterator, Set, Union
+from collections.abc import Mapping
+import string
+
+
+StringValue = Union[str, tuple]
+
+
+class StringTable(Mapping):
+    """Flat name -> string table of one language
+    """
+    def __init__(self, lang: str, table: Dict[str, StringValue]):
+        self._lang = lang
+        self._table = table
+
+    @property
+    def lang(self) -> str:
+        return self._lang
+
+    def __getitem__(self, name: str) -> StringValue:
+        return self._table[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._table)
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+
+def _get_format_fields(name: str, lang: str, value: str) -> Set[str]:
+    try:
+        return {
+            field_name for _, field_name, _, _ in string.Formatter().parse(value)
+            if field_name is not None
+        }
+    except ValueError as e:
+        raise ValueError(f"String '{name}' ({lang}) has invalid format: {e}")
+
+
+def _get_value_format_fields(name: str, lang: str, value: Any) -> Set[str]:
+    if isinstance(value, str):
+        return _get_format_fields(name, lang, value)
+    elif isinstance(value, (list, tuple)):
+        fields = set()
+        for item in value:
+            if not isinstance(item, str):
+                raise ValueError(f"String '{name}' ({lang}) contains non-string item: {item!r}")
+            fields |= _get_format_fields(name, lang, item)
+        return fields
+    else:
+        raise ValueError(f"String '{name}' ({lang}) has unsupported type: {type(value).__name__}")
+
+
+def compile_string_tables(strings: Dict[str, Dict[str, Any]], default_lang: str) -> Dict[str, StringTable]:
+    """Compile strings.yml ({name: {lang: value}}) into one flat table per language.
+
+    Every string must have a default language value, missing translations fall back to it.
+    Translations of one string must use the same format fields, so .format() with the fields
+    of the default language never fails in other languages.
+    """
+    langs = set()
+    for name, values in strings.items():
+        if not isinstance(values, dict):
+            raise ValueError(f"String '{name}' must be a mapping of language to value")
+        langs |= set(values.keys())
+
+    tables = {lang: {} for lang in langs | {default_lang}}
+    for name, values in strings.items():
+        if default_lang not in values:
+            raise ValueError(f"String '{name}' has no value for default language '{default_lang}'")
+
+        default_fields = _get_value_format_fields(name, default_lang, values[default_lang])
+        for lang, value in values.items():
+            fields = _get_value_format_fields(name, lang, value)
+            if fields != default_fields:
+                raise ValueError(
+                    f"String '{name}' ({lang}) has format fields {sorted(fields)}, "
+                    f"but '{default_lang}' has {sorted(default_fields)}"
+                )
+
+        for lang, table in tables.items():
+            value = values.get(lang, values[default_lang])
+            table[name] = tuple(value) if isinstance(value, list) else value
+
+    return {lang: StringTable(lang, table) for lang, table in tables.items()}
@@ -1,4 +1,6 @@
 import asyncio
+import pydub
+from contextlib import asynccontextmanager
 
 
 def split_text_into_chunks(text, chunk_size):
@@ -6,6 +8,11 @@ def split_text_into_chunks(text, chunk_size):
         yield text[i:i + chunk_size]
 
 
+def convert_audio(input_path, output_path, format: str) -> None:
+    # module-level to be runnable in process pool
+    pydub.AudioSegment.from_file(input_path).export(output_path, format=format)
+
+
 async def cancel_asyncio_task_and_wait(task: asyncio.Task):
     task.cancel()
     # ensure that task is cancelled
@@ -13,3 +20,47 @@ async def cancel_asyncio_task_and_wait(task: asyncio.Task):
         await task
     except asyncio.CancelledError:
         pass
+
+
+class KeyedLockRegistry:
+    """Per-key asyncio locks which are kept only while somebody holds or waits for them,
+    so the registry size is bounded by the number of concurrently active keys
+    """
+    class _Entry:
+        def __init__(self):
+            self.lock = asyncio.Lock()
+            self.n_refs = 0
+
+    def __init__(self):
+        self._entries = dict()
+        self.max_size = 0
+
+    def locked(self, key) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.lock.locked()
+
+    @asynccontextmanager
+    async def acquire(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = KeyedLockRegistry._Entry()
+            self.max_size = max(self.max_size, len(self._entries))
+        entry.n_refs += 1
+
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.n_refs -= 1
+            if entry.n_refs == 0:
+                del self._entries[key]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_statistics(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "n_locked": sum(1 for entry in self._entries.values() if entry.lock.locked()),
+            "max_size": self.max_size,
+        }
@@ -0,0 +1,168 @@
+from typing import Optional, Dict, Any
+
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from bot import config
+
+
+logger = logging.getLogger(__name__)
+
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def normalize_url_path(url_path: str) -> str:
+    return url_path if url_path.startswith("/") else f"/{url_path}"
+
+
+class WebhookServer:
+    """Embedded HTTP server which receives updates from Telegram and processes them with application.
+
+    Updates are counted until their processing is finished. When max_pending_updates are pending,
+    new ones are rejected with 503 and Telegram redelivers them later instead of piling up in memory.
+    (application.update_queue can't do it: with concurrent updates it's drained immediately,
+    and updates wait for free slot as tasks)
+    """
+    def __init__(
+        self,
+        application: Application,
+        listen: str,
+        port: int,
+        url_path: str,
+        secret_token: str,
+        max_pending_updates: int = 1000,
+    ):
+        if not secret_token:
+            raise ValueError("secret_token is required, otherwise forged updates are accepted")
+
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.url_path = normalize_url_path(url_path)
+        self.secret_token = secret_token
+        self.max_pending_updates = max_pending_updates
+
+        # same limit as application uses for updates from update_queue
+        self._processing_semaphore = asyncio.Semaphore(max(application.concurrent_updates, 1))
+        self.n_pending_updates = 0  # received, but not processed yet (waiting for slot or in handler)
+
+        self._runner: Optional[web.AppRunner] = None
+        self.http_app = web.Application()
+        self.http_app.router.add_post(self.url_path, self._handle_update)
+
+        self.n_received = 0
+        self.n_rejected = 0
+        self.n_unauthorized = 0
+        self.n_bad_requests = 0
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.http_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"Webhook server is listening on {self.listen}:{self.port}{self.url_path}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+            logger.info("Webhook server stopped")
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        request_secret_token = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(request_secret_token.encode(), self.secret_token.encode()):  # str version fails on non-ascii
+            self.n_unauthorized += 1
+            return web.Response(status=403)
+
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except (json.JSONDecodeError, ValueError, TypeError):
+            self.n_bad_requests += 1
+            return web.Response(status=400)
+
+        if update is None:
+            self.n_bad_requests += 1
+            return web.Response(status=400)
+
+        if self.n_pending_updates >= self.max_pending_updates:
+            self.n_rejected += 1
+            return web.Response(status=503)
+
+        self.n_pending_updates += 1
+        self.n_received += 1
+        self.application.create_task(self._process_update(update), update=update)
+        return web.Response(status=200)
+
+    async def _process_update(self, update: Update) -> None:
+        try:
+            async with self._processing_semaphore:
+                await self.application.process_update(update)
+        finally:
+            self.n_pending_updates -= 1
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "n_received": self.n_received,
+            "n_rejected": self.n_rejected,
+            "n_unauthorized": self.n_unauthorized,
+            "n_bad_requests": self.n_bad_requests,
+            "n_pending_updates": self.n_pending_updates,
+            "max_pending_updates": self.max_pending_updates,
+        }
+
+
+def run_webhook(
+    application: Application,
+    listen: Optional[str] = None,
+    port: Optional[int] = None,
+    set_webhook: bool = True,
+) -> None:
+    """Analog of application.run_polling() which receives updates with WebhookServer.
+    Stopping is done by application.stop(), so pre_stop also runs in this mode
+    """
+    webhook_server = WebhookServer(
+        application,
+        listen=listen or config.webhook_listen,
+        port=port or config.webhook_port,
+        url_path=config.webhook_url_path,
+        secret_token=config.webhook_secret_token,
+        max_pending_updates=config.webhook_max_pending_updates,
+    )
+    application.bot_data["webhook_server"] = webhook_server
+
+    async def _run():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        await application.initialize()
+        try:
+            if application.post_init is not None:
+                await application.post_init(application)
+            await application.start()
+            await webhook_server.start()
+
+            if set_webhook and config.webhook_url is not None:
+                await application.bot.set_webhook(
+                    url=config.webhook_url,
+                    secret_token=config.webhook_secret_token,
+                    max_connections=config.webhook_max_connections,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+
+            await stop_event.wait()
+        finally:
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_run())
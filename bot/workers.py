@@ -0,0 +1,276 @@
+from typing import Optional, Dict, Any, List, Set, Callable, Awaitable
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+from contextlib import asynccontextmanager
+
+import aiohttp
+from aiohttp import web
+import telegram
+from telegram import Update
+
+from bot import config
+from bot.database import db, UserId
+from bot.utils import cancel_asyncio_task_and_wait
+from bot.webhook import SECRET_TOKEN_HEADER, normalize_url_path
+
+
+logger = logging.getLogger(__name__)
+
+
+WORKER_INDEX_ENV = "BOT_WORKER_INDEX"
+
+
+class UserLeaseManager:
+    """Mongo-backed per-user lease, gives user exclusivity across worker processes and hosts.
+
+    Held leases are renewed in background with one query. The same loop picks up
+    cancel requests made by /cancel in other processes. Disabled in single process mode
+    """
+    def __init__(self, owner: str, ttl: float, renew_interval: float, enabled: bool = True):
+        self.owner = owner
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.enabled = enabled
+        self.acquire_poll_interval = 0.5
+
+        self.on_cancel_requested: Optional[Callable[[UserId], Awaitable[Any]]] = None
+
+        self._held_user_ids: Set[UserId] = set()
+        self._renew_task: Optional[asyncio.Task] = None
+
+    @asynccontextmanager
+    async def acquire(self, user_id: UserId):
+        if not self.enabled:
+            yield
+            return
+
+        while not await db.acquire_user_lease(user_id, self.owner, self.ttl):
+            await asyncio.sleep(self.acquire_poll_interval)
+        self._held_user_ids.add(user_id)
+
+        try:
+            yield
+        finally:
+            self._held_user_ids.discard(user_id)
+            try:
+                await db.release_user_lease(user_id, self.owner)
+            except Exception:
+                logger.exception(f"Failed to release lease of user {user_id}, it will expire in {self.ttl}s")
+
+    async def is_held(self, user_id: UserId) -> bool:
+        if not self.enabled:
+            return False
+        return await db.check_if_user_lease_is_held(user_id)
+
+    async def request_cancel(self, user_id: UserId) -> bool:
+        if not self.enabled:
+            return False
+        return await db.request_user_task_cancel(user_id)
+
+    def run(self) -> None:
+        if self.enabled:
+            self._renew_task = asyncio.create_task(self._renew_loop())
+
+    async def shutdown(self) -> None:
+        if self._renew_task is not None:
+            await cancel_asyncio_task_and_wait(self._renew_task)
+            self._renew_task = None
+
+    async def _renew_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            try:
+                user_ids_to_cancel = await db.renew_user_leases(self.owner, list(self._held_user_ids), self.ttl)
+                for user_id in user_ids_to_cancel:
+                    await db.clear_user_task_cancel_request(user_id, self.owner)
+                    if self.on_cancel_requested is not None:
+                        await self.on_cancel_requested(user_id)
+            except Exception:
+                logger.exception("Failed to renew user leases")
+
+
+user_leases = UserLeaseManager(
+    owner=f"{socket.gethostname()}:{os.getpid()}",
+    ttl=config.user_lease_ttl,
+    renew_interval=config.user_lease_renew_interval,
+    enabled=config.n_workers > 1,
+)
+
+
+def get_update_user_id(update_dict: Dict[str, Any]) -> Optional[UserId]:
+    # every update type carries its sender in "from" (or "user" for poll_answer)
+    for value in update_dict.values():
+        if isinstance(value, dict):
+            for key in ["from", "user"]:
+                if isinstance(value.get(key), dict) and "id" in value[key]:
+                    return value[key]["id"]
+    return None
+
+
+def get_worker_index(user_id: Optional[UserId], n_workers: int) -> int:
+    if user_id is None:
+        return 0
+    return user_id % n_workers
+
+
+def get_worker_port(worker_index: int) -> int:
+    return config.webhook_port + 1 + worker_index
+
+
+class UpdateRouter:
+    """Receives webhook updates and forwards them to worker processes partitioned by user_id,
+    so all updates of one user are handled by the same worker
+    """
+    def __init__(self, listen: str, port: int, url_path: str, worker_urls: List[str]):
+        self.listen = listen
+        self.port = port
+        self.url_path = normalize_url_path(url_path)
+        self.worker_urls = worker_urls
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._runner: Optional[web.AppRunner] = None
+        self.http_app = web.Application()
+        self.http_app.router.add_post(self.url_path, self._handle_update)
+
+        self.n_routed = [0] * len(worker_urls)
+
+    async def start(self) -> None:
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        self._runner = web.AppRunner(self.http_app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        logger.info(f"Update router is listening on {self.listen}:{self.port}{self.url_path}, {len(self.worker_urls)} workers")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            update_dict = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(update_dict, dict):
+            return web.Response(status=400)
+
+        worker_index = get_worker_index(get_update_user_id(update_dict), len(self.worker_urls))
+        self.n_routed[worker_index] += 1
+
+        headers = {"Content-Type": "application/json"}
+        if SECRET_TOKEN_HEADER in request.headers:
+            headers[SECRET_TOKEN_HEADER] = request.headers[SECRET_TOKEN_HEADER]
+
+        try:
+            async with self._session.post(self.worker_urls[worker_index], data=body, headers=headers) as response:
+                return web.Response(status=response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # worker is down or restarting, Telegram will redeliver
+            return web.Response(status=503)
+
+
+def _run_worker() -> None:
+    from bot.app import setup_logging, run_bot
+
+    setup_logging()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)  # until bot installs its config reload handler
+    run_bot()
+
+
+def run_workers() -> None:
+    """Run config.n_workers bot processes behind UpdateRouter. Requires webhook mode,
+    because Telegram allows only one getUpdates consumer per bot
+    """
+    if not config.webhook_enabled:
+        raise ValueError("n_workers > 1 requires webhook_enabled")
+
+    n_workers = config.n_workers
+    mp_context = multiprocessing.get_context("spawn")
+    processes: Dict[int, multiprocessing.Process] = {}
+
+    def _start_worker(worker_index: int):
+        # spawned processes take environment at start, config reads worker index from it
+        os.environ[WORKER_INDEX_ENV] = str(worker_index)
+        try:
+            process = mp_context.Process(target=_run_worker, name=f"bot_worker_{worker_index}")
+            process.start()
+        finally:
+            os.environ.pop(WORKER_INDEX_ENV, None)
+
+        processes[worker_index] = process
+        logger.info(f"Started worker {worker_index} (pid={process.pid})")
+
+    def _reload_workers_config():
+        logger.info("Forwarding config reload to workers")
+        for process in processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    router = UpdateRouter(
+        listen=config.webhook_listen,
+        port=config.webhook_port,
+        url_path=config.webhook_url_path,
+        worker_urls=[
+            f"http://127.0.0.1:{get_worker_port(worker_index)}{normalize_url_path(config.webhook_url_path)}"
+            for worker_index in range(n_workers)
+        ],
+    )
+
+    async def _run():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            loop.add_signal_handler(sig, stop_event.set)
+        loop.add_signal_handler(signal.SIGHUP, _reload_workers_config)
+
+        for worker_index in range(n_workers):
+            _start_worker(worker_index)
+
+        await router.start()
+        try:
+            if config.webhook_url is not None:
+                bot = telegram.Bot(config.telegram_token)
+                async with bot:
+                    await bot.set_webhook(
+                        url=config.webhook_url,
+                        secret_token=config.webhook_secret_token,
+                        max_connections=config.webhook_max_connections,
+                        allowed_updates=Update.ALL_TYPES,
+                    )
+
+            # restart crashed workers
+            while not stop_event.is_set():
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=5.0)
+                except asyncio.TimeoutError:
+                    pass
+
+                for worker_index, process in list(processes.items()):
+                    if not stop_event.is_set() and not process.is_alive():
+                        logger.error(f"Worker {worker_index} exited with code {process.exitcode}, restarting")
+                        _start_worker(worker_index)
+        finally:
+            await router.stop()
+
+            # SIGTERM makes worker run pre_stop
+            for process in processes.values():
+                if process.is_alive():
+                    process.terminate()
+            for worker_index, process in processes.items():
+                await loop.run_in_executor(None, process.join, 120)
+                if process.is_alive():
+                    logger.error(f"Worker {worker_index} did not stop in time, killing")
+                    process.kill()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_run())
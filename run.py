@@ -1,10 +1,10 @@
-import logging
-from bot.app import run_bot
+from bot import config
+from bot.app import setup_logging, run_bot
+from bot.workers import run_workers
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)-12s :%(name)-15s: %(levelname)-8s %(message)s'
-    )
-    logging.getLogger("openai").setLevel(logging.ERROR)
-    run_bot()
+    setup_logging()
+    if config.n_workers > 1:
+        run_workers()
+    else:
+        run_bot()
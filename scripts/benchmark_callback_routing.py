@@ -0,0 +1,81 @@
+# run: python scripts/benchmark_callback_routing.py
+# compares routing + parsing of callback data: regex pattern per handler + dataclasses.fields based load (old)
+# vs prefix dict lookup + compiled codec (current)
+
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+import re
+import timeit
+from dataclasses import fields
+
+from bot.handlers import constants
+from bot.handlers.callback_router import CallbackQueryRouter
+
+
+CALLBACK_DATA_CLASSES = [
+    constants.NewDialogButtonData,
+    constants.ChoosePageChatModesData,
+    constants.SetChatModeData,
+    constants.SettingsData,
+    constants.SpeedupMessageQueueButtonData,
+    constants.ShowPaymentMethodsData,
+    constants.ShowProductsData,
+    constants.InviteFriendData,
+    constants.InvoiceData,
+]
+
+SAMPLE_DATA = [
+    constants.SetChatModeData("assistant").dump(),
+    constants.ChoosePageChatModesData(2).dump(),
+    constants.SettingsData("gpt-4").dump(),
+    constants.InvoiceData("cryptomus", "100k_tokens").dump(),
+    constants.NewDialogButtonData(True).dump(),
+]
+
+
+def legacy_load(cls, data):
+    parts = data.split("|")
+    prefix = parts[0]
+    if prefix != cls.prefix:
+        raise ValueError(f"Invalid prefix: {prefix}")
+    _fields = fields(cls)
+    if len(parts) != len(_fields):
+        raise ValueError(f"Invalid number of parts {len(parts)} in data {data} for {_fields}")
+    _fields = [x for x in _fields if x.name != "prefix"]
+    kwargs = {f.name: cls.string_to_field_value(p, f.type) for f, p in zip(_fields, parts[1:])}
+    return cls(**kwargs)
+
+
+def main(n_iterations: int = 20000):
+    # old: handlers are checked one by one, first matching regex wins
+    legacy_handlers = [(re.compile(cls.pattern()), cls) for cls in CALLBACK_DATA_CLASSES]
+
+    def _legacy():
+        for data in SAMPLE_DATA:
+            for pattern, cls in legacy_handlers:
+                if pattern.match(data):
+                    legacy_load(cls, data)
+                    break
+
+    # new
+    router = CallbackQueryRouter()
+    for cls in CALLBACK_DATA_CLASSES:
+        router.add(cls, cls.load)  # handler is replaced by load to measure routing + parsing only
+
+    def _routed():
+        for data in SAMPLE_DATA:
+            router.get_handler(data)(data)
+
+    legacy_time = min(timeit.repeat(_legacy, number=n_iterations, repeat=5))
+    routed_time = min(timeit.repeat(_routed, number=n_iterations, repeat=5))
+
+    n_calls = n_iterations * len(SAMPLE_DATA)
+    print(f"regex + legacy load: {1e6 * legacy_time / n_calls:.2f} us/callback")
+    print(f"router + codec:      {1e6 * routed_time / n_calls:.2f} us/callback")
+    print(f"speedup: {legacy_time / routed_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+# run: docker compose --env-file config/config.env run chatgpt_telegram_bot_pro python /code/scripts/index_report.py
+# applies INDEX_SPEC (idempotent) and prints index usage and slow unindexed queries
+
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+import re
+import html
+import asyncio
+
+from bot import database
+from bot.handlers.admin import format_index_report
+
+
+async def main():
+    db = database.Database()
+    await db.ensure_indexes()
+
+    report = await db.get_index_report(n_slow_queries=50)
+    text = format_index_report(report)
+
+    # strip html tags for terminal output
+    print(html.unescape(re.sub(r"<[^>]+>", "", text)))
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
+    loop.close()
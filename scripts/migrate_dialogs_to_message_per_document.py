@@ -0,0 +1,103 @@
+# run: docker compose --env-file config/config.env run chatgpt_telegram_bot_pro python /code/scripts/migrate_dialogs_to_message_per_document.py
+# moves messages from `messages` array of dialog documents to `dialog_message` collection.
+# stop the bot and run it BEFORE switching dialog_storage to message_per_document: after switching,
+# appends to not migrated dialog allocate seq from 0 and collide with or go before moved messages.
+# while the bot is still on embedded storage, messages appended to cleared dialog go to `messages` array again.
+# safe to run several times: already moved messages are upserted by (dialog_id, seq)
+# dialog is cleared only if no message was appended since it was read, otherwise it's migrated again in next pass
+
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+
+import asyncio
+import argparse
+
+from pymongo import UpdateOne
+
+from bot import database
+from bot.database import MessagePerDocumentDialogStorage
+
+
+async def migrate_dialogs(db, dialog_storage, query: dict, batch_size: int) -> list:
+    """Migrate dialogs matching query. Returns ids of dialogs which got new messages while
+    being migrated (they were not cleared)
+    """
+    n_dialogs = await db.dialog_collection.count_documents(query)
+    print(f"Found {n_dialogs} dialogs to migrate")
+
+    n_migrated_dialogs, n_migrated_messages = 0, 0
+    requests, migrated_dialogs = [], []
+    changed_dialog_ids = []
+
+    async def _clear_dialog(dialog_id, n_moved_messages: int, n_messages: int) -> None:
+        # guarded by array size: messages appended after read must not be lost
+        result = await db.dialog_collection.update_one(
+            {"_id": dialog_id, "messages": {"$size": n_moved_messages}},
+            {"$set": {"messages": [], "n_messages": n_messages}},
+        )
+        if result.matched_count == 0:
+            changed_dialog_ids.append(dialog_id)
+
+    async def _flush():
+        nonlocal n_migrated_dialogs, n_migrated_messages, requests, migrated_dialogs
+        if len(requests) > 0:
+            await dialog_storage.dialog_message_collection.bulk_write(requests, ordered=False)
+
+        # dialogs are updated only after their messages were written
+        await asyncio.gather(*[_clear_dialog(*item) for item in migrated_dialogs])
+
+        n_migrated_dialogs += len(migrated_dialogs)
+        n_migrated_messages += len(requests)
+        requests, migrated_dialogs = [], []
+        print(f"Migrated {n_migrated_dialogs}/{n_dialogs} dialogs ({n_migrated_messages} messages)")
+
+    cursor = db.dialog_collection.find(query, projection={"user_id": 1, "messages": 1, "n_messages": 1})
+    async for dialog_dict in cursor:
+        # dialog could already have some messages in dialog_message collection
+        first_seq = dialog_dict.get("n_messages", 0)
+        for i, message in enumerate(dialog_dict["messages"]):
+            message_dict = MessagePerDocumentDialogStorage.build_message_dict(
+                dialog_dict["_id"], dialog_dict["user_id"], first_seq + i, message
+            )
+            requests.append(UpdateOne(
+                {"dialog_id": message_dict["dialog_id"], "seq": message_dict["seq"]},
+                {"$setOnInsert": message_dict},
+                upsert=True,
+            ))
+        migrated_dialogs.append((dialog_dict["_id"], len(dialog_dict["messages"]), first_seq + len(dialog_dict["messages"])))
+
+        if len(requests) >= batch_size:
+            await _flush()
+
+    await _flush()
+    return changed_dialog_ids
+
+
+async def main(batch_size: int, max_n_passes: int = 10):
+    db = database.Database()
+    dialog_storage = MessagePerDocumentDialogStorage(db.db)
+    await db.ensure_indexes()
+
+    query = {"messages.0": {"$exists": True}}
+    for _ in range(max_n_passes):
+        changed_dialog_ids = await migrate_dialogs(db, dialog_storage, query, batch_size)
+        if len(changed_dialog_ids) == 0:
+            print("Done")
+            return
+
+        # n_messages of changed dialogs wasn't updated, so their messages are upserted with the same seqs
+        print(f"{len(changed_dialog_ids)} dialogs got new messages during migration, migrating them again")
+        query = {"_id": {"$in": changed_dialog_ids}, "messages.0": {"$exists": True}}
+
+    print(f"Not done: {len(changed_dialog_ids)} dialogs are still changing, run script again")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=1000, help="number of messages written in one bulk_write")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args.batch_size))
+    loop.close()
@@ -20,6 +20,7 @@ from bot import database
 from bot.app import show_balance_handle
 
 newsletter_id = "60_new_chat_modes"
+delivery_batch_size = 50
 
 async def main():
     # setup
@@ -32,14 +33,13 @@ async def main():
     db = database.Database()
 
     # db collection
-    db.create_newsletter(newsletter_id)
-    already_sent_to_user_ids = set(db.get_newsletter_attribute(newsletter_id, "already_sent_to_user_ids"))
-    print(f"Already sent to {len(already_sent_to_user_ids)} users")
+    await db.ensure_indexes()
+    await db.create_newsletter(newsletter_id)
+    print(f"Already sent to {await db.count_newsletter_deliveries(newsletter_id)} users")
 
     # choose users to send
-    # user_dicts = list(db.user_collection.find({"username": "karfly"}))
-    user_dicts = list(db.user_collection.find({}))
-    print(f"Found {len(user_dicts)} users")
+    # user_dicts = await db.get_users_not_in_newsletter(newsletter_id, query={"username": "karfly"})
+    user_dicts = await db.get_users_not_in_newsletter(newsletter_id)
 
     # send newsletter
     text = """🔥🎭 New hot <b>65+ chat modes</b> added to the bot!
@@ -57,32 +57,42 @@ Some highlights:
 
 ... and 60+ more chat modes for <b>many use cases</b>"""
 
+    # deliveries are recorded in batches (one round trip per batch), and also on exit,
+    # so that rerun doesn't send newsletter twice
+    delivered_user_ids = []
+
+    async def _flush_deliveries():
+        if len(delivered_user_ids) > 0:
+            await db.add_users_to_newsletter(newsletter_id, delivered_user_ids)
+            delivered_user_ids.clear()
+
     random.shuffle(user_dicts)
-    for user_dict in user_dicts:
-        if user_dict["_id"] in already_sent_to_user_ids:
-            print(f"Skipping {user_dict['_id']}. Already sent before")
-            continue
-
-        try:
-            await application.bot.send_message(
-                user_dict['chat_id'],
-                text,
-                disable_web_page_preview=True,
-                parse_mode=ParseMode.HTML
-            )
-            print(f"Successfully sent to {user_dict['_id']}")
-
-            db.add_user_to_newsletter(newsletter_id, user_dict["_id"])
-
-            time.sleep(1.0)
-        except Exception as e:
-            print(e)
-            if "httpx.LocalProtocolError" in str(e):
+    try:
+        for user_dict in user_dicts:
+            try:
+                await application.bot.send_message(
+                    user_dict['chat_id'],
+                    text,
+                    disable_web_page_preview=True,
+                    parse_mode=ParseMode.HTML
+                )
+                print(f"Successfully sent to {user_dict['_id']}")
+
+                delivered_user_ids.append(user_dict["_id"])
+                if len(delivered_user_ids) >= delivery_batch_size:
+                    await _flush_deliveries()
+
+                await asyncio.sleep(1.0)
+            except Exception as e:
                 print(e)
-                print("You need to start again")
-                exit()
-
-            print(f"Failed to send message to {user_dict['_id']}. Reason: {e}")
+                if "httpx.LocalProtocolError" in str(e):
+                    print(e)
+                    print("You need to start again")
+                    exit()
+
+                print(f"Failed to send message to {user_dict['_id']}. Reason: {e}")
+    finally:
+        await _flush_deliveries()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+# run: python scripts/post_recorded_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret-token <webhook_secret_token>
+# posts recorded Telegram updates (one JSON update per line) to webhook server and reports latency / throughput.
+# use a test bot token: handlers will process these updates and reply to their chats
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+
+def load_updates(path, n_repeats):
+    with open(path, "r") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+
+    # update_id must be unique, so repeated updates get new ones
+    all_updates = []
+    for i in range(n_repeats):
+        for update in updates:
+            update = dict(update)
+            update["update_id"] = len(all_updates) + 1
+            all_updates.append(update)
+    return all_updates
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def main(args):
+    updates = load_updates(args.updates_path, args.n_repeats)
+    headers = {}
+    if args.secret_token is not None:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret_token
+
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    latencies, statuses = [], {}
+
+    async def _worker(session):
+        while not queue.empty():
+            update = queue.get_nowait()
+            start_time = time.perf_counter()
+            async with session.post(args.url, json=update, headers=headers) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start_time)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    start_time = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[_worker(session) for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start_time
+
+    print(f"Posted {len(updates)} updates in {elapsed:.2f}s ({len(updates) / elapsed:.1f} updates/s)")
+    print(f"Statuses: {statuses}")
+    print(
+        f"Latency: p50={1000 * percentile(latencies, 0.5):.1f}ms, "
+        f"p95={1000 * percentile(latencies, 0.95):.1f}ms, "
+        f"p99={1000 * percentile(latencies, 0.99):.1f}ms"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("updates_path", help="file with one JSON update per line")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    parser.add_argument("--secret-token", default=None)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--n-repeats", type=int, default=1)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(args))
+    loop.close()
@@ -0,0 +1,50 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+
+
+config_dir = Path(__file__).parent.parent / "config"
+pytestmark = pytest.mark.skipif(not (config_dir / "config.yml").exists(), reason="bot config is read at import time")
+
+
+class _InMemoryDialogStorage:
+    def __init__(self, messages: list):
+        self.messages = messages
+        self.n_count_calls = 0
+
+    async def get_last_messages(self, dialog_id: str, user_id: int, n: int) -> list:
+        return self.messages[-n:]
+
+    async def count_messages(self, dialog_id: str, user_id: int) -> int:
+        self.n_count_calls += 1
+        return len(self.messages)
+
+
+def _get_dialog_messages_for_context(n_dialog_messages: int, max_n: int):
+    from bot.database import Database
+
+    async def _get_dialog_id(user_id, dialog_id=None):
+        return "dialog_id"
+
+    db = Database()
+    db._get_dialog_id = _get_dialog_id
+    db.dialog_storage = _InMemoryDialogStorage([{"user": str(i), "bot": str(i)} for i in range(n_dialog_messages)])
+
+    dialog_messages, n_not_loaded = asyncio.run(db.get_dialog_messages_for_context(1, max_n))
+    return dialog_messages, n_not_loaded, db.dialog_storage.n_count_calls
+
+
+def test_dialog_longer_than_limit_reports_not_loaded_messages():
+    dialog_messages, n_not_loaded, n_count_calls = _get_dialog_messages_for_context(n_dialog_messages=120, max_n=50)
+    assert [x["user"] for x in dialog_messages] == [str(i) for i in range(70, 120)]
+    assert n_not_loaded == 70
+    assert n_count_calls == 1
+
+
+@pytest.mark.parametrize("n_dialog_messages", [0, 10, 50])
+def test_dialog_within_limit_is_loaded_whole(n_dialog_messages):
+    dialog_messages, n_not_loaded, n_count_calls = _get_dialog_messages_for_context(n_dialog_messages, max_n=50)
+    assert len(dialog_messages) == n_dialog_messages
+    assert n_not_loaded == 0
+    assert n_count_calls == 0  # short dialogs aren't counted
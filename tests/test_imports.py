@@ -0,0 +1,13 @@
+import importlib
+from pathlib import Path
+
+import pytest
+
+
+config_dir = Path(__file__).parent.parent / "config"
+
+
+@pytest.mark.skipif(not (config_dir / "config.yml").exists(), reason="bot config is read at import time")
+def test_app_imports():
+    # handler modules import each other, this catches import cycles
+    importlib.import_module("bot.app")
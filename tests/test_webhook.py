@@ -0,0 +1,79 @@
+import asyncio
+import socket
+from pathlib import Path
+
+import aiohttp
+import pytest
+
+
+config_dir = Path(__file__).parent.parent / "config"
+pytestmark = pytest.mark.skipif(not (config_dir / "config.yml").exists(), reason="bot config is read at import time")
+
+
+SECRET_TOKEN = "secret"
+
+
+class _SlowApplication:
+    """Minimal Application stand-in, whose handlers don't finish until released
+    """
+    bot = None
+    concurrent_updates = 256
+
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.tasks = []
+        self.n_processed = 0
+
+    def create_task(self, coroutine, update=None):
+        task = asyncio.create_task(coroutine)
+        self.tasks.append(task)
+        return task
+
+    async def process_update(self, update):
+        await self.released.wait()
+        self.n_processed += 1
+
+
+def _get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_webhook_rejects_updates_over_limit():
+    from bot.webhook import WebhookServer, SECRET_TOKEN_HEADER
+
+    async def _run():
+        application = _SlowApplication()
+        port = _get_free_port()
+        webhook_server = WebhookServer(
+            application, listen="127.0.0.1", port=port, url_path="/telegram",
+            secret_token=SECRET_TOKEN, max_pending_updates=5,
+        )
+        await webhook_server.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                async def _post(update_id: int) -> int:
+                    async with session.post(
+                        f"http://127.0.0.1:{port}/telegram",
+                        json={"update_id": update_id},
+                        headers={SECRET_TOKEN_HEADER: SECRET_TOKEN},
+                    ) as response:
+                        return response.status
+
+                statuses = await asyncio.gather(*[_post(i) for i in range(50)])
+                assert statuses.count(200) == 5
+                assert statuses.count(503) == 45
+                assert webhook_server.n_pending_updates == 5
+
+                application.released.set()
+                await asyncio.gather(*application.tasks)
+                assert application.n_processed == 5
+                assert webhook_server.n_pending_updates == 0
+
+                assert await _post(50) == 200
+                await asyncio.gather(*application.tasks)
+        finally:
+            await webhook_server.stop()
+
+    asyncio.run(_run())